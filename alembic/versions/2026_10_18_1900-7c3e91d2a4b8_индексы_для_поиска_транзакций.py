@@ -0,0 +1,62 @@
+"""индексы для поиска транзакций
+
+Revision ID: 7c3e91d2a4b8
+Revises: de3a9a574be5
+Create Date: 2026-10-18 19:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7c3e91d2a4b8'
+down_revision: Union[str, None] = 'de3a9a574be5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    '''Upgrade schema.
+
+    Индексы создаются с CONCURRENTLY, чтобы не блокировать запись в большую таблицу
+    transactions на время построения. CREATE INDEX CONCURRENTLY нельзя выполнять
+    внутри транзакции, поэтому используется autocommit_block().
+
+    Если на таблице уже есть два возврата по одной исходной операции, построение
+    уникального индекса завершится ошибкой - такие строки нужно исправить вручную.
+    '''
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_transactions_account_id_transaction_date',
+            'transactions',
+            ['account_id', 'transaction_date', 'id'],
+            unique=False,
+            postgresql_concurrently=True
+        )
+        op.create_index(
+            'ix_transactions_pending_holds',
+            'transactions',
+            ['account_id', 'transaction_date'],
+            unique=False,
+            postgresql_where=sa.text("transaction_type = 'HOLD' AND transaction_status = 'PENDING'"),
+            postgresql_concurrently=True
+        )
+        op.create_index(
+            'uq_transactions_refund_original_transaction_id',
+            'transactions',
+            ['original_transaction_id'],
+            unique=True,
+            postgresql_where=sa.text("transaction_type = 'REFUND'"),
+            postgresql_concurrently=True
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('uq_transactions_refund_original_transaction_id', table_name='transactions', postgresql_concurrently=True)
+        op.drop_index('ix_transactions_pending_holds', table_name='transactions', postgresql_concurrently=True)
+        op.drop_index('ix_transactions_account_id_transaction_date', table_name='transactions', postgresql_concurrently=True)
@@ -0,0 +1,65 @@
+"""журнал изменений балансов ledger
+
+Revision ID: a1f4c2e9b7d3
+Revises: 7c3e91d2a4b8
+Create Date: 2026-10-18 20:00:00.000000
+
+"""
+from datetime import datetime, timezone
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a1f4c2e9b7d3'
+down_revision: Union[str, None] = '7c3e91d2a4b8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    '''Upgrade schema.
+
+    Вместе с таблицей для каждого существующего счета создается запись OPENING с текущими
+    балансом и удерживаемым балансом - от нее ведется отсчет изменений при восстановлении
+    балансов по журналу. Как и в app/ledger.py - open_accounts(), незавершенные удержания получают
+    собственные записи HOLD, а OPENING - удерживаемый баланс без них; время записей берется
+    из часов приложения.
+    '''
+    op.create_table('ledger',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('operation_id', sa.UUID(), nullable=True),
+    sa.Column('account_id', sa.Integer(), nullable=False),
+    sa.Column('entry_type', sa.VARCHAR(length=16), nullable=False),
+    sa.Column('amount', sa.DECIMAL(precision=15, scale=2), nullable=False),
+    sa.Column('balance_delta', sa.DECIMAL(precision=15, scale=2), nullable=False),
+    sa.Column('held_delta', sa.DECIMAL(precision=15, scale=2), nullable=False),
+    sa.Column('balance_after', sa.DECIMAL(precision=15, scale=2), nullable=True),
+    sa.Column('held_balance_after', sa.DECIMAL(precision=15, scale=2), nullable=True),
+    sa.Column('created_at', sa.TIMESTAMP(), nullable=False),
+    sa.ForeignKeyConstraint(['account_id'], ['accounts.id'], ondelete='restrict'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('operation_id', 'entry_type', name='uq_ledger_operation_id_entry_type')
+    )
+    op.create_index('ix_ledger_account_id_id', 'ledger', ['account_id', 'id'], unique=False)
+    op.execute(sa.text(
+        "WITH pending AS ("
+        "SELECT transaction_id, account_id, amount FROM transactions "
+        "WHERE transaction_type = 'HOLD' AND transaction_status NOT IN ('COMPLETED', 'CANCELLED', 'EXPIRED')"
+        "), holds AS ("
+        "INSERT INTO ledger (operation_id, account_id, entry_type, amount, balance_delta, held_delta, created_at) "
+        "SELECT transaction_id, account_id, 'HOLD', amount, 0, amount, :created_at FROM pending"
+        ") "
+        "INSERT INTO ledger (account_id, entry_type, amount, balance_delta, held_delta, balance_after, held_balance_after, created_at) "
+        "SELECT a.id, 'OPENING', a.balance, a.balance, a.held_balance - coalesce(p.amount, 0), "
+        "a.balance, a.held_balance - coalesce(p.amount, 0), :created_at FROM accounts a "
+        "LEFT JOIN (SELECT account_id, sum(amount) AS amount FROM pending GROUP BY account_id) p ON p.account_id = a.id"
+    ).bindparams(sa.bindparam('created_at', datetime.now(timezone.utc), type_=sa.TIMESTAMP())))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_ledger_account_id_id', table_name='ledger')
+    op.drop_table('ledger')
@@ -0,0 +1,41 @@
+"""индекс просроченных удержаний
+
+Revision ID: b7d2e4f1c903
+Revises: a1f4c2e9b7d3
+Create Date: 2026-10-18 21:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7d2e4f1c903'
+down_revision: Union[str, None] = 'a1f4c2e9b7d3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    '''Upgrade schema.
+
+    Частичный индекс по дате незавершенных удержаний для поиска просроченных удержаний
+    (см. app/sweeper.py). Создается с CONCURRENTLY, как и индексы в 7c3e91d2a4b8.
+    '''
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_transactions_pending_holds_transaction_date',
+            'transactions',
+            ['transaction_date', 'id'],
+            unique=False,
+            postgresql_where=sa.text("transaction_type = 'HOLD' AND transaction_status = 'PENDING'"),
+            postgresql_concurrently=True
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_transactions_pending_holds_transaction_date', table_name='transactions', postgresql_concurrently=True)
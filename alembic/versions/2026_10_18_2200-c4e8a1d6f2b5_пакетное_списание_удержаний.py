@@ -0,0 +1,61 @@
+"""пакетное списание удержаний
+
+Revision ID: c4e8a1d6f2b5
+Revises: b7d2e4f1c903
+Create Date: 2026-10-18 22:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4e8a1d6f2b5'
+down_revision: Union[str, None] = 'b7d2e4f1c903'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('settlements',
+    sa.Column('settlement_id', sa.UUID(), nullable=False),
+    sa.Column('status', sa.VARCHAR(length=16), nullable=False),
+    sa.Column('account_id', sa.Integer(), nullable=True),
+    sa.Column('created_before', sa.TIMESTAMP(), nullable=True),
+    sa.Column('created_at', sa.TIMESTAMP(), nullable=False),
+    sa.Column('finished_at', sa.TIMESTAMP(), nullable=True),
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['account_id'], ['accounts.id'], ondelete='restrict'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('settlement_id')
+    )
+    op.create_table('settlement_items',
+    sa.Column('settlement_id', sa.Integer(), nullable=False),
+    sa.Column('operation_id', sa.UUID(), nullable=False),
+    sa.Column('status', sa.VARCHAR(length=16), nullable=False),
+    sa.Column('account_id', sa.Integer(), nullable=True),
+    sa.Column('amount', sa.DECIMAL(precision=15, scale=2), nullable=True),
+    sa.Column('message', sa.TEXT(), nullable=True),
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['account_id'], ['accounts.id'], ondelete='restrict'),
+    sa.ForeignKeyConstraint(['settlement_id'], ['settlements.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('settlement_id', 'operation_id', name='uq_settlement_items_settlement_id_operation_id')
+    )
+    op.create_index(
+        'ix_settlement_items_pending',
+        'settlement_items',
+        ['settlement_id', 'id'],
+        unique=False,
+        postgresql_where=sa.text("status = 'PENDING'")
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_settlement_items_pending', table_name='settlement_items', postgresql_where=sa.text("status = 'PENDING'"))
+    op.drop_table('settlement_items')
+    op.drop_table('settlements')
@@ -0,0 +1,42 @@
+"""слоты удерживаемого баланса
+
+Revision ID: d9a3f5b2e7c1
+Revises: c4e8a1d6f2b5
+Create Date: 2026-10-18 23:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd9a3f5b2e7c1'
+down_revision: Union[str, None] = 'c4e8a1d6f2b5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('accounts', sa.Column('hold_slots', sa.SMALLINT(), server_default='0', nullable=False))
+    op.add_column('transactions', sa.Column('hold_slot', sa.SMALLINT(), nullable=True))
+    op.create_table('account_slots',
+    sa.Column('account_id', sa.Integer(), nullable=False),
+    sa.Column('slot', sa.SMALLINT(), nullable=False),
+    sa.Column('reserved', sa.DECIMAL(precision=15, scale=2), nullable=False),
+    sa.Column('held', sa.DECIMAL(precision=15, scale=2), nullable=False),
+    sa.Column('charged', sa.DECIMAL(precision=15, scale=2), nullable=False),
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['account_id'], ['accounts.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('account_id', 'slot', name='uq_account_slots_account_id_slot')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('account_slots')
+    op.drop_column('transactions', 'hold_slot')
+    op.drop_column('accounts', 'hold_slots')
@@ -0,0 +1,28 @@
+"""книга резервирований
+
+Revision ID: e2b7c9d4a6f8
+Revises: d9a3f5b2e7c1
+Create Date: 2026-10-19 00:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e2b7c9d4a6f8'
+down_revision: Union[str, None] = 'd9a3f5b2e7c1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('account_slots', sa.Column('wal_lsn', sa.BIGINT(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('account_slots', 'wal_lsn')
@@ -0,0 +1,54 @@
+"""исходящие события outbox
+
+Revision ID: f3c8d5a7b9e2
+Revises: e2b7c9d4a6f8
+Create Date: 2026-10-19 01:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3c8d5a7b9e2'
+down_revision: Union[str, None] = 'e2b7c9d4a6f8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('outbox',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('event_id', sa.UUID(), nullable=False),
+    sa.Column('event_type', sa.VARCHAR(length=16), nullable=False),
+    sa.Column('operation_id', sa.UUID(), nullable=False),
+    sa.Column('account_id', sa.Integer(), nullable=False),
+    sa.Column('amount', sa.DECIMAL(precision=15, scale=2), nullable=False),
+    sa.Column('balance', sa.DECIMAL(precision=15, scale=2), nullable=True),
+    sa.Column('held_balance', sa.DECIMAL(precision=15, scale=2), nullable=True),
+    sa.Column('created_at', sa.TIMESTAMP(), nullable=False),
+    sa.Column('published_at', sa.TIMESTAMP(), nullable=True),
+    sa.Column('attempts', sa.Integer(), server_default=sa.text('0'), nullable=False),
+    sa.Column('last_error', sa.TEXT(), nullable=True),
+    sa.ForeignKeyConstraint(['account_id'], ['accounts.id'], ondelete='restrict'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('event_id')
+    )
+    op.create_index(
+        'ix_outbox_unpublished',
+        'outbox',
+        ['id'],
+        unique=False,
+        postgresql_where=sa.text('published_at IS NULL')
+    )
+    op.create_index('ix_outbox_published_at', 'outbox', ['published_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_outbox_published_at', table_name='outbox')
+    op.drop_index('ix_outbox_unpublished', table_name='outbox', postgresql_where=sa.text('published_at IS NULL'))
+    op.drop_table('outbox')
@@ -0,0 +1,30 @@
+"""внешний идентификатор клиента
+
+Revision ID: a6d1e8f4c2b7
+Revises: f3c8d5a7b9e2
+Create Date: 2026-10-19 02:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a6d1e8f4c2b7'
+down_revision: Union[str, None] = 'f3c8d5a7b9e2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('clients', sa.Column('external_id', sa.VARCHAR(length=64), nullable=True))
+    op.create_unique_constraint('clients_external_id_key', 'clients', ['external_id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_constraint('clients_external_id_key', 'clients', type_='unique')
+    op.drop_column('clients', 'external_id')
@@ -0,0 +1,70 @@
+'''
+Кэш неизменяемых атрибутов счета: номер счета (UUID) -> внутренний id, валюта, клиент.
+
+Удержание по номеру счета сначала определяет внутренний id счета. Эти атрибуты после
+открытия счета не меняются, поэтому их можно не читать из базы данных при каждом запросе.
+Балансы в кэш не попадают и всегда читаются и изменяются в базе данных.
+
+Условный UPDATE удержания дополнительно проверяет номер счета, поэтому устаревшая запись
+(счет удален) не приводит к изменению чужого счета: запрос не находит строку, и запись
+удаляется из кэша (см. services.py - hold_funds()).
+
+Хранилище: память процесса (`ACCOUNT_CACHE_SIZE`, `ACCOUNT_CACHE_TTL`) и, если задан
+`REDIS_URL`, общий кэш в Redis (см. cache.py).
+'''
+from collections import namedtuple
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from app.cache import LRUCache, TieredCache
+from app.database.accounts import Accounts
+from app.redis_client import get_redis
+from app.settings import app_settings
+
+'''
+`hold_slots` - количество слотов удерживаемого баланса (см. hot_accounts.py). В отличие от остальных
+атрибутов может измениться; устаревшее значение не нарушает проверку баланса, а удержание
+обнаруживает изменение и удаляет запись из кэша (см. services.py - hold_funds()).
+'''
+AccountRef = namedtuple('AccountRef', ('id', 'account_number', 'currency', 'client_id', 'hold_slots'), defaults=(0,))
+
+
+def _default_cache():
+    local = LRUCache(app_settings.account_cache_size, app_settings.account_cache_ttl)
+    client = get_redis()
+    if client is None:
+        return local
+    return TieredCache(local, client, 'account', app_settings.account_cache_ttl)
+
+
+account_cache = _default_cache()
+
+
+def _key(account_number) -> str:
+    return str(account_number).lower()
+
+
+def get_account_ref(db: Session, account_number: str):
+    '''
+    Атрибуты счета с номером `account_number` из кэша или из базы данных.
+
+    Выходные данные - AccountRef или None, если счет не найден. Отсутствие счета не кэшируется.
+    '''
+    key = _key(account_number)
+    cached = account_cache.get(key)
+    if cached is not None:
+        return AccountRef(*cached)
+
+    row = db.execute(
+        select(Accounts.id, Accounts.account_number, Accounts.currency, Accounts.client_id, Accounts.hold_slots)
+        .where(Accounts.account_number == account_number)
+    ).first()
+    if row is None:
+        return None
+
+    ref = AccountRef(row.id, str(row.account_number), row.currency, row.client_id, row.hold_slots)
+    account_cache.set(key, list(ref))
+    return ref
+
+
+def invalidate_account(account_number: str):
+    account_cache.delete(_key(account_number))
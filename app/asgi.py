@@ -0,0 +1,144 @@
+'''
+ASGI-приложение с эндпоинтами операций.
+
+Обслуживает тот же контракт, что и Flask-приложение (см. routes.py):
+`POST /api/operation/<operation_id>/{hold,charge,cancel,refund}` с теми же телами
+запросов, ответами и кодами ответа. Запросы к базе данных выполняются асинхронно
+(см. async_services.py).
+
+Запуск:
+
+```sh
+uvicorn app.asgi:application --host 0.0.0.0 --port 8000
+```
+'''
+import json
+import logging
+import re
+from decimal import Decimal
+from app import async_services
+from app.money import json_default
+from app.replicas import replica_router
+from app.schemas import validate_operation_id, load_hold_request, load_refund_request
+
+logger = logging.getLogger(__name__)
+
+ROUTE = re.compile(r'^/api/operation/(?P<operation_id>[^/]+)/(?P<action>hold|charge|cancel|refund)$')
+
+
+async def _hold(operation_id: str, data):
+    try:
+        account_identifier, amount, description = load_hold_request(data)
+    except ValueError as e:
+        return 400, {'message': str(e)}
+
+    result = await async_services.process_hold_funds(operation_id, account_identifier, amount, description)
+    if "Операция удержания с данным ID уже существует" in result.get("message", ""):
+        return 200, result
+    return 201, result
+
+
+async def _charge(operation_id: str, data):
+    return 200, await async_services.process_charge_funds(operation_id)
+
+
+async def _cancel(operation_id: str, data):
+    return 200, await async_services.process_cancel_hold(operation_id)
+
+
+async def _refund(operation_id: str, data):
+    try:
+        description = load_refund_request(data)
+    except ValueError as e:
+        return 400, {'message': str(e)}
+
+    result = await async_services.process_refund_funds(operation_id, description)
+    if "Средства по данной операции уже были возвращены." in result.get("message", ""):
+        return 200, result
+    return 201, result
+
+
+HANDLERS = {
+    'hold': _hold,
+    'charge': _charge,
+    'cancel': _cancel,
+    'refund': _refund,
+}
+
+
+async def _read_json(receive):
+    '''
+    Чтение тела запроса и разбор JSON с дробными числами в `Decimal`.
+    Пустое или некорректное тело дает None, как `request.get_json(silent=True)` во Flask.
+    '''
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+
+    if not body:
+        return None
+    try:
+        return json.loads(body, parse_float=Decimal)
+    except ValueError:
+        return None
+
+
+async def _respond(send, status: int, payload: dict):
+    body = json.dumps(payload, default=json_default).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await async_services.async_engine.dispose()
+            await replica_router.dispose_async()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    match = ROUTE.match(scope['path'])
+    if match is None:
+        await _respond(send, 404, {'message': 'Не найдено.'})
+        return
+    if scope['method'] != 'POST':
+        await _respond(send, 405, {'message': 'Метод не поддерживается.'})
+        return
+
+    try:
+        operation_id = validate_operation_id(match['operation_id'])
+    except ValueError as e:
+        await _respond(send, 400, {'message': str(e)})
+        return
+
+    data = await _read_json(receive)
+    try:
+        status, payload = await HANDLERS[match['action']](operation_id, data)
+    except ValueError as e:
+        status, payload = 400, {'message': str(e)}
+    except Exception as e:
+        logger.exception("Ошибка при обработке %s", scope['path'])
+        status, payload = 500, {'message': 'Произошла внутренняя ошибка сервера.', 'error': str(e)}
+
+    await _respond(send, status, payload)
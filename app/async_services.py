@@ -0,0 +1,156 @@
+'''
+Асинхронные варианты операций для ASGI-приложения (см. asgi.py).
+
+Проверки и бизнес-логика не дублируются: функции `hold_funds()`, `charge_funds()`,
+`cancel_hold()` и `refund_funds()` из services.py выполняются через
+`AsyncSession.run_sync()`, т.е. тот же код работает поверх асинхронного соединения
+psycopg. Пока один запрос ждет ответа базы данных, цикл событий обслуживает другие,
+поэтому один процесс держит столько одновременных обращений к базе, сколько
+позволяет пул соединений.
+
+Функции `process_*()` повторяют порядок шагов одноименных функций services.py и выполняются
+в цикле событий:
+- кэш идемпотентности читается клиентом redis.asyncio (см. idempotency.py - `get_async()`),
+  повтор ищется на реплике через ее асинхронный движок (см. replicas.py - `run_on_replica_async()`);
+- отложенные вызовы транзакции (кэши в Redis, см. db_session.py - `after_commit()`) выполняются
+  после фиксации в потоке, если задан Redis: они обращаются к нему синхронным клиентом.
+  Без Redis они работают только с памятью процесса и выполняются в цикле событий;
+- в потоках выполняются только шаги, у которых нет асинхронного варианта: операции книги
+  резервирований (fsync WAL, запись и пополнение книги) и транзакции в режиме групповой
+  фиксации (см. group_commit.py), которые ждут общую транзакцию синхронного движка.
+
+Проверка операции в транзакции обращается к Redis только при промахе кэша счетов в памяти
+процесса (см. account_cache.py), такое обращение выполняется в цикле событий.
+'''
+import asyncio
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from app.db_session import engine_options, pop_after_commit
+from app.group_commit import group_committer
+from app.idempotency import idempotency_cache
+from app.redis_client import get_redis
+from app.replicas import run_on_replica_async
+from app.reservation_book import reservation_book
+from app.settings import app_settings
+from app import services, metrics, sql_profiler
+
+async_engine = create_async_engine(app_settings.url, **engine_options())
+sql_profiler.attach(async_engine.sync_engine)
+
+async_session = async_sessionmaker(async_engine, autoflush=False)
+
+
+def _run_callbacks(callbacks: list):
+    for callback, args in callbacks:
+        callback(*args)
+
+
+async def run_in_transaction(operation, *args):
+    '''
+    Асинхронный аналог services.run_in_transaction().
+    '''
+    if app_settings.group_commit_enabled:
+        return await asyncio.to_thread(group_committer.submit, operation, *args)
+
+    async with async_session() as db:
+        try:
+            result = await db.run_sync(operation, *args)
+            callbacks = pop_after_commit(db.sync_session)
+            with metrics.stage('commit'):
+                await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+
+    if callbacks and get_redis() is not None:
+        await asyncio.to_thread(_run_callbacks, callbacks)
+    else:
+        _run_callbacks(callbacks)
+    return result
+
+
+async def find_replayed(operation_id: str, action: str):
+    '''
+    Асинхронный аналог services.find_replayed().
+    '''
+    result = await idempotency_cache.get_async(operation_id, action)
+    if result is None:
+        result = await run_on_replica_async(services.find_finished_operation, operation_id, action)
+        if result is not None:
+            await idempotency_cache.store_async(operation_id, action, result)
+    return result
+
+
+async def process_hold_funds(operation_id: str, account_identifier: str, amount, description: str):
+    '''
+    Удержание средств. См. services.process_hold_funds().
+    '''
+    amount = services.normalize_hold_amount(amount)
+
+    cached_result = await idempotency_cache.get_async(operation_id, 'hold')
+    if cached_result is not None:
+        return cached_result
+
+    if app_settings.reservation_book_enabled:
+        result = await asyncio.to_thread(reservation_book.hold, operation_id, account_identifier, amount, description)
+        if result is not None:
+            return result
+
+    try:
+        return await run_in_transaction(services.hold_funds, operation_id, account_identifier, amount, description)
+    except IntegrityError:
+        result = await run_in_transaction(services.find_active_hold, operation_id)
+        if result is None:
+            raise
+        return result
+
+
+async def process_charge_funds(operation_id: str):
+    '''
+    Списание удержанных средств. См. services.process_charge_funds().
+    '''
+    cached_result = await find_replayed(operation_id, 'charge')
+    if cached_result is not None:
+        return cached_result
+
+    if app_settings.reservation_book_enabled:
+        await asyncio.to_thread(reservation_book.flush_operation, operation_id)
+
+    try:
+        return await run_in_transaction(services.charge_funds, operation_id)
+    except ValueError:
+        if not app_settings.reservation_book_enabled or not await asyncio.to_thread(reservation_book.await_operation, operation_id):
+            raise
+    return await run_in_transaction(services.charge_funds, operation_id)
+
+
+async def process_cancel_hold(operation_id: str):
+    '''
+    Отмена удержания. См. services.process_cancel_hold().
+    '''
+    cached_result = await find_replayed(operation_id, 'cancel')
+    if cached_result is not None:
+        return cached_result
+
+    if app_settings.reservation_book_enabled:
+        result = await asyncio.to_thread(reservation_book.cancel, operation_id)
+        if result is not None:
+            return result
+
+    try:
+        return await run_in_transaction(services.cancel_hold, operation_id)
+    except ValueError:
+        if not app_settings.reservation_book_enabled or not await asyncio.to_thread(reservation_book.await_operation, operation_id):
+            raise
+    return await run_in_transaction(services.cancel_hold, operation_id)
+
+
+async def process_refund_funds(operation_id: str, description: str = "Возврат средств"):
+    '''
+    Возврат средств. См. services.process_refund_funds().
+    '''
+    cached_result = await find_replayed(operation_id, 'refund')
+    if cached_result is not None:
+        return cached_result
+
+    return await run_in_transaction(services.refund_funds, operation_id, description)
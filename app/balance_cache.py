@@ -0,0 +1,107 @@
+'''
+Проекция балансов счетов для `GET /api/account/<account_number>/balance`.
+
+Операции, изменяющие баланс (удержание, списание, отмена, возврат, освобождение просроченных
+удержаний), получают новые значения баланса из RETURNING своего UPDATE и после фиксации
+транзакции записывают их в проекцию (`project_balance()`). Чтение баланса обслуживается
+из проекции; при промахе баланс читается из базы данных - с реплики, если она задана
+(см. replicas.py).
+
+Проекция - подсказка для клиента, а не проверка: удержание по-прежнему проверяет доступный
+баланс условным UPDATE в базе данных. Значение в проекции может отставать от базы данных
+не более чем на `BALANCE_CACHE_TTL` секунд: записи других процессов не обновляют память
+текущего процесса, а записи параллельных операций одного счета могут попасть в проекцию
+не в порядке фиксации.
+
+Хранилище: память процесса (`BALANCE_CACHE_SIZE`, `BALANCE_CACHE_TTL`) и, если задан
+`REDIS_URL`, общий кэш в Redis (см. cache.py).
+'''
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from app.cache import LRUCache, TieredCache
+from app.database.accounts import Accounts
+from app.db_session import after_commit
+from app.hot_accounts import BALANCE, HELD_BALANCE
+from app.replicas import run_read
+from app.redis_client import get_redis
+from app.settings import app_settings
+
+
+def _default_cache():
+    local = LRUCache(app_settings.balance_cache_size, app_settings.balance_cache_ttl)
+    client = get_redis()
+    if client is None:
+        return local
+    return TieredCache(local, client, 'balance', app_settings.balance_cache_ttl)
+
+
+balance_cache = _default_cache()
+
+
+def _key(account_number) -> str:
+    return str(account_number).lower()
+
+
+def store_balance(account_number, currency: str, balance: Decimal, held_balance: Decimal) -> list:
+    '''
+    Запись значений баланса счета в проекцию. Суммы хранятся строками, чтобы в Redis
+    они не проходили через float.
+    '''
+    value = [str(account_number), currency, str(balance), str(held_balance), time.time()]
+    balance_cache.set(_key(account_number), value)
+    return value
+
+
+def project_balance(db: Session, account_number, currency: str, balance: Decimal, held_balance: Decimal):
+    '''
+    Запись новых значений баланса счета в проекцию после фиксации транзакции `db`.
+    '''
+    after_commit(db, store_balance, account_number, currency, balance, held_balance)
+
+
+def _read_balance(db: Session, account_number: str):
+    return db.execute(
+        select(Accounts.account_number, Accounts.currency, BALANCE, HELD_BALANCE)
+        .where(Accounts.account_number == account_number)
+    ).first()
+
+
+def get_balance(account_number: str):
+    '''
+    Баланс счета из проекции или из базы данных.
+
+    Выходные данные - словарь или None, если счет не найден:
+
+    ```
+    {
+        "account_id": "XXXXXXXX-XXXX-XXXX-XXXX-XXXXXXXXXXXX",
+        "currency": "KZT",
+        "balance": 1000.00,
+        "held_balance": 100.00,
+        "available_balance": 900.00,
+        "as_of": "2026-10-18T12:00:00.000000+00:00"
+    }
+    ```
+
+    `as_of` - время, на которое получены значения.
+    '''
+    value = balance_cache.get(_key(account_number))
+    if value is None:
+        row = run_read(_read_balance, account_number)
+        if row is None:
+            return None
+        value = store_balance(row.account_number, row.currency, row.balance, row.held_balance)
+
+    account_number, currency, balance, held_balance, as_of = value
+    balance, held_balance = Decimal(balance), Decimal(held_balance)
+    return {
+        "account_id": account_number,
+        "currency": currency,
+        "balance": balance,
+        "held_balance": held_balance,
+        "available_balance": balance - held_balance,
+        "as_of": datetime.fromtimestamp(as_of, timezone.utc).isoformat()
+    }
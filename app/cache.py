@@ -0,0 +1,103 @@
+'''
+Кэши для редко изменяемых данных.
+
+- `LRUCache` - кэш в памяти процесса с ограничением по количеству записей (вытесняются
+  давно не использованные) и временем жизни записей;
+- `TieredCache` - `LRUCache` перед общим кэшем в Redis: промах в памяти процесса проверяется
+  в Redis, и найденное значение сохраняется в памяти процесса. Значения в Redis хранятся в JSON.
+
+Удаление записи из `TieredCache` удаляет ее из памяти текущего процесса и из Redis, но не из
+памяти других процессов - там запись живет до истечения времени жизни. Поэтому эти кэши
+подходят только для данных, которые не меняются или устаревание которых на время жизни
+записи допустимо.
+
+Ошибки Redis не прерывают запрос: они записываются в лог, и значение считается отсутствующим.
+'''
+import json
+import logging
+import time
+from collections import OrderedDict
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        with self._lock:
+            self._items[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class TieredCache:
+    def __init__(self, local: LRUCache, client, prefix: str, ttl: int):
+        self.local = local
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def _key(self, key) -> str:
+        return f"{self.prefix}:{key}"
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        try:
+            raw = self.client.get(self._key(key))
+        except Exception:
+            logger.warning("Redis недоступен при чтении кэша '%s'.", self.prefix, exc_info=True)
+            return None
+        if raw is None:
+            return None
+        value = json.loads(raw)
+        self.local.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        try:
+            self.client.set(self._key(key), json.dumps(value), ex=self.ttl)
+        except Exception:
+            logger.warning("Redis недоступен при записи кэша '%s'.", self.prefix, exc_info=True)
+
+    def delete(self, key):
+        self.local.delete(key)
+        try:
+            self.client.delete(self._key(key))
+        except Exception:
+            logger.warning("Redis недоступен при удалении из кэша '%s'.", self.prefix, exc_info=True)
+
+    def clear(self):
+        self.local.clear()
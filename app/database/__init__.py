@@ -11,11 +11,20 @@ __all__ = (
     'Clients',
     'Accounts',
     'Cards',
-    'Transactions'
+    'Transactions',
+    'Ledger',
+    'Settlements',
+    'SettlementItems',
+    'AccountSlots',
+    'Outbox'
 )
 
 from app.database.base import Base
 from app.database.clients import Clients
 from app.database.accounts import Accounts
 from app.database.cards import Cards
-from app.database.transactions import Transactions
\ No newline at end of file
+from app.database.transactions import Transactions
+from app.database.ledger import Ledger
+from app.database.settlements import Settlements, SettlementItems
+from app.database.account_slots import AccountSlots
+from app.database.outbox import Outbox
\ No newline at end of file
@@ -0,0 +1,29 @@
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy import SMALLINT, BIGINT, DECIMAL, ForeignKey, UniqueConstraint
+from app.database.base import Base
+from decimal import Decimal
+
+class AccountSlots(Base):
+    '''
+    Слот удерживаемого баланса "горячего" счета (см. hot_accounts.py).
+
+    - `reserved` - часть доступного баланса счета, переданная слоту; учтена в `accounts.held_balance`;
+    - `held` - сумма удержаний, выполненных через слот;
+    - `charged` - сумма списаний через слот, еще не перенесенная в `accounts.balance`.
+
+    Свободный остаток слота - `reserved - held - charged`.
+
+    Слоты с отрицательными номерами принадлежат книгам резервирований (см. reservation_book.py);
+    `wal_lsn` - номер последней записи журнала книги, уже перенесенной в базу данных.
+    '''
+    __tablename__ = 'account_slots'
+    __table_args__ = (
+        UniqueConstraint('account_id', 'slot', name='uq_account_slots_account_id_slot'),
+    )
+
+    account_id: Mapped[int] = mapped_column(ForeignKey('accounts.id', ondelete='cascade'), nullable=False)
+    slot: Mapped[int] = mapped_column(SMALLINT, nullable=False)
+    reserved: Mapped[Decimal] = mapped_column(DECIMAL(15, 2), nullable=False, default=0.00)
+    held: Mapped[Decimal] = mapped_column(DECIMAL(15, 2), nullable=False, default=0.00)
+    charged: Mapped[Decimal] = mapped_column(DECIMAL(15, 2), nullable=False, default=0.00)
+    wal_lsn: Mapped[int] = mapped_column(BIGINT, nullable=True)
@@ -1,12 +1,14 @@
 from sqlalchemy.orm import Mapped, mapped_column
-from sqlalchemy import TIMESTAMP, VARCHAR, UUID, DECIMAL, ForeignKey
+from sqlalchemy import TIMESTAMP, VARCHAR, UUID, DECIMAL, SMALLINT, ForeignKey
 from app.database.base import Base
+from decimal import Decimal
 
 
 class Accounts(Base):
     client_id: Mapped[int] = mapped_column(ForeignKey("clients.id", ondelete="cascade"))
     account_number: Mapped[str] = mapped_column(UUID, nullable=False, unique=True)
     account_type: Mapped[str] = mapped_column(VARCHAR(64), nullable=False)
-    balance: Mapped[float] = mapped_column(DECIMAL(15, 2), nullable=False, default=0.00)
+    balance: Mapped[Decimal] = mapped_column(DECIMAL(15, 2), nullable=False, default=0.00)
     currency: Mapped[str] = mapped_column(VARCHAR(3), nullable=False)
-    held_balance: Mapped[float] = mapped_column(DECIMAL(15, 2), nullable=False, default=0.00)
\ No newline at end of file
+    held_balance: Mapped[Decimal] = mapped_column(DECIMAL(15, 2), nullable=False, default=0.00)
+    hold_slots: Mapped[int] = mapped_column(SMALLINT, nullable=False, default=0, server_default='0')
@@ -4,6 +4,12 @@ from app.database.base import Base
 
 
 class Clients(Base):
+    '''
+    Клиенты банка. `external_id` - идентификатор клиента во внешней системе, по которому
+    на клиента ссылаются счета при массовой загрузке (см. importer.py); у клиентов,
+    созданных не загрузкой, не заполнен.
+    '''
+    external_id: Mapped[str] = mapped_column(VARCHAR(64), unique=True, nullable=True)
     first_name: Mapped[str] = mapped_column(VARCHAR(64), nullable=False)
     last_name: Mapped[str] = mapped_column(VARCHAR(64), nullable=False)
     middle_name: Mapped[str] = mapped_column(VARCHAR(64), nullable=True)
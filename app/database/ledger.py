@@ -0,0 +1,33 @@
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy import TIMESTAMP, VARCHAR, UUID, DECIMAL, BigInteger, ForeignKey, Index, UniqueConstraint
+from app.database.base import Base
+import datetime
+from decimal import Decimal
+
+class Ledger(Base):
+    '''
+    Журнал изменений балансов счетов. Строки только добавляются и никогда не изменяются.
+
+    Каждая запись - одно событие операции (HOLD, CHARGE, CANCEL, REFUND) с изменением баланса
+    (`balance_delta`) и удерживаемого баланса (`held_delta`) и значениями после изменения.
+    Запись OPENING фиксирует баланс счета на момент начала ведения журнала, поэтому сумма
+    изменений по счету равна его текущему балансу (см. ledger.py - replay_balances()). Незавершенные
+    на этот момент удержания записываются отдельными записями HOLD (см. ledger.py - open_accounts()).
+
+    Пара (operation_id, entry_type) уникальна: повторная запись того же события отбрасывается.
+    '''
+    __table_args__ = (
+        Index('ix_ledger_account_id_id', 'account_id', 'id'),
+        UniqueConstraint('operation_id', 'entry_type', name='uq_ledger_operation_id_entry_type'),
+    )
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    operation_id: Mapped[str] = mapped_column(UUID, nullable=True)
+    account_id: Mapped[int] = mapped_column(ForeignKey('accounts.id', ondelete='restrict'), nullable=False)
+    entry_type: Mapped[str] = mapped_column(VARCHAR(16), nullable=False)
+    amount: Mapped[Decimal] = mapped_column(DECIMAL(15, 2), nullable=False)
+    balance_delta: Mapped[Decimal] = mapped_column(DECIMAL(15, 2), nullable=False)
+    held_delta: Mapped[Decimal] = mapped_column(DECIMAL(15, 2), nullable=False)
+    balance_after: Mapped[Decimal] = mapped_column(DECIMAL(15, 2), nullable=True)
+    held_balance_after: Mapped[Decimal] = mapped_column(DECIMAL(15, 2), nullable=True)
+    created_at: Mapped[datetime.datetime] = mapped_column(TIMESTAMP, nullable=False)
\ No newline at end of file
@@ -0,0 +1,35 @@
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy import TIMESTAMP, VARCHAR, UUID, DECIMAL, TEXT, BigInteger, Integer, ForeignKey, Index, text
+from app.database.base import Base
+import datetime
+from decimal import Decimal
+
+class Outbox(Base):
+    '''
+    Исходящие события операций (transactional outbox, см. outbox.py).
+
+    Строка добавляется в той же транзакции, что и изменение операции (HOLD, CHARGE, CANCEL,
+    EXPIRE, REFUND), поэтому событие существует тогда и только тогда, когда изменение зафиксировано.
+    Ретранслятор отправляет события в порядке `id` и отмечает их `published_at`; неотправленные
+    события выбираются по частичному индексу только по строкам без `published_at`.
+
+    `event_id` - ключ идемпотентности для получателей: при сбое после отправки событие
+    может быть доставлено повторно.
+    '''
+    __table_args__ = (
+        Index('ix_outbox_unpublished', 'id', postgresql_where=text('published_at IS NULL')),
+        Index('ix_outbox_published_at', 'published_at'),
+    )
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    event_id: Mapped[str] = mapped_column(UUID, unique=True, nullable=False)
+    event_type: Mapped[str] = mapped_column(VARCHAR(16), nullable=False)
+    operation_id: Mapped[str] = mapped_column(UUID, nullable=False)
+    account_id: Mapped[int] = mapped_column(ForeignKey('accounts.id', ondelete='restrict'), nullable=False)
+    amount: Mapped[Decimal] = mapped_column(DECIMAL(15, 2), nullable=False)
+    balance: Mapped[Decimal] = mapped_column(DECIMAL(15, 2), nullable=True)
+    held_balance: Mapped[Decimal] = mapped_column(DECIMAL(15, 2), nullable=True)
+    created_at: Mapped[datetime.datetime] = mapped_column(TIMESTAMP, nullable=False)
+    published_at: Mapped[datetime.datetime] = mapped_column(TIMESTAMP, nullable=True)
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, server_default=text('0'))
+    last_error: Mapped[str] = mapped_column(TEXT, nullable=True)
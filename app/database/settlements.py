@@ -0,0 +1,43 @@
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy import TIMESTAMP, VARCHAR, UUID, DECIMAL, TEXT, ForeignKey, Index, UniqueConstraint, text
+from app.database.base import Base
+import datetime
+from decimal import Decimal
+
+class Settlements(Base):
+    '''
+    Пакетное списание удержаний (см. settlement.py).
+
+    Статус RUNNING - пакет создан и обрабатывается (или обработка прервана и ее можно продолжить),
+    COMPLETED - все элементы пакета обработаны.
+    '''
+    settlement_id: Mapped[str] = mapped_column(UUID, unique=True, nullable=False)
+    status: Mapped[str] = mapped_column(VARCHAR(16), nullable=False)
+    account_id: Mapped[int] = mapped_column(ForeignKey('accounts.id', ondelete='restrict'), nullable=True)
+    created_before: Mapped[datetime.datetime] = mapped_column(TIMESTAMP, nullable=True)
+    created_at: Mapped[datetime.datetime] = mapped_column(TIMESTAMP, nullable=False)
+    finished_at: Mapped[datetime.datetime] = mapped_column(TIMESTAMP, nullable=True)
+
+class SettlementItems(Base):
+    '''
+    Удержание в пакетном списании и результат его обработки: PENDING - еще не обработано,
+    CHARGED - списано, SKIPPED - было списано до пакета, FAILED - не списано (причина в `message`).
+
+    Необработанные элементы пакета выбираются по частичному индексу только по строкам PENDING.
+    '''
+    __tablename__ = 'settlement_items'
+    __table_args__ = (
+        UniqueConstraint('settlement_id', 'operation_id', name='uq_settlement_items_settlement_id_operation_id'),
+        Index(
+            'ix_settlement_items_pending',
+            'settlement_id', 'id',
+            postgresql_where=text("status = 'PENDING'")
+        ),
+    )
+
+    settlement_id: Mapped[int] = mapped_column(ForeignKey('settlements.id', ondelete='cascade'), nullable=False)
+    operation_id: Mapped[str] = mapped_column(UUID, nullable=False)
+    status: Mapped[str] = mapped_column(VARCHAR(16), nullable=False)
+    account_id: Mapped[int] = mapped_column(ForeignKey('accounts.id', ondelete='restrict'), nullable=True)
+    amount: Mapped[Decimal] = mapped_column(DECIMAL(15, 2), nullable=True)
+    message: Mapped[str] = mapped_column(TEXT, nullable=True)
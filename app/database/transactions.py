@@ -1,14 +1,49 @@
 from sqlalchemy.orm import Mapped, mapped_column
-from sqlalchemy import TIMESTAMP, VARCHAR, UUID, DECIMAL, ForeignKey, TEXT
+from sqlalchemy import TIMESTAMP, VARCHAR, UUID, DECIMAL, SMALLINT, ForeignKey, TEXT, Index, text
 from app.database.base import Base
 import datetime
+from decimal import Decimal
 
 class Transactions(Base):
+    '''
+    Индексы подобраны под запросы из services.py:
+    - история операций счета - по (account_id, transaction_date, id);
+    - незавершенные удержания счета - частичный индекс только по строкам HOLD в статусе PENDING;
+    - просроченные удержания (sweeper.py) - такой же частичный индекс, упорядоченный по дате;
+    - возврат по исходной операции - частичный уникальный индекс, который также
+      не допускает двух возвратов по одной операции.
+
+    Поиск по transaction_id обслуживается индексом его уникального ограничения.
+
+    `hold_slot` - слот удерживаемого баланса "горячего" счета, через который выполнено удержание
+    (см. hot_accounts.py); для остальных удержаний и операций - NULL.
+    '''
+    __table_args__ = (
+        Index('ix_transactions_account_id_transaction_date', 'account_id', 'transaction_date', 'id'),
+        Index(
+            'ix_transactions_pending_holds',
+            'account_id', 'transaction_date',
+            postgresql_where=text("transaction_type = 'HOLD' AND transaction_status = 'PENDING'")
+        ),
+        Index(
+            'ix_transactions_pending_holds_transaction_date',
+            'transaction_date', 'id',
+            postgresql_where=text("transaction_type = 'HOLD' AND transaction_status = 'PENDING'")
+        ),
+        Index(
+            'uq_transactions_refund_original_transaction_id',
+            'original_transaction_id',
+            unique=True,
+            postgresql_where=text("transaction_type = 'REFUND'")
+        ),
+    )
+
     transaction_id: Mapped[str] = mapped_column(UUID, unique=True)
     account_id: Mapped[int] = mapped_column(ForeignKey('accounts.id', ondelete='restrict'), nullable=False)
     transaction_type: Mapped[str] = mapped_column(VARCHAR(64), nullable=False)
     transaction_date: Mapped[datetime.datetime] = mapped_column(TIMESTAMP, nullable=False)
-    amount: Mapped[float] = mapped_column(DECIMAL(15, 2), nullable=False)
+    amount: Mapped[Decimal] = mapped_column(DECIMAL(15, 2), nullable=False)
     description: Mapped[str] = mapped_column(TEXT)
     transaction_status: Mapped[str] = mapped_column(VARCHAR(64), nullable=False)
-    original_transaction_id: Mapped[str] = mapped_column(UUID, nullable=True, default=None)
\ No newline at end of file
+    original_transaction_id: Mapped[str] = mapped_column(UUID, nullable=True, default=None)
+    hold_slot: Mapped[int] = mapped_column(SMALLINT, nullable=True, default=None)
@@ -1,15 +1,216 @@
-from sqlalchemy import create_engine
+import time
+from contextlib import contextmanager
+from threading import Lock
+from flask import g, has_app_context
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.pool import QueuePool
 from app.database import Base
 from app.settings import app_settings
+from app import sql_profiler
 
-engine = create_engine(app_settings.url, echo=True)
+
+class PoolStats:
+    '''
+    Счетчики выдачи соединений из пула: сколько раз соединение запрашивалось,
+    сколько времени запросы ждали свободное соединение и сколько раз ожидание
+    закончилось ошибкой по таймауту.
+    '''
+
+    def __init__(self):
+        self._lock = Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record(self, wait: float, timed_out: bool = False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_total += wait
+            if wait > self.wait_max:
+                self.wait_max = wait
+
+
+pool_stats = PoolStats()
+
+
+class InstrumentedQueuePool(QueuePool):
+    '''
+    QueuePool, который замеряет время ожидания соединения.
+    '''
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            pool_stats.record(time.perf_counter() - started, timed_out=True)
+            raise
+        pool_stats.record(time.perf_counter() - started)
+        return connection
+
+
+def engine_options() -> dict:
+    '''
+    Общие параметры движка и пула из настроек. Используются синхронным движком ниже
+    и асинхронным движком в async_services.py.
+    '''
+    connect_args = {'prepare_threshold': app_settings.db_prepare_threshold}
+    if app_settings.db_statement_timeout > 0:
+        connect_args['options'] = f'-c statement_timeout={app_settings.db_statement_timeout}'
+    return {
+        'echo': app_settings.db_echo,
+        'pool_size': app_settings.db_pool_size,
+        'max_overflow': app_settings.db_max_overflow,
+        'pool_timeout': app_settings.db_pool_timeout,
+        'pool_recycle': app_settings.db_pool_recycle,
+        'pool_pre_ping': app_settings.db_pool_pre_ping,
+        'connect_args': connect_args
+    }
+
+
+engine = create_engine(app_settings.url, poolclass=InstrumentedQueuePool, **engine_options())
+sql_profiler.attach(engine)
 
 session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-def get_db():
+def after_commit(db: Session, callback, *args):
+    '''
+    Отложенный вызов `callback(*args)` после фиксации транзакции сессии `db`.
+
+    Используется для действий вне базы данных (кэши и т.п.), которые должны
+    выполняться только если изменения действительно зафиксированы. При откате
+    транзакции отложенные вызовы отбрасываются. При откате к точке сохранения
+    (`db.begin_nested()`) отбрасываются только вызовы, добавленные после нее.
+    '''
+    db.info.setdefault('after_commit', []).append((callback, args))
+
+def pop_after_commit(db: Session) -> list:
+    '''
+    Отложенные вызовы транзакции `db`, изъятые из сессии: пары `(callback, args)`, которые
+    вызывающая сторона выполняет сама после фиксации (см. async_services.py).
+    '''
+    db.info.pop('savepoints', None)
+    return db.info.pop('after_commit', [])
+
+@event.listens_for(Session, 'after_commit')
+def _run_after_commit(db: Session):
+    db.info.pop('savepoints', None)
+    for callback, args in db.info.pop('after_commit', ()):
+        callback(*args)
+
+@event.listens_for(Session, 'after_transaction_create')
+def _mark_savepoint(db: Session, transaction):
+    if transaction.nested:
+        db.info.setdefault('savepoints', {})[transaction] = len(db.info.get('after_commit', ()))
+
+@event.listens_for(Session, 'after_transaction_end')
+def _forget_savepoint(db: Session, transaction):
+    if transaction.nested:
+        db.info.get('savepoints', {}).pop(transaction, None)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_after_commit(db: Session):
+    savepoint = db.get_nested_transaction()
+    mark = db.info.get('savepoints', {}).get(savepoint) if savepoint is not None else None
+    if mark is None:
+        db.info.pop('savepoints', None)
+        db.info.pop('after_commit', None)
+        return
+    '''
+    Откат к точке сохранения: транзакция продолжается, отложенные вызовы до точки сохранения остаются.
+    '''
+    del db.info.get('after_commit', [])[mark:]
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_after_outer_rollback(db: Session, previous_transaction):
+    if not previous_transaction.nested:
+        db.info.pop('savepoints', None)
+        db.info.pop('after_commit', None)
+
+def get_request_session() -> Session:
+    '''
+    Сессия текущего запроса Flask.
+
+    Создается при первом обращении в рамках запроса и привязывается к одному
+    соединению из пула, которое удерживается до конца запроса. Все вызовы сервисов
+    в одном запросе работают через это соединение, а не берут новое из пула каждый раз.
+    Фиксация (commit) по-прежнему выполняется сервисами: сессия, привязанная к соединению
+    без открытой транзакции, сама открывает и фиксирует транзакции на нем.
+    '''
+    if 'db' not in g:
+        g.db_connection = engine.connect()
+        g.db = session(bind=g.db_connection)
+    return g.db
+
+def close_request_session(exception=None):
+    '''
+    Закрытие сессии запроса и возврат соединения в пул. Незафиксированные изменения откатываются.
+    '''
+    db = g.pop('db', None)
+    connection = g.pop('db_connection', None)
+    if db is not None:
+        db.close()
+    if connection is not None:
+        connection.close()
+
+@contextmanager
+def session_scope():
+    '''
+    Сессия для вызова сервиса.
+
+    Внутри запроса Flask - сессия запроса (см. get_request_session()), которая закрывается
+    по окончании запроса. Вне запроса (скрипты, фоновые задачи) - отдельная сессия,
+    которая закрывается при выходе из блока `with`.
+    '''
+    if has_app_context():
+        yield get_request_session()
+        return
+
     db = session()
     try:
         yield db
     finally:
         db.close()
+
+def init_app(app):
+    '''
+    Регистрация закрытия сессии запроса в приложении Flask.
+    '''
+    app.teardown_appcontext(close_request_session)
+
+def get_pool_stats() -> dict:
+    '''
+    Состояние пула соединений и статистика ожидания:
+
+    ```
+    {
+        "pool_size": 10,
+        "checked_out": 3,
+        "checked_in": 7,
+        "overflow": -7,
+        "checkouts": 1520,
+        "timeouts": 0,
+        "wait_total_ms": 12.4,
+        "wait_avg_ms": 0.008,
+        "wait_max_ms": 3.1
+    }
+    ```
+    '''
+    pool = engine.pool
+    checkouts = pool_stats.checkouts
+    return {
+        "pool_size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": pool.overflow(),
+        "checkouts": checkouts,
+        "timeouts": pool_stats.timeouts,
+        "wait_total_ms": round(pool_stats.wait_total * 1000, 3),
+        "wait_avg_ms": round(pool_stats.wait_total * 1000 / checkouts, 3) if checkouts else 0.0,
+        "wait_max_ms": round(pool_stats.wait_max * 1000, 3)
+    }
\ No newline at end of file
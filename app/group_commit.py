@@ -0,0 +1,219 @@
+'''
+Групповая фиксация операций (group commit).
+
+Без нее каждая операция (удержание, списание, отмена, возврат) фиксируется отдельной транзакцией,
+и каждая фиксация ждет записи WAL PostgreSQL на диск - при большом количестве параллельных запросов
+пропускная способность ограничена количеством fsync в секунду. При включенной групповой фиксации
+(`GROUP_COMMIT_ENABLED=true`) `services.run_in_transaction()` не выполняет операцию сама, а ставит
+ее в очередь процесса. Поток-исполнитель берет первую операцию из очереди, в течение
+`GROUP_COMMIT_WINDOW_MS` добирает к ней поступившие следом (не больше `GROUP_COMMIT_MAX_BATCH`) и
+выполняет их все в одной транзакции одним commit. Вызывающий поток ждет фиксации группы и получает
+результат или ошибку своей операции - ответ отдается только после того, как изменения зафиксированы.
+
+Изоляция операций группы:
+- каждая операция выполняется в своей точке сохранения. Ошибка операции (недостаточно средств,
+  операция уже существует и т.д.) откатывает только ее изменения и отложенные вызовы after_commit
+  (см. db_session.py) и возвращается ее вызывающему потоку, остальные операции группы фиксируются;
+- ошибка соединения с другими транзакциями (`OperationalError`: взаимная блокировка, таймаут запроса)
+  не возвращается сразу: после фиксации группы операция повторяется отдельной транзакцией;
+- если не удалась фиксация группы, транзакция откатывается, и все операции, не завершившиеся
+  собственной ошибкой, повторяются по одной, каждая своей транзакцией. Если фиксация прервалась
+  обрывом соединения и на самом деле состоялась, повтор безопасен: операции идемпотентны по
+  operation_id и вернут ответ повтора ("уже списаны", "уже существует и активна" и т.д.).
+
+Ограничения:
+- блокировки строк всех операций группы удерживаются до общей фиксации, поэтому порядок блокировок
+  (сначала счет, затем его слоты - см. hot_accounts.py) соблюдается только внутри операции.
+  Группы разных исполнителей и процессов, захватившие одни и те же счета в разном порядке, могут
+  взаимно заблокироваться; PostgreSQL обнаружит это через `deadlock_timeout` и отменит запрос одной
+  из операций, которая затем повторится отдельно. По умолчанию в процессе один исполнитель
+  (`GROUP_COMMIT_WORKERS=1`), и группы одного процесса не блокируют друг друга;
+- одиночная операция ждет окончания окна группы, то есть задержка ответа растет на
+  `GROUP_COMMIT_WINDOW_MS` - групповая фиксация выгодна только при параллельной нагрузке;
+- операции одного процесса выполняются исполнителями последовательно, поэтому общая пропускная
+  способность ограничена длительностью самих операций, а не fsync. Это относится и к ASGI-приложению
+  (async_services.py): в режиме групповой фиксации его операции выполняются синхронным движком.
+
+Метрики:
+- `group_commit_batch_size` - гистограмма количества операций в группе;
+- `group_commit_retries_total{reason}` - операции, повторенные отдельной транзакцией:
+  `conflict` - после `OperationalError`, `commit` - после ошибки фиксации группы.
+'''
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from sqlalchemy.exc import OperationalError
+from app.db_session import session
+from app.metrics import registry, Counter, Histogram
+from app.settings import app_settings
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+batch_size = registry.register(Histogram(
+    'group_commit_batch_size', 'Количество операций в одной групповой фиксации.', (),
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256)
+))
+retries_total = registry.register(Counter(
+    'group_commit_retries_total', 'Операции групповой фиксации, повторенные отдельной транзакцией.', ('reason',)
+))
+
+
+class _Operation:
+    __slots__ = ('operation', 'args', 'result', 'error', 'retry', 'done')
+
+    def __init__(self, operation, args: tuple):
+        self.operation = operation
+        self.args = args
+        self.result = None
+        self.error = None
+        self.retry = None
+        self.done = threading.Event()
+
+
+class GroupCommitter:
+    def __init__(self, window: float, max_batch: int, workers: int):
+        self.window = window
+        self.max_batch = max_batch
+        self.workers = workers
+        self.queue = None
+        self.threads = []
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def _ensure_started(self):
+        '''
+        Исполнители запускаются при первой операции в каждом процессе: потоки не переходят
+        в дочерние процессы при fork (см. server.py).
+        '''
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = queue.Queue()
+            self.threads = [
+                threading.Thread(target=self._run, name=f'group-commit-{number}', daemon=True)
+                for number in range(self.workers)
+            ]
+            for thread in self.threads:
+                thread.start()
+            self.pid = os.getpid()
+
+    def submit(self, operation, *args):
+        '''
+        Выполнение `operation(db, *args)` в составе группы и ожидание ее фиксации.
+
+        Выходные данные - результат операции. Ошибки операции передаются без изменений.
+        '''
+        self._ensure_started()
+        item = _Operation(operation, args)
+        self.queue.put(item)
+        item.done.wait()
+        if item.error is not None:
+            raise item.error
+        return item.result
+
+    def _run(self):
+        while True:
+            first = self.queue.get()
+            if first is _STOP:
+                return
+            batch = [first]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    '''
+                    Остановка откладывается до завершения текущей группы.
+                    '''
+                    self.queue.put(_STOP)
+                    break
+                batch.append(item)
+
+            try:
+                self._execute(batch)
+            except Exception as e:
+                logger.error("Ошибка групповой фиксации", exc_info=True)
+                for item in batch:
+                    if item.error is None:
+                        item.result, item.error = None, e
+            for item in batch:
+                item.done.set()
+
+    def _execute(self, batch: list):
+        if app_settings.metrics_enabled:
+            batch_size.observe((), len(batch))
+
+        db = session()
+        try:
+            for item in batch:
+                savepoint = db.begin_nested()
+                try:
+                    item.result = item.operation(db, *item.args)
+                    savepoint.commit()
+                except OperationalError:
+                    savepoint.rollback()
+                    item.result, item.retry = None, 'conflict'
+                except Exception as e:
+                    savepoint.rollback()
+                    item.result, item.error = None, e
+
+            try:
+                with metrics.stage('commit'):
+                    db.commit()
+            except Exception:
+                logger.warning("Не удалась фиксация группы из %d операций, операции повторяются по одной", len(batch), exc_info=True)
+                db.rollback()
+                for item in batch:
+                    if item.error is None:
+                        item.result, item.retry = None, 'commit'
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+        for item in batch:
+            if item.retry is not None:
+                self._execute_alone(item)
+
+    def _execute_alone(self, item: _Operation):
+        if app_settings.metrics_enabled:
+            retries_total.inc((item.retry,))
+        db = session()
+        try:
+            item.result = item.operation(db, *item.args)
+            with metrics.stage('commit'):
+                db.commit()
+        except Exception as e:
+            db.rollback()
+            item.result, item.error = None, e
+        finally:
+            db.close()
+
+    def stop(self):
+        if self.pid != os.getpid():
+            return
+        for _ in self.threads:
+            self.queue.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+        self.pid = None
+
+
+group_committer = GroupCommitter(
+    app_settings.group_commit_window_ms / 1000,
+    app_settings.group_commit_max_batch,
+    app_settings.group_commit_workers
+)
+atexit.register(group_committer.stop)
@@ -0,0 +1,153 @@
+'''
+История операций счета.
+
+Операции выбираются по индексу (account_id, transaction_date, id) (см. database/transactions.py)
+с keyset-пагинацией: курсор следующей страницы - пара (transaction_date, id) последней операции
+страницы, и следующая страница начинается условием `(transaction_date, id) < курсор` вместо OFFSET.
+Поэтому время чтения страницы не зависит от того, как далеко она от начала истории.
+
+Для выгрузки всей истории операции выводятся потоком в формате NDJSON (одна операция - одна
+строка JSON). Строки читаются серверным курсором порциями по `HISTORY_STREAM_CHUNK_SIZE`,
+поэтому память процесса не зависит от длины истории.
+
+Дата удержания обновляется при его списании и отмене, поэтому удержание, завершенное во время
+постраничного чтения, может переместиться в уже прочитанную часть истории и не попасть в ответ.
+'''
+import base64
+import binascii
+import json
+from datetime import datetime
+from sqlalchemy import select, tuple_
+from sqlalchemy.orm import Session
+from app.database import Transactions
+from app.db_session import session
+from app.replicas import pick_read_engine
+from app.money import json_default
+from app.settings import app_settings
+
+_COLUMNS = (
+    Transactions.id,
+    Transactions.transaction_id,
+    Transactions.transaction_type,
+    Transactions.transaction_status,
+    Transactions.amount,
+    Transactions.description,
+    Transactions.transaction_date,
+    Transactions.original_transaction_id
+)
+
+
+def encode_cursor(transaction_date: datetime, transaction_id: int) -> str:
+    raw = f"{transaction_date.isoformat()}|{transaction_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple:
+    '''
+    Выходные данные - кортеж `(transaction_date, id)`.
+    '''
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        transaction_date, transaction_id = raw.split('|')
+        return datetime.fromisoformat(transaction_date), int(transaction_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError('Некорректный курсор.')
+
+
+def history_query(account_id: int, filters: dict):
+    '''
+    Запрос операций счета по параметрам из schemas.py - load_history_query() без ограничения количества.
+    '''
+    query = select(*_COLUMNS).where(Transactions.account_id == account_id)
+    if filters["types"]:
+        query = query.where(Transactions.transaction_type.in_(filters["types"]))
+    if filters["statuses"]:
+        query = query.where(Transactions.transaction_status.in_(filters["statuses"]))
+    if filters["date_from"] is not None:
+        query = query.where(Transactions.transaction_date >= filters["date_from"])
+    if filters["date_to"] is not None:
+        query = query.where(Transactions.transaction_date < filters["date_to"])
+
+    key = tuple_(Transactions.transaction_date, Transactions.id)
+    if filters["cursor"] is not None:
+        after = tuple_(*decode_cursor(filters["cursor"]))
+        query = query.where(key < after if filters["order"] == 'desc' else key > after)
+
+    if filters["order"] == 'desc':
+        return query.order_by(Transactions.transaction_date.desc(), Transactions.id.desc())
+    return query.order_by(Transactions.transaction_date, Transactions.id)
+
+
+def _item(row) -> dict:
+    return {
+        "operation_id": str(row.transaction_id),
+        "type": row.transaction_type,
+        "status": row.transaction_status,
+        "amount": row.amount,
+        "description": row.description,
+        "transaction_date": row.transaction_date.isoformat(),
+        "original_operation_id": str(row.original_transaction_id) if row.original_transaction_id else None
+    }
+
+
+def get_history_page(db: Session, account_id: int, filters: dict) -> dict:
+    '''
+    Страница истории операций счета.
+
+    Выходные данные:
+
+    ```
+    {
+        "items": [
+            {
+                "operation_id": "XXXXXXXX-XXXX-XXXX-XXXX-XXXXXXXXXXXX",
+                "type": "HOLD",
+                "status": "COMPLETED",
+                "amount": 100.00,
+                "description": "Оплата заказа",
+                "transaction_date": "2026-10-18T12:00:00.000000",
+                "original_operation_id": null
+            }
+        ],
+        "next_cursor": "MjAyNi0xMC0xOFQxMjowMDowMHwxMjM"
+    }
+    ```
+
+    `next_cursor` - значение параметра `cursor` для следующей страницы или null, если страница последняя.
+    '''
+    limit = filters["limit"]
+    rows = db.execute(history_query(account_id, filters).limit(limit + 1)).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].transaction_date, rows[-1].id)
+
+    return {"items": [_item(row) for row in rows], "next_cursor": next_cursor}
+
+
+def stream_history(account_id: int, filters: dict):
+    '''
+    Генератор строк NDJSON с операциями счета. Запрос строится сразу, поэтому ошибка
+    в параметрах (например, в курсоре) выбрасывается до начала ответа.
+
+    Выгрузка выполняется в отдельной сессии на реплике, если она есть (см. replicas.py):
+    сессия запроса Flask закрывается до того, как сервер начинает отправлять тело ответа.
+    Соединение возвращается в пул по окончании выгрузки или при разрыве соединения клиентом.
+    Ошибка реплики во время выгрузки прерывает ответ без перехода на основной сервер.
+    '''
+    query = history_query(account_id, filters)
+    if filters["limit"] is not None:
+        query = query.limit(filters["limit"])
+    query = query.execution_options(yield_per=app_settings.history_stream_chunk_size)
+    bind = pick_read_engine()
+
+    def generate():
+        db = session(bind=bind) if bind is not None else session()
+        try:
+            for row in db.execute(query):
+                yield json.dumps(_item(row), ensure_ascii=False, default=json_default) + '\n'
+        finally:
+            db.close()
+
+    return generate()
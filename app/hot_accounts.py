@@ -0,0 +1,405 @@
+'''
+"Горячие" счета: удерживаемый баланс в нескольких строках-слотах.
+
+Удержание обычного счета увеличивает `held_balance` в строке счета, поэтому все удержания одного
+счета выполняются по очереди на блокировке этой строки. У счета с `accounts.hold_slots` = N > 0
+часть доступного баланса заранее передана N слотам (таблица account_slots, см.
+database/account_slots.py), и удержание изменяет строку только одного случайно выбранного слота:
+1. условный UPDATE увеличивает `held` слота, только если свободного остатка слота хватает;
+   номер слота записывается в удержание (`transactions.hold_slot`);
+2. отмена такого удержания уменьшает `held` того же слота, списание переносит сумму из `held`
+   в `charged`. Строка счета при этом не блокируется;
+3. если свободного остатка слота не хватает, выполняется перераспределение (`rebalance()`):
+   строка счета и все его слоты блокируются, списания из `charged` переносятся в баланс счета,
+   а доступный баланс заново делится поровну между слотами и самим счетом. Доля счета остается
+   для операций без слотов (пакетное удержание). Слот, которому не хватило, получает сумму
+   удержания сверх своей доли; если не хватает всего доступного баланса, удержание получает
+   обычную ошибку о недостатке средств.
+
+Переданная слоту сумма учтена в `accounts.held_balance`, поэтому проверка доступного баланса
+по строке счета остается верной (хотя и более строгой) и для операций без слотов. Значения
+счета для ответов, журнала и проекции балансов вычисляются с учетом слотов (`BALANCE`, `HELD_BALANCE`):
+- баланс = `balance` - сумма `charged` слотов;
+- удерживаемый баланс = `held_balance` - сумма (`reserved` - `held`) слотов.
+
+Перераспределение также выполняется для всех горячих счетов в каждом проходе `python run.py sweep`
+(`rebalance_accounts()`), чтобы списания не копились в слотах. Режим включается и выключается
+командой `python run.py hot-account <account_number> --slots N` (`--slots 0` - выключить);
+слоты с действующими удержаниями остаются до их завершения.
+
+Порядок блокировок тот же, что и в остальных операциях: удержание, затем счет, затем слоты счета
+в порядке номеров. Строка счета перед слотами блокируется `FOR NO KEY UPDATE`, а не `FOR UPDATE`:
+удержание через слот вставляет транзакцию уже после блокировки слота, и проверка внешнего ключа
+этой вставки (`FOR KEY SHARE` строки счета) не должна ждать перераспределения, которое само
+ждет этот слот.
+
+Слоты с отрицательными номерами принадлежат книгам резервирований процессов сервера
+(см. reservation_book.py): их свободный остаток учитывается в памяти процесса-владельца, поэтому
+перераспределение никогда его не уменьшает - такие слоты только переносят списания в баланс счета
+и получают сумму, запрошенную книгой (`fund_book()`).
+'''
+import logging
+import random
+from decimal import Decimal, ROUND_DOWN
+from sqlalchemy import select, update, delete, insert, func, tuple_, values, column, Integer, SMALLINT, DECIMAL
+from sqlalchemy.orm import Session
+from app.account_cache import invalidate_account
+from app.database import Accounts, AccountSlots
+from app.db_session import session, after_commit
+
+logger = logging.getLogger(__name__)
+
+
+def _slots_sum(expression):
+    return func.coalesce(
+        select(func.sum(expression))
+        .where(AccountSlots.account_id == Accounts.id)
+        .correlate(Accounts)
+        .scalar_subquery(),
+        0
+    )
+
+
+'''
+Поправки к значениям строки счета и сами значения с учетом слотов - для SELECT и RETURNING
+по таблице accounts. У счета без слотов поправки равны нулю.
+'''
+BALANCE_ADJUSTMENT = _slots_sum(AccountSlots.charged)
+HELD_BALANCE_ADJUSTMENT = _slots_sum(AccountSlots.reserved - AccountSlots.held)
+BALANCE = (Accounts.balance - BALANCE_ADJUSTMENT).label('balance')
+HELD_BALANCE = (Accounts.held_balance - HELD_BALANCE_ADJUSTMENT).label('held_balance')
+
+
+def account_balances(db: Session, account_id: int):
+    '''
+    Выходные данные - строка `(account_number, currency, balance, held_balance)` счета с учетом слотов или None.
+    '''
+    return db.execute(
+        select(Accounts.account_number, Accounts.currency, BALANCE, HELD_BALANCE)
+        .where(Accounts.id == account_id)
+    ).first()
+
+
+def _take(db: Session, account_id: int, slot: int, amount: Decimal) -> bool:
+    return db.execute(
+        update(AccountSlots)
+        .where(
+            AccountSlots.account_id == account_id,
+            AccountSlots.slot == slot,
+            AccountSlots.reserved - AccountSlots.held - AccountSlots.charged >= amount
+        )
+        .values(held=AccountSlots.held + amount)
+        .returning(AccountSlots.id)
+        .execution_options(synchronize_session=False)
+    ).first() is not None
+
+
+def hold_on_slot(db: Session, account_id: int, slots: int, amount: Decimal):
+    '''
+    Удержание `amount` через случайный слот счета в транзакции `db` без ее фиксации.
+
+    Выходные данные - номер слота или None, если режим слотов для счета выключен
+    (удержание нужно выполнить по строке счета).
+
+    Ошибки:
+    - `ValueError` - недостаточно средств.
+    '''
+    slot = random.randrange(slots)
+
+    '''
+    UPDATE, который дождался фиксации параллельного изменения слота и по новой версии строки
+    не выполнил условие, оставляет строку слота заблокированной до конца транзакции. Перед
+    перераспределением (счет, затем все слоты) эта блокировка снимается откатом к точке сохранения.
+    '''
+    savepoint = db.begin_nested()
+    if _take(db, account_id, slot, amount):
+        savepoint.commit()
+        return slot
+    savepoint.rollback()
+
+    if not rebalance(db, account_id, slot, amount):
+        return None
+    return slot if _take(db, account_id, slot, amount) else None
+
+
+def release_slot(db: Session, account_id: int, slot: int, amount: Decimal, charge: bool):
+    '''
+    Завершение удержания `amount`, выполненного через слот `slot`, в транзакции `db` без ее фиксации:
+    списание (`charge=True`) или отмена.
+
+    Выходные данные - строка счета с учетом слотов (см. account_balances()) или None,
+    если удерживаемых средств слота недостаточно.
+    '''
+    changes = {"held": AccountSlots.held - amount}
+    if charge:
+        changes["charged"] = AccountSlots.charged + amount
+    released = db.execute(
+        update(AccountSlots)
+        .where(
+            AccountSlots.account_id == account_id,
+            AccountSlots.slot == slot,
+            AccountSlots.held >= amount
+        )
+        .values(**changes)
+        .returning(AccountSlots.id)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if released is None:
+        return None
+    return account_balances(db, account_id)
+
+
+def lock_slots(db: Session, keys) -> dict:
+    '''
+    Блокировка слотов `keys` - пар `(account_id, slot)` - в порядке счетов и номеров слотов.
+
+    Выходные данные - словарь `(account_id, slot)` -> удерживаемая через слот сумма.
+    '''
+    if not keys:
+        return {}
+    return {
+        (row.account_id, row.slot): row.held
+        for row in db.execute(
+            select(AccountSlots.account_id, AccountSlots.slot, AccountSlots.held)
+            .where(tuple_(AccountSlots.account_id, AccountSlots.slot).in_(list(keys)))
+            .order_by(AccountSlots.account_id, AccountSlots.slot)
+            .with_for_update()
+        )
+    }
+
+
+def release_slots(db: Session, amounts: dict, charge: bool):
+    '''
+    Завершение удержаний, выполненных через слоты, одним UPDATE ... FROM (VALUES ...)
+    в транзакции `db` без ее фиксации. `amounts` - словарь `(account_id, slot)` -> сумма;
+    слоты должны быть заблокированы (см. lock_slots()).
+
+    Отмена и освобождение уменьшают только `held` слота. Списание (`charge=True`) уменьшает
+    также `reserved`: сумма уходит со счета сразу, поэтому вызывающая сторона уменьшает
+    баланс и удерживаемый баланс строки счета на ту же сумму.
+    '''
+    if not amounts:
+        return
+    released = values(
+        column('account_id', Integer), column('slot', SMALLINT), column('amount', DECIMAL(15, 2)), name='released'
+    ).data(sorted((account_id, slot, amount) for (account_id, slot), amount in amounts.items()))
+    changes = {"held": AccountSlots.held - released.c.amount}
+    if charge:
+        changes["reserved"] = AccountSlots.reserved - released.c.amount
+    db.execute(
+        update(AccountSlots)
+        .where(AccountSlots.account_id == released.c.account_id, AccountSlots.slot == released.c.slot)
+        .values(**changes)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _redistribute(db: Session, account_id: int, slot: int, amount: Decimal, distribute: bool, consumed: Decimal = Decimal('0.00')) -> bool:
+    account = db.execute(
+        select(Accounts.account_number, Accounts.balance, Accounts.held_balance, Accounts.hold_slots)
+        .where(Accounts.id == account_id)
+        .with_for_update(key_share=True)
+    ).first()
+    if account is None:
+        return False
+    slots = db.execute(
+        select(AccountSlots.id, AccountSlots.slot, AccountSlots.reserved, AccountSlots.held, AccountSlots.charged)
+        .where(AccountSlots.account_id == account_id)
+        .order_by(AccountSlots.slot)
+        .with_for_update()
+    ).all()
+
+    book = slot is not None and slot < 0
+    active = [row.slot for row in slots if 0 <= row.slot < account.hold_slots] if distribute else []
+    if book:
+        enabled = distribute and account.hold_slots > 0 and any(row.slot == slot for row in slots)
+    else:
+        enabled = slot in active if slot is not None else bool(active)
+    if not enabled:
+        active, amount, consumed = [], Decimal('0.00'), Decimal('0.00')
+    funded = slot if enabled and book else None
+    targets = active + [funded] if funded is not None else active
+
+    '''
+    Значения счета с учетом слотов не меняются: меняется только то, какая их часть лежит в строке счета.
+    Свободные остатки слотов книг резервирований остаются у них и в распределении не участвуют.
+    У пополняемой книги остается только `consumed` - сумма ее операций, еще не записанных в базу данных.
+    '''
+    balance = account.balance - sum((row.charged for row in slots), Decimal('0.00'))
+    held_balance = account.held_balance - sum((row.reserved - row.held for row in slots), Decimal('0.00'))
+    kept = {
+        row.slot: consumed if row.slot == funded else row.reserved - row.held - row.charged
+        for row in slots if row.slot < 0
+    }
+    available = balance - held_balance - sum(kept.values(), Decimal('0.00'))
+    if amount > available:
+        raise ValueError(f"Недостаточно средств на счету {account.account_number}. Доступно: {available}, запрошено: {amount}.")
+
+    share = Decimal('0.00')
+    if targets:
+        share = ((available - amount) / (len(targets) + 1)).quantize(Decimal('0.01'), rounding=ROUND_DOWN)
+    reserved = {
+        row.slot: row.held + kept.get(row.slot, Decimal('0.00'))
+        + (share if row.slot in targets else Decimal('0.00'))
+        + (amount if row.slot == slot else Decimal('0.00'))
+        for row in slots
+    }
+
+    if slots:
+        db.execute(update(AccountSlots), [
+            {"id": row.id, "reserved": reserved[row.slot], "charged": Decimal('0.00')} for row in slots
+        ])
+    db.execute(
+        update(Accounts)
+        .where(Accounts.id == account_id)
+        .values(
+            balance=balance,
+            held_balance=held_balance + sum((reserved[row.slot] - row.held for row in slots), Decimal('0.00'))
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+    '''
+    Слоты сверх `hold_slots` без удержаний больше не нужны.
+    '''
+    unused = [row.id for row in slots if row.slot >= account.hold_slots and row.held == 0]
+    if unused:
+        db.execute(delete(AccountSlots).where(AccountSlots.id.in_(unused)))
+    return enabled
+
+
+def rebalance(db: Session, account_id: int, slot: int = None, amount: Decimal = Decimal('0.00')) -> bool:
+    '''
+    Перераспределение доступного баланса счета между слотами в транзакции `db` без ее фиксации.
+    Слоту `slot` сверх его доли передается `amount`.
+
+    Выходные данные - False, если режим слотов для счета выключен или слота `slot` у счета нет.
+
+    Ошибки:
+    - `ValueError` - доступного баланса меньше `amount`.
+    '''
+    return _redistribute(db, account_id, slot, amount, True)
+
+
+def fund_book(db: Session, account_id: int, slot: int, amount: Decimal, consumed: Decimal) -> bool:
+    '''
+    Пополнение слота `slot` книги резервирований (см. reservation_book.py) в транзакции `db` без ее
+    фиксации. `consumed` - сумма удержаний книги, еще не записанных в базу данных; остальной свободный
+    остаток слота возвращается в распределение, и слот получает `consumed`, `amount` и долю доступного
+    баланса наравне с обычными слотами.
+
+    Выходные данные - False, если режим слотов для счета выключен или слота у счета нет.
+
+    Ошибки:
+    - `ValueError` - доступного баланса меньше `amount`.
+    '''
+    return _redistribute(db, account_id, slot, amount, True, consumed=consumed)
+
+
+def release_book(db: Session, account_id: int, slot: int):
+    '''
+    Возврат свободного остатка слота `slot` книги резервирований в строку счета в транзакции `db`
+    без ее фиксации - при остановке книги.
+    '''
+    db.execute(select(Accounts.id).where(Accounts.id == account_id).with_for_update(key_share=True))
+    row = db.execute(
+        select(AccountSlots.id, AccountSlots.reserved, AccountSlots.held, AccountSlots.charged)
+        .where(AccountSlots.account_id == account_id, AccountSlots.slot == slot)
+        .with_for_update()
+    ).first()
+    if row is None:
+        return
+    free = row.reserved - row.held - row.charged
+    if free == 0:
+        return
+    db.execute(
+        update(AccountSlots)
+        .where(AccountSlots.id == row.id)
+        .values(reserved=AccountSlots.reserved - free)
+        .execution_options(synchronize_session=False)
+    )
+    db.execute(
+        update(Accounts)
+        .where(Accounts.id == account_id)
+        .values(held_balance=Accounts.held_balance - free)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def collapse(db: Session, account_id: int):
+    '''
+    Возврат свободных остатков (кроме слотов книг резервирований) и списаний всех слотов счета
+    в строку счета в транзакции `db` без ее фиксации - для операций, которые проверяют доступный
+    баланс по строке счета (пакетное удержание). Следующее удержание через слот заново распределит баланс.
+    '''
+    _redistribute(db, account_id, None, Decimal('0.00'), False)
+
+
+def set_hold_slots(db: Session, account_number: str, slots: int) -> int:
+    '''
+    Включение режима слотов (`slots` > 0), изменение количества слотов или выключение (`slots` = 0)
+    для счета `account_number` в транзакции `db` без ее фиксации.
+
+    Выходные данные - внутренний id счета.
+
+    Ошибки:
+    - `ValueError` - счет не найден.
+    '''
+    account_id = db.execute(
+        update(Accounts)
+        .where(Accounts.account_number == account_number)
+        .values(hold_slots=slots)
+        .returning(Accounts.id)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+    if account_id is None:
+        raise ValueError(f"Счет с номером '{account_number}' не найден.")
+
+    existing = set(db.scalars(select(AccountSlots.slot).where(AccountSlots.account_id == account_id)))
+    missing = [slot for slot in range(slots) if slot not in existing]
+    if missing:
+        db.execute(insert(AccountSlots), [
+            {"account_id": account_id, "slot": slot, "reserved": 0, "held": 0, "charged": 0}
+            for slot in missing
+        ])
+    rebalance(db, account_id)
+    after_commit(db, invalidate_account, account_number)
+    return account_id
+
+
+def slot_stats(db: Session, account_id: int) -> list:
+    return [
+        {"slot": row.slot, "reserved": row.reserved, "held": row.held, "charged": row.charged}
+        for row in db.execute(
+            select(AccountSlots.slot, AccountSlots.reserved, AccountSlots.held, AccountSlots.charged)
+            .where(AccountSlots.account_id == account_id)
+            .order_by(AccountSlots.slot)
+        )
+    ]
+
+
+def rebalance_accounts() -> int:
+    '''
+    Перераспределение слотов всех счетов, у которых они есть, - по одной транзакции на счет.
+
+    Выходные данные - количество обработанных счетов.
+    '''
+    db = session()
+    try:
+        account_ids = db.scalars(select(AccountSlots.account_id).distinct().order_by(AccountSlots.account_id)).all()
+    finally:
+        db.close()
+
+    for account_id in account_ids:
+        db = session()
+        try:
+            rebalance(db, account_id)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+    if account_ids:
+        logger.info("Перераспределены слоты %d счетов.", len(account_ids))
+    return len(account_ids)
@@ -0,0 +1,177 @@
+'''
+Кэш идемпотентности операций.
+
+Платежные шлюзы повторяют запросы с тем же operation_id. Чтобы повтор не требовал
+обращения к базе данных, после завершения операции в кэш записывается ответ, который
+сервис вернул бы на повторный запрос (сообщение вида "уже списаны"). Ключ кэша -
+пара (operation_id, действие), значение хранится ограниченное время (IDEMPOTENCY_TTL).
+
+Хранилище выбирается автоматически: Redis, если задан REDIS_URL, иначе память процесса.
+Ошибки Redis не прерывают запрос - в этом случае кэш считается пустым, и операция
+обрабатывается через базу данных.
+
+Методы `get_async()`, `store_async()` и `forget_async()` - то же для ASGI-приложения
+(см. async_services.py): с Redis они обращаются к нему клиентом redis.asyncio и не блокируют
+цикл событий.
+
+Хранилище в памяти у каждого процесса свое. При нескольких процессах сервера
+(`python run.py serve`, см. server.py) без Redis повтор, попавший в другой процесс, не найдет
+ответ в кэше и будет обработан через базу данных. Кроме того, `forget()` после списания или
+отмены удаляет ответ на повтор удержания только в своем процессе, и другой процесс до истечения
+IDEMPOTENCY_TTL может ответить на повтор удержания, что оно еще активно. Поэтому при нескольких
+процессах нужен Redis.
+'''
+import json
+import logging
+import uuid
+from decimal import Decimal
+from app.cache import LRUCache
+from app.redis_client import get_redis, get_async_redis
+from app import metrics
+from app.settings import app_settings
+
+logger = logging.getLogger(__name__)
+
+
+def _encode(o):
+    if isinstance(o, Decimal):
+        return float(o)
+    if isinstance(o, uuid.UUID):
+        return str(o)
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+class MemoryIdempotencyBackend:
+    '''
+    Хранилище в памяти процесса (только для этого процесса, см. описание модуля). Используется
+    по умолчанию и в проверках.
+
+    Количество записей ограничено `max_size`: при переполнении вытесняются давно не использованные
+    записи, и повтор такой операции обрабатывается через базу данных.
+    '''
+
+    def __init__(self, max_size: int):
+        self._items = LRUCache(max_size, 0)
+
+    def get(self, key: str):
+        value = self._items.get(key)
+        return dict(value) if value is not None else None
+
+    def set(self, key: str, value: dict, ttl: int):
+        self._items.set(key, dict(value), ttl)
+
+    def delete(self, key: str):
+        self._items.delete(key)
+
+    def clear(self):
+        self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+    async def get_async(self, key: str):
+        return self.get(key)
+
+    async def set_async(self, key: str, value: dict, ttl: int):
+        self.set(key, value, ttl)
+
+    async def delete_async(self, key: str):
+        self.delete(key)
+
+
+class RedisIdempotencyBackend:
+    '''
+    Хранилище в Redis - общее для всех процессов сервиса.
+    '''
+
+    def __init__(self, client, async_client=get_async_redis):
+        self._client = client
+        self._async_client = async_client
+
+    def get(self, key: str):
+        raw = self._client.get(key)
+        if raw is None:
+            return None
+        return json.loads(raw, parse_float=Decimal)
+
+    def set(self, key: str, value: dict, ttl: int):
+        self._client.set(key, json.dumps(value, default=_encode), ex=ttl)
+
+    def delete(self, key: str):
+        self._client.delete(key)
+
+    async def get_async(self, key: str):
+        raw = await self._async_client().get(key)
+        if raw is None:
+            return None
+        return json.loads(raw, parse_float=Decimal)
+
+    async def set_async(self, key: str, value: dict, ttl: int):
+        await self._async_client().set(key, json.dumps(value, default=_encode), ex=ttl)
+
+    async def delete_async(self, key: str):
+        await self._async_client().delete(key)
+
+
+class IdempotencyCache:
+    '''
+    Кэш ответов на повторные запросы, ключ - (operation_id, действие).
+    '''
+
+    def __init__(self, backend, ttl: int, prefix: str = 'idempotency'):
+        self.backend = backend
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _key(self, operation_id: str, action: str) -> str:
+        return f"{self.prefix}:{action}:{str(operation_id).lower()}"
+
+    def get(self, operation_id: str, action: str):
+        try:
+            with metrics.stage('idempotency_check'):
+                return self.backend.get(self._key(operation_id, action))
+        except Exception:
+            logger.warning("Кэш идемпотентности недоступен при чтении.", exc_info=True)
+            return None
+
+    def store(self, operation_id: str, action: str, result: dict):
+        try:
+            self.backend.set(self._key(operation_id, action), result, self.ttl)
+        except Exception:
+            logger.warning("Кэш идемпотентности недоступен при записи.", exc_info=True)
+
+    def forget(self, operation_id: str, action: str):
+        try:
+            self.backend.delete(self._key(operation_id, action))
+        except Exception:
+            logger.warning("Кэш идемпотентности недоступен при удалении.", exc_info=True)
+
+    async def get_async(self, operation_id: str, action: str):
+        try:
+            with metrics.stage('idempotency_check'):
+                return await self.backend.get_async(self._key(operation_id, action))
+        except Exception:
+            logger.warning("Кэш идемпотентности недоступен при чтении.", exc_info=True)
+            return None
+
+    async def store_async(self, operation_id: str, action: str, result: dict):
+        try:
+            await self.backend.set_async(self._key(operation_id, action), result, self.ttl)
+        except Exception:
+            logger.warning("Кэш идемпотентности недоступен при записи.", exc_info=True)
+
+    async def forget_async(self, operation_id: str, action: str):
+        try:
+            await self.backend.delete_async(self._key(operation_id, action))
+        except Exception:
+            logger.warning("Кэш идемпотентности недоступен при удалении.", exc_info=True)
+
+
+def _default_backend():
+    client = get_redis()
+    if client is None:
+        return MemoryIdempotencyBackend(app_settings.idempotency_memory_size)
+    return RedisIdempotencyBackend(client)
+
+
+idempotency_cache = IdempotencyCache(_default_backend(), app_settings.idempotency_ttl)
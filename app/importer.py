@@ -0,0 +1,380 @@
+'''
+Массовая загрузка клиентов, счетов и карт из CSV и Parquet (`python run.py import`).
+
+Файлы загружаются в порядке клиенты -> счета -> карты и читаются частями по `IMPORT_CHUNK_SIZE`
+строк, поэтому расход памяти не зависит от размера файла. Каждая часть:
+1. проверяется построчно (см. `_client()`, `_account()`, `_card()`); строка с ошибкой
+   не загружается и попадает в отчет;
+2. ссылки строк части разрешаются одним запросом в словарь в памяти: счет ссылается на клиента
+   по `client_external_id` (столбец `clients.external_id`), карта - на счет по `account_number`.
+   Ссылаться можно и на записи, созданные раньше, не только в этой загрузке;
+3. загружается одной транзакцией: `COPY` во временную таблицу и
+   `INSERT ... SELECT ... ON CONFLICT DO NOTHING RETURNING` в основную (по умолчанию) или
+   пакетный INSERT (`--method insert`, например, если соединение идет через пул, не поддерживающий COPY).
+   Строки, ключ которых (`external_id`, `account_number`, `card_number`) уже существует, пропускаются;
+4. для новых счетов создаются записи OPENING журнала изменений с начальным балансом (см. ledger.py).
+
+Поскольку существующие записи пропускаются, прерванную загрузку можно просто запустить повторно.
+
+Столбцы файлов (обязательные отмечены *):
+- клиенты: `external_id`*, `first_name`*, `last_name`*, `middle_name`, `date_of_birth`* (ГГГГ-ММ-ДД),
+  `address`*, `phone_number`*;
+- счета: `client_external_id`*, `account_number`* (UUID), `account_type`*, `balance` (по умолчанию 0),
+  `currency`* (три буквы, например KZT);
+- карты: `account_number`*, `card_number`* (12-19 цифр), `expiry_date`* (ГГГГ-ММ-ДД или ММ/ГГ),
+  `cvc`* (3-4 цифры), `cardholder_name`*, `issue_date`* (ГГГГ-ММ-ДД), `card_status` (по умолчанию active).
+
+Файлы с расширением `.parquet` читаются через pyarrow, который не входит в зависимости сервиса
+и устанавливается отдельно (`pip install pyarrow`).
+
+Отчет - CSV со строками `file,line,status,message`, где `status` - `failed` (ошибка в строке)
+или `skipped` (запись уже существует). `line` - номер строки файла CSV с учетом заголовка
+или номер записи файла Parquet начиная с 1.
+'''
+import calendar
+import csv
+import logging
+import re
+import time
+from datetime import date
+from sqlalchemy import select, text, any_, bindparam
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.database import Clients, Accounts, Cards
+from app.db_session import session
+from app.ledger import open_accounts
+from app.money import to_money
+from app.schemas import UUID_PATTERN
+from app.settings import app_settings
+
+logger = logging.getLogger(__name__)
+
+_DIGITS = re.compile(r'^[0-9]+$')
+_PHONE = re.compile(r'^\+?[0-9 ()-]+$')
+_CURRENCY = re.compile(r'^[A-Z]{3}$')
+_EXPIRY = re.compile(r'^(0[1-9]|1[0-2])/([0-9]{2})$')
+
+
+def _text(row: dict, name: str, required: bool = True, max_length: int = None):
+    value = row.get(name)
+    value = '' if value is None else str(value).strip()
+    if not value:
+        if required:
+            raise ValueError(f'Поле "{name}" обязательно.')
+        return None
+    if max_length is not None and len(value) > max_length:
+        raise ValueError(f'Поле "{name}" длиннее {max_length} символов.')
+    return value
+
+
+def _date(row: dict, name: str, required: bool = True):
+    value = row.get(name)
+    if isinstance(value, date):
+        return value
+    value = _text(row, name, required)
+    if value is None:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'Поле "{name}" должно быть датой в формате ГГГГ-ММ-ДД, получено "{value}".')
+
+
+def _uuid(row: dict, name: str) -> str:
+    value = _text(row, name)
+    if not UUID_PATTERN.match(value):
+        raise ValueError(f'Поле "{name}" должно быть UUID, получено "{value}".')
+    return value.lower()
+
+
+def _client(row: dict) -> tuple:
+    date_of_birth = _date(row, 'date_of_birth')
+    if date_of_birth > date.today():
+        raise ValueError(f"Дата рождения {date_of_birth} в будущем.")
+    phone_number = _text(row, 'phone_number', max_length=20)
+    if not _PHONE.match(phone_number):
+        raise ValueError(f"Некорректный номер телефона '{phone_number}'.")
+    return {
+        "external_id": _text(row, 'external_id', max_length=64),
+        "first_name": _text(row, 'first_name', max_length=64),
+        "last_name": _text(row, 'last_name', max_length=64),
+        "middle_name": _text(row, 'middle_name', required=False, max_length=64),
+        "date_of_birth": date_of_birth,
+        "address": _text(row, 'address'),
+        "phone_number": phone_number
+    }, None
+
+
+def _account(row: dict) -> tuple:
+    balance = _text(row, 'balance', required=False)
+    balance = to_money(balance if balance is not None else 0)
+    if balance < 0:
+        raise ValueError(f"Баланс счета не может быть отрицательным: {balance}.")
+    currency = _text(row, 'currency').upper()
+    if not _CURRENCY.match(currency):
+        raise ValueError(f"Некорректный код валюты '{currency}'.")
+    return {
+        "account_number": _uuid(row, 'account_number'),
+        "account_type": _text(row, 'account_type', max_length=64),
+        "balance": balance,
+        "currency": currency,
+        "held_balance": to_money(0)
+    }, _text(row, 'client_external_id', max_length=64)
+
+
+def _card(row: dict) -> tuple:
+    card_number = _text(row, 'card_number').replace(' ', '')
+    if not _DIGITS.match(card_number) or not 12 <= len(card_number) <= 19:
+        raise ValueError("Номер карты должен состоять из 12-19 цифр.")
+    cvc = _text(row, 'cvc')
+    if not _DIGITS.match(cvc) or len(cvc) not in (3, 4):
+        raise ValueError('Поле "cvc" должно состоять из 3-4 цифр.')
+
+    expiry = row.get('expiry_date')
+    match = _EXPIRY.match(expiry.strip()) if isinstance(expiry, str) else None
+    if match:
+        '''
+        Срок действия ММ/ГГ - последний день месяца.
+        '''
+        year, month = 2000 + int(match.group(2)), int(match.group(1))
+        expiry_date = date(year, month, calendar.monthrange(year, month)[1])
+    else:
+        expiry_date = _date(row, 'expiry_date')
+    issue_date = _date(row, 'issue_date')
+    if issue_date > expiry_date:
+        raise ValueError(f"Дата выпуска карты {issue_date} позже срока действия {expiry_date}.")
+
+    return {
+        "card_number": card_number,
+        "expiry_date": expiry_date,
+        "cvc": cvc,
+        "cardholder_name": _text(row, 'cardholder_name', max_length=128),
+        "issue_date": issue_date,
+        "card_status": _text(row, 'card_status', required=False, max_length=32) or 'active'
+    }, _uuid(row, 'account_number')
+
+
+class Entity:
+    '''
+    Описание загружаемой таблицы: функция проверки строки, уникальный ключ, по которому
+    обнаруживаются уже существующие записи, и ссылка на родительскую таблицу
+    (ключ и id родителя, столбец внешнего ключа, сообщение об отсутствующем родителе).
+    '''
+
+    def __init__(self, name: str, model, key: str, columns: tuple, parse, required: tuple, reference: tuple = None):
+        self.name = name
+        self.model = model
+        self.key = key
+        self.columns = columns
+        self.parse = parse
+        self.required = required
+        self.reference = reference
+
+
+CLIENTS = Entity(
+    'clients', Clients, 'external_id',
+    ('external_id', 'first_name', 'last_name', 'middle_name', 'date_of_birth', 'address', 'phone_number'),
+    _client, ('external_id', 'first_name', 'last_name', 'date_of_birth', 'address', 'phone_number')
+)
+ACCOUNTS = Entity(
+    'accounts', Accounts, 'account_number',
+    ('client_id', 'account_number', 'account_type', 'balance', 'currency', 'held_balance'),
+    _account, ('client_external_id', 'account_number', 'account_type', 'currency'),
+    (Clients.external_id, Clients.id, 'client_id', "Клиент с external_id '{}' не найден.")
+)
+CARDS = Entity(
+    'cards', Cards, 'card_number',
+    ('account_id', 'card_number', 'expiry_date', 'cvc', 'cardholder_name', 'issue_date', 'card_status'),
+    _card, ('account_number', 'card_number', 'expiry_date', 'cvc', 'cardholder_name', 'issue_date'),
+    (Accounts.account_number, Accounts.id, 'account_id', "Счет с номером '{}' не найден.")
+)
+
+
+def read_chunks(path: str, required: tuple, chunk_size: int):
+    '''
+    Чтение файла частями по `chunk_size` строк. Каждая часть - список `(line, row)`,
+    где `row` - словарь значений по именам столбцов.
+
+    Ошибки:
+    - `ValueError` - в файле нет обязательных столбцов или нет pyarrow для файла Parquet.
+    '''
+    if path.endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ValueError("Для чтения файлов Parquet требуется пакет pyarrow.")
+        file = pq.ParquetFile(path)
+        missing = [name for name in required if name not in file.schema_arrow.names]
+        if missing:
+            raise ValueError(f"В файле {path} нет столбцов: {', '.join(missing)}.")
+        line = 1
+        for batch in file.iter_batches(batch_size=chunk_size):
+            rows = batch.to_pylist()
+            yield list(enumerate(rows, start=line))
+            line += len(rows)
+        return
+
+    with open(path, newline='', encoding='utf-8-sig') as file:
+        reader = csv.DictReader(file)
+        missing = [name for name in required if name not in (reader.fieldnames or ())]
+        if missing:
+            raise ValueError(f"В файле {path} нет столбцов: {', '.join(missing)}.")
+        chunk = []
+        for row in reader:
+            chunk.append((reader.line_num, row))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+class ImportReport:
+    '''
+    Итоги загрузки по таблицам и построчный отчет в CSV-файл `output` (если задан).
+    '''
+
+    def __init__(self, output=None):
+        self.writer = csv.writer(output) if output is not None else None
+        if self.writer is not None:
+            self.writer.writerow(('file', 'line', 'status', 'message'))
+        self.totals = {}
+        self.examples = []
+
+    def _total(self, entity: Entity) -> dict:
+        return self.totals.setdefault(entity.name, {"inserted": 0, "skipped": 0, "failed": 0})
+
+    def inserted(self, entity: Entity, count: int):
+        self._total(entity)["inserted"] += count
+
+    def row(self, entity: Entity, path: str, line: int, status: str, message: str):
+        self._total(entity)[status] += 1
+        if self.writer is not None:
+            self.writer.writerow((path, line, status, message))
+        if status == 'failed' and len(self.examples) < 20:
+            self.examples.append(f"{path}:{line}: {message}")
+
+
+def _copy(db, entity: Entity, rows: list) -> list:
+    '''
+    Загрузка через COPY во временную таблицу, удаляемую при фиксации.
+    '''
+    table = entity.model.__tablename__
+    staging = f'import_{table}'
+    columns = ', '.join(entity.columns)
+    db.execute(text(
+        f'CREATE TEMP TABLE {staging} ON COMMIT DROP AS SELECT 0 AS line, {columns} FROM {table} WITH NO DATA'
+    ))
+    cursor = db.connection().connection.driver_connection.cursor()
+    with cursor.copy(f'COPY {staging} (line, {columns}) FROM STDIN') as copy:
+        for line, values in rows:
+            copy.write_row((line, *(values[column] for column in entity.columns)))
+    return db.execute(text(
+        f'INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging} ORDER BY line '
+        f'ON CONFLICT DO NOTHING RETURNING id, {entity.key}'
+    )).all()
+
+
+def _insert(db, entity: Entity, rows: list) -> list:
+    '''
+    Загрузка пакетным INSERT (executemany).
+    '''
+    key = getattr(entity.model, entity.key)
+    return db.execute(
+        pg_insert(entity.model).on_conflict_do_nothing().returning(entity.model.id, key),
+        [values for _, values in rows]
+    ).all()
+
+
+def load_chunk(entity: Entity, path: str, chunk: list, report: ImportReport, method: str = 'copy'):
+    '''
+    Проверка, разрешение ссылок и загрузка одной части файла в отдельной транзакции.
+    '''
+    parsed = []
+    for line, row in chunk:
+        try:
+            values, reference = entity.parse(row)
+        except (ValueError, ArithmeticError) as e:
+            '''
+            ArithmeticError - ошибки decimal при разборе сумм: строка с такой ошибкой попадает
+            в отчет, а не прерывает загрузку.
+            '''
+            report.row(entity, path, line, 'failed', str(e) or f"Некорректное числовое значение ({type(e).__name__}).")
+            continue
+        parsed.append((line, values, reference))
+
+    db = session()
+    try:
+        rows = []
+        if entity.reference is None:
+            rows = [(line, values) for line, values, _ in parsed]
+        else:
+            parent_key, parent_id, foreign_key, missing = entity.reference
+            references = {reference for _, _, reference in parsed}
+            parents = dict(db.execute(
+                select(parent_key, parent_id).where(parent_key == any_(bindparam('references', list(references), type_=ARRAY(parent_key.type))))
+            ).all()) if references else {}
+            parents = {str(key): value for key, value in parents.items()}
+            for line, values, reference in parsed:
+                parent = parents.get(reference)
+                if parent is None:
+                    report.row(entity, path, line, 'failed', missing.format(reference))
+                    continue
+                values[foreign_key] = parent
+                rows.append((line, values))
+
+        inserted = (_copy if method == 'copy' else _insert)(db, entity, rows) if rows else []
+        if entity is ACCOUNTS and inserted:
+            open_accounts(db, [row[0] for row in inserted])
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    '''
+    Строки, ключ которых не вернулся из INSERT, уже существовали (в базе данных или выше в файле).
+    '''
+    new_keys = {str(row[1]) for row in inserted}
+    report.inserted(entity, len(new_keys))
+    for line, values in rows:
+        key = str(values[entity.key])
+        if key in new_keys:
+            new_keys.discard(key)
+        else:
+            if entity is CARDS:
+                key = '*' * (len(key) - 4) + key[-4:]
+            report.row(entity, path, line, 'skipped', f"Запись с {entity.key} '{key}' уже существует.")
+
+
+def import_files(clients: str = None, accounts: str = None, cards: str = None, report: ImportReport = None,
+                 method: str = 'copy', chunk_size: int = None) -> ImportReport:
+    '''
+    Загрузка файлов клиентов, счетов и карт (любой из них можно не указывать).
+
+    Выходные данные - отчет с итогами по таблицам (`report.totals`):
+
+    ```
+    {"clients": {"inserted": 1000, "skipped": 0, "failed": 2}, "accounts": {...}, "cards": {...}}
+    ```
+
+    Ошибки:
+    - `ValueError` - файл не содержит обязательных столбцов или неизвестный `method`.
+    '''
+    if method not in ('copy', 'insert'):
+        raise ValueError(f"Неизвестный способ загрузки '{method}'.")
+    chunk_size = chunk_size or app_settings.import_chunk_size
+    report = report or ImportReport()
+
+    for entity, path in ((CLIENTS, clients), (ACCOUNTS, accounts), (CARDS, cards)):
+        if path is None:
+            continue
+        started = time.perf_counter()
+        lines = 0
+        for chunk in read_chunks(path, entity.required, chunk_size):
+            load_chunk(entity, path, chunk, report, method)
+            lines += len(chunk)
+            logger.info("%s: обработано строк %d.", path, lines)
+        logger.info("%s: %s за %.1f с.", path, report.totals.get(entity.name), time.perf_counter() - started)
+    return report
@@ -0,0 +1,399 @@
+'''
+Журнал изменений балансов (таблица ledger, см. database/ledger.py).
+
+Каждая операция, изменившая баланс счета, добавляет в журнал запись с изменением баланса
+и удерживаемого баланса. Запись в базу данных выполняется не в запросе, а фоновым потоком
+(write-behind): после фиксации транзакции операции запись попадает в ограниченную очередь,
+а поток раз в `LEDGER_FLUSH_INTERVAL_MS` или по набору `LEDGER_BATCH_SIZE` записей вставляет их
+одним пакетным INSERT через отдельное соединение.
+
+Если очередь заполнена, запись вставляется сразу в потоке запроса - журнал не теряет записей,
+а под перегрузкой запросы замедляются. Ошибки вставки повторяются с увеличивающейся паузой;
+после последней попытки записи выводятся в лог с уровнем ERROR для ручного восстановления.
+Повторная вставка того же события не создает дубликата (уникальность operation_id, entry_type).
+
+Поскольку журнал пишется асинхронно, он отстает от таблицы accounts на время в пределах
+интервала записи, а записи, не вставленные после всех попыток или не записанные из-за падения
+процесса, теряются. Поэтому восстановление балансов (`replay_balances()` с `apply=True`) заменяет
+баланс счета, только если у всех его операций после OPENING есть записи журнала (`ledger_gaps()`);
+иначе балансы не изменяются. Выполнять его нужно после того, как очереди всех процессов сервера
+записаны (например, после остановки сервера).
+'''
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+from sqlalchemy import select, update, func, insert, literal, exists, any_, and_, or_, bindparam, case, Integer
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+from app.database import Accounts, Ledger, Transactions
+from app.db_session import engine, after_commit
+from app.hot_accounts import BALANCE, HELD_BALANCE, BALANCE_ADJUSTMENT, HELD_BALANCE_ADJUSTMENT
+from app.settings import app_settings
+
+logger = logging.getLogger(__name__)
+
+'''
+Завершенные статусы удержания и записи журнала, которыми они завершаются.
+'''
+FINISHED_HOLD_ENTRIES = {'COMPLETED': 'CHARGE', 'CANCELLED': 'CANCEL', 'EXPIRED': 'EXPIRE'}
+
+_STOP = object()
+
+
+class LedgerWriter:
+    def __init__(self, queue_size: int, batch_size: int, flush_interval: float, retries: int = 5):
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.queue = None
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.written = 0
+        self.sync_writes = 0
+        self.failed = 0
+
+    def _ensure_started(self):
+        '''
+        Поток запускается при первой записи в каждом процессе: потоки не переходят
+        в дочерние процессы при fork (см. server.py).
+        '''
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = queue.Queue(maxsize=self.queue_size)
+            self.thread = threading.Thread(target=self._run, name='ledger-writer', daemon=True)
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def submit(self, entry: dict):
+        self._ensure_started()
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self.sync_writes += 1
+            self._write_with_retry([entry])
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            first = self.queue.get()
+            if first is _STOP:
+                self.queue.task_done()
+                break
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if entry is _STOP:
+                    self.queue.task_done()
+                    stopping = True
+                    break
+                batch.append(entry)
+
+            self._write_with_retry(batch)
+            for _ in batch:
+                self.queue.task_done()
+
+    def _write(self, entries: list):
+        with engine.begin() as connection:
+            connection.execute(
+                pg_insert(Ledger).on_conflict_do_nothing(constraint='uq_ledger_operation_id_entry_type'),
+                entries
+            )
+
+    def _write_with_retry(self, entries: list):
+        for attempt in range(self.retries):
+            try:
+                self._write(entries)
+                self.written += len(entries)
+                return
+            except Exception:
+                if attempt == self.retries - 1:
+                    self.failed += len(entries)
+                    logger.error("Не удалось записать %d записей журнала: %r", len(entries), entries, exc_info=True)
+                    return
+                time.sleep(0.1 * 2 ** attempt)
+
+    def flush(self):
+        '''
+        Ожидание записи всех записей, поставленных в очередь текущим процессом.
+        '''
+        if self.pid == os.getpid():
+            self.queue.join()
+
+    def stop(self):
+        if self.pid != os.getpid() or not self.thread.is_alive():
+            return
+        self.queue.put(_STOP)
+        self.thread.join()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize() if self.pid == os.getpid() else 0,
+            "written": self.written,
+            "sync_writes": self.sync_writes,
+            "failed": self.failed
+        }
+
+
+ledger_writer = LedgerWriter(
+    app_settings.ledger_queue_size,
+    app_settings.ledger_batch_size,
+    app_settings.ledger_flush_interval_ms / 1000
+)
+atexit.register(ledger_writer.stop)
+
+
+def journal(db: Session, operation_id: str, account_id: int, entry_type: str, amount: Decimal,
+            balance_delta: Decimal, held_delta: Decimal, balance_after: Decimal = None, held_balance_after: Decimal = None):
+    '''
+    Запись события в журнал после фиксации транзакции `db`. При откате транзакции запись отбрасывается.
+    '''
+    if not app_settings.ledger_enabled:
+        return
+    after_commit(db, ledger_writer.submit, {
+        "operation_id": operation_id,
+        "account_id": account_id,
+        "entry_type": entry_type,
+        "amount": amount,
+        "balance_delta": balance_delta,
+        "held_delta": held_delta,
+        "balance_after": balance_after,
+        "held_balance_after": held_balance_after,
+        "created_at": datetime.now(timezone.utc)
+    })
+
+
+def open_accounts(db: Session, account_ids: list = None) -> int:
+    '''
+    Запись OPENING с текущими балансами для счетов, у которых ее еще нет (например, для счетов,
+    созданных после включения журнала). Запись выполняется в транзакции `db` без ее фиксации.
+
+    Незавершенные удержания счета получают собственные записи HOLD, а OPENING - удерживаемый баланс
+    без них. Поэтому у каждого незавершенного удержания есть запись HOLD, и ledger_gaps() проверяет
+    ее, не зная, создано удержание до или после OPENING. Удержания выбираются в том же запросе, что
+    и балансы: все три части выполняются в одном снимке данных.
+
+    Время записей берется из часов приложения, как и время операций (`transaction_date`) и записей
+    журнала (`journal()`), и передается параметром, т.е. преобразуется в TIMESTAMP так же.
+
+    Выходные данные - количество созданных записей OPENING.
+    '''
+    '''
+    NOT EXISTS проверяется по индексу журнала (account_id, id) только для выбранных счетов,
+    а не читает все записи OPENING журнала.
+    '''
+    opened = exists().where(Ledger.account_id == Accounts.id, Ledger.entry_type == 'OPENING')
+    accounts = select(Accounts.id).where(~opened)
+    if isinstance(account_ids, (list, tuple)):
+        '''
+        Список id передается одним параметром-массивом: длинный IN (...) с параметром на каждый id
+        заметно дольше готовится драйвером (например, при массовой загрузке счетов, см. importer.py).
+        '''
+        accounts = accounts.where(Accounts.id == any_(bindparam('account_ids', list(account_ids), type_=ARRAY(Integer))))
+    elif account_ids is not None:
+        accounts = accounts.where(Accounts.id.in_(account_ids))
+    accounts = accounts.cte('opening_accounts')
+    created_at = literal(datetime.now(timezone.utc), Ledger.created_at.type)
+
+    pending = (
+        select(Transactions.transaction_id, Transactions.account_id, Transactions.amount)
+        .where(
+            Transactions.account_id.in_(select(accounts.c.id)),
+            Transactions.transaction_type == 'HOLD',
+            Transactions.transaction_status.not_in(list(FINISHED_HOLD_ENTRIES))
+        )
+        .cte('opening_holds')
+    )
+    holds = (
+        pg_insert(Ledger)
+        .from_select(
+            ['operation_id', 'account_id', 'entry_type', 'amount', 'balance_delta', 'held_delta', 'created_at'],
+            select(pending.c.transaction_id, pending.c.account_id, literal('HOLD'), pending.c.amount, literal(0), pending.c.amount, created_at)
+        )
+        .on_conflict_do_nothing(constraint='uq_ledger_operation_id_entry_type')
+        .returning(Ledger.id)
+        .cte('opening_hold_entries')
+    )
+    pending_held = func.coalesce(
+        select(func.sum(pending.c.amount)).where(pending.c.account_id == Accounts.id).correlate(Accounts).scalar_subquery(),
+        0
+    )
+    held_balance = HELD_BALANCE - pending_held
+    source = select(
+        Accounts.id, literal('OPENING'), BALANCE, BALANCE, held_balance,
+        BALANCE, held_balance, created_at
+    ).where(Accounts.id.in_(select(accounts.c.id)))
+
+    created = db.scalars(insert(Ledger).from_select(
+        ['account_id', 'entry_type', 'amount', 'balance_delta', 'held_delta',
+         'balance_after', 'held_balance_after', 'created_at'],
+        source
+    ).returning(Ledger.id).add_cte(holds)).all()
+    return len(created)
+
+
+def ledger_gaps(db: Session, account_ids: list) -> dict:
+    '''
+    Поиск операций счетов, для которых в журнале нет хотя бы одной из ожидаемых записей:
+    - HOLD - у каждого незавершенного удержания (см. open_accounts()) и у удержания,
+      завершенного после записи OPENING счета;
+    - CHARGE, CANCEL или EXPIRE - у удержания, завершенного после записи OPENING;
+    - REFUND - у возврата, созданного после записи OPENING.
+
+    Выходные данные - словарь `{account_id: количество операций без записей}` только для счетов,
+    у которых такие операции есть.
+    '''
+    openings = (
+        select(Ledger.account_id, func.min(Ledger.created_at).label('created_at'))
+        .where(Ledger.entry_type == 'OPENING', Ledger.account_id == any_(bindparam('gap_account_ids', list(account_ids), type_=ARRAY(Integer))))
+        .group_by(Ledger.account_id)
+        .subquery()
+    )
+
+    def missing(operation_id, entry_type):
+        return ~exists().where(Ledger.operation_id == operation_id, Ledger.entry_type == entry_type)
+
+    hold = Transactions.transaction_type == 'HOLD'
+    finished = Transactions.transaction_status.in_(list(FINISHED_HOLD_ENTRIES))
+    after_opening = Transactions.transaction_date > openings.c.created_at
+    finished_entry = case(
+        *((Transactions.transaction_status == status, entry_type) for status, entry_type in FINISHED_HOLD_ENTRIES.items())
+    )
+    return dict(db.execute(
+        select(Transactions.account_id, func.count())
+        .join(openings, openings.c.account_id == Transactions.account_id)
+        .where(or_(
+            and_(hold, or_(~finished, after_opening), missing(Transactions.transaction_id, 'HOLD')),
+            and_(hold, finished, after_opening, missing(Transactions.transaction_id, finished_entry)),
+            and_(
+                Transactions.transaction_type == 'REFUND', after_opening,
+                missing(Transactions.original_transaction_id, 'REFUND')
+            )
+        ))
+        .group_by(Transactions.account_id)
+    ).all())
+
+
+def replay_balances(db: Session, account_ids: list = None, apply: bool = False) -> list:
+    '''
+    Восстановление баланса и удерживаемого баланса счетов по журналу: сумма изменений
+    всех записей счета, начиная с OPENING.
+
+    Выходные данные - список расхождений с таблицей accounts:
+
+    ```
+    [
+        {
+            "account_id": 1,
+            "account_number": "XXXXXXXX-XXXX-XXXX-XXXX-XXXXXXXXXXXX",
+            "opened": true,
+            "balance": 900.00,
+            "held_balance": 0.00,
+            "ledger_balance": 1000.00,
+            "ledger_held_balance": 0.00,
+            "balance_adjustment": 0.00,
+            "held_balance_adjustment": 0.00,
+            "missing": 0
+        }
+    ]
+    ```
+
+    `opened` - есть ли у счета запись OPENING; без нее баланс по журналу восстановить нельзя.
+    Балансы "горячих" счетов сравниваются с учетом слотов (см. hot_accounts.py); `balance_adjustment`
+    и `held_balance_adjustment` - разница между значениями в строке счета и значениями с учетом слотов.
+    `missing` - количество операций счета без записей журнала (см. ledger_gaps()): пока оно
+    не равно 0, журнал счета неполон, и восстановленный баланс неверен.
+
+    С `apply=True` балансы счетов с записью OPENING заменяются восстановленными значениями
+    в транзакции `db` без ее фиксации.
+
+    Ошибки:
+    - `ValueError` - `apply=True`, а у расходящегося счета есть операции без записей журнала.
+      Балансы не изменяются.
+    '''
+    totals = (
+        select(
+            Ledger.account_id,
+            func.sum(Ledger.balance_delta).label('balance'),
+            func.sum(Ledger.held_delta).label('held_balance'),
+            func.count().filter(Ledger.entry_type == 'OPENING').label('openings')
+        )
+        .group_by(Ledger.account_id)
+        .subquery()
+    )
+    query = (
+        select(
+            Accounts.id, Accounts.account_number, BALANCE, HELD_BALANCE,
+            BALANCE_ADJUSTMENT.label('balance_adjustment'),
+            HELD_BALANCE_ADJUSTMENT.label('held_balance_adjustment'),
+            func.coalesce(totals.c.balance, 0).label('ledger_balance'),
+            func.coalesce(totals.c.held_balance, 0).label('ledger_held_balance'),
+            func.coalesce(totals.c.openings, 0).label('openings')
+        )
+        .outerjoin(totals, totals.c.account_id == Accounts.id)
+        .order_by(Accounts.id)
+    )
+    if account_ids is not None:
+        query = query.where(Accounts.id.in_(account_ids))
+
+    mismatches = []
+    for row in db.execute(query):
+        opened = row.openings > 0
+        if opened and row.balance == row.ledger_balance and row.held_balance == row.ledger_held_balance:
+            continue
+        mismatches.append({
+            "account_id": row.id,
+            "account_number": str(row.account_number),
+            "opened": opened,
+            "balance": row.balance,
+            "held_balance": row.held_balance,
+            "ledger_balance": row.ledger_balance,
+            "ledger_held_balance": row.ledger_held_balance,
+            "balance_adjustment": row.balance_adjustment,
+            "held_balance_adjustment": row.held_balance_adjustment,
+            "missing": 0
+        })
+
+    opened = [item["account_id"] for item in mismatches if item["opened"]]
+    gaps = ledger_gaps(db, opened) if opened else {}
+    for item in mismatches:
+        item["missing"] = gaps.get(item["account_id"], 0)
+
+    if apply:
+        if gaps:
+            accounts = ', '.join(
+                f"{item['account_number']} ({item['missing']})" for item in mismatches if item["missing"]
+            )
+            raise ValueError(
+                f"Есть операции без записей журнала, балансы не изменены: {accounts}. "
+                "Журнал неполон: дождитесь записи очередей журнала всех процессов."
+            )
+        repairs = [
+            {
+                "id": item["account_id"],
+                "balance": item["ledger_balance"] + item["balance_adjustment"],
+                "held_balance": item["ledger_held_balance"] + item["held_balance_adjustment"]
+            }
+            for item in mismatches if item["opened"]
+        ]
+        if repairs:
+            db.execute(update(Accounts), repairs)
+
+    return mismatches
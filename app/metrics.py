@@ -0,0 +1,257 @@
+'''
+Метрики приложения в текстовом формате Prometheus.
+
+Реестр хранится в памяти процесса, поэтому при запуске нескольких процессов (см. server.py)
+каждый процесс отдает собственные значения, и сервер метрик должен опрашивать их по отдельности
+или суммировать по метке `instance`.
+
+Метрики:
+- `http_requests_total{endpoint, outcome}` - количество запросов по эндпоинтам и результатам:
+    - `created` - операция выполнена, создана новая запись (201);
+    - `ok` - операция выполнена (200);
+    - `replay` - повтор уже выполненной операции;
+    - `validation_error` - ошибка во входных данных запроса;
+    - `business_error` - отказ бизнес-логики: счет не найден, недостаточно средств и т.д. (400);
+    - `error` - внутренняя ошибка (500).
+- `http_request_duration_seconds{endpoint, outcome}` - гистограмма длительности запросов;
+- `operation_stage_duration_seconds{stage}` - гистограмма длительности этапов обработки:
+  `json_parse`, `idempotency_check`, `account_lookup`, `commit`.
+
+При выключенных метриках (`METRICS_ENABLED=false`) все функции записи ничего не делают.
+'''
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import wraps
+from app.settings import app_settings
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels: tuple, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def collect(self) -> list:
+        with self.lock:
+            values = sorted(self.values.items())
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for labels, value in values:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    '''
+    Гистограмма с фиксированными границами корзин. Для каждого набора меток хранится
+    список счетчиков по корзинам (без накопления), сумма и количество наблюдений;
+    накопленные значения считаются только при выгрузке.
+    '''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _state(self, labels: tuple) -> list:
+        state = self.values.get(labels)
+        if state is None:
+            with self.lock:
+                state = self.values.setdefault(labels, [[0] * (len(self.buckets) + 1), 0.0, 0])
+        return state
+
+    def observe(self, labels: tuple, value: float):
+        index = bisect_left(self.buckets, value)
+        state = self._state(labels)
+        with self.lock:
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def observer(self, labels: tuple):
+        '''
+        Функция записи для фиксированного набора меток - для горячего пути, где набор меток известен заранее.
+        '''
+        buckets, lock = self.buckets, self.lock
+        state = self._state(labels)
+        counts = state[0]
+
+        def observe(value: float):
+            index = bisect_left(buckets, value)
+            with lock:
+                counts[index] += 1
+                state[1] += value
+                state[2] += 1
+        return observe
+
+    def collect(self) -> list:
+        with self.lock:
+            values = sorted((labels, (list(state[0]), state[1], state[2])) for labels, state in self.values.items())
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        labelnames = self.labelnames + ('le',)
+        for labels, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else _format_value(bound)
+                lines.append(f'{self.name}_bucket{_format_labels(labelnames, labels + (le,))} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, labels)} {count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+registry = Registry()
+
+requests_total = registry.register(Counter(
+    'http_requests_total', 'Количество запросов по эндпоинтам и результатам.', ('endpoint', 'outcome')
+))
+request_duration = registry.register(Histogram(
+    'http_request_duration_seconds', 'Длительность запросов в секундах.', ('endpoint', 'outcome')
+))
+stage_duration = registry.register(Histogram(
+    'operation_stage_duration_seconds', 'Длительность этапов обработки операции в секундах.', ('stage',)
+))
+
+OUTCOMES_BY_STATUS = {200: 'ok', 201: 'created', 400: 'business_error', 500: 'error'}
+
+'''
+Результат текущего запроса, заданный через mark(). Хранится в переменной контекста, а не во
+`flask.g`, потому что обращение к ней в несколько раз дешевле.
+'''
+_outcome = ContextVar('metrics_outcome', default=None)
+
+
+class _StageTimer:
+    __slots__ = ('observe', 'started')
+
+    def __init__(self, observe):
+        self.observe = observe
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.observe(time.perf_counter() - self.started)
+
+
+_stage_observers = {}
+
+
+class _NoopTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_noop_timer = _NoopTimer()
+
+
+def stage(name: str):
+    '''
+    Контекстный менеджер, который записывает длительность этапа `name`.
+
+    ```
+    with metrics.stage('commit'):
+        db.commit()
+    ```
+    '''
+    if not app_settings.metrics_enabled:
+        return _noop_timer
+    observe = _stage_observers.get(name)
+    if observe is None:
+        observe = _stage_observers[name] = stage_duration.observer((name,))
+    return _StageTimer(observe)
+
+
+def mark(outcome: str):
+    '''
+    Уточнение результата текущего запроса, если он не следует из кода ответа:
+    `replay` для повторов и `validation_error` для ошибок во входных данных.
+    '''
+    if app_settings.metrics_enabled:
+        _outcome.set(outcome)
+
+
+def instrument(endpoint: str):
+    '''
+    Декоратор эндпоинта: записывает количество и длительность запросов с результатом,
+    определенным по `mark()` или по коду ответа (см. OUTCOMES_BY_STATUS).
+    '''
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not app_settings.metrics_enabled:
+                return view(*args, **kwargs)
+
+            token = _outcome.set(None)
+            started = time.perf_counter()
+            try:
+                response = view(*args, **kwargs)
+            except Exception:
+                _record(endpoint, 'error', started)
+                raise
+            else:
+                status = response[1] if isinstance(response, tuple) else 200
+                _record(endpoint, _outcome.get() or OUTCOMES_BY_STATUS.get(status, str(status)), started)
+            finally:
+                _outcome.reset(token)
+            return response
+        return wrapper
+    return decorator
+
+
+def _record(endpoint: str, outcome: str, started: float):
+    labels = (endpoint, outcome)
+    requests_total.inc(labels)
+    request_duration.observe(labels, time.perf_counter() - started)
+
+
+def expose() -> str:
+    return registry.expose()
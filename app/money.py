@@ -0,0 +1,99 @@
+'''
+Денежные суммы.
+
+Все суммы внутри сервиса представлены типом `Decimal` с двумя знаками после запятой,
+как и столбцы `DECIMAL(15, 2)` в базе данных. Значения передаются в SQL и читаются из него
+без промежуточного перевода в `float`, поэтому при сложении и вычитании не накапливается
+ошибка округления.
+
+JSON-тела запросов разбираются сразу в `Decimal` (см. `MoneyJSONProvider`), а в ответах
+суммы выводятся обычными JSON-числами.
+'''
+import json
+from decimal import Decimal, InvalidOperation
+from flask.json.provider import DefaultJSONProvider
+
+CENT = Decimal('0.01')
+
+'''
+Предельное значение для столбцов DECIMAL(15, 2) - 13 знаков в целой части.
+'''
+MAX_AMOUNT = Decimal('9999999999999.99')
+
+
+def to_money(value) -> Decimal:
+    '''
+    Приведение значения к денежной сумме.
+
+    Входные аргументы:
+    - `value` - `int`, `Decimal`, `str` или `float` (для вызовов из Python-кода).
+
+    Выходные данные - `Decimal` с ровно двумя знаками после запятой.
+
+    Ошибки:
+    - `ValueError`:
+        - значение не является числом;
+        - у значения больше двух знаков после запятой;
+        - значение выходит за пределы столбца DECIMAL(15, 2).
+    '''
+
+    if isinstance(value, bool):
+        raise ValueError("Сумма должна быть числом.")
+    try:
+        if isinstance(value, float):
+            '''
+            repr() у float дает кратчайшую десятичную запись, т.е. 100.1 превращается
+            в Decimal('100.1'), а не в 100.099999999999994315658113919198513031005859375.
+            '''
+            amount = Decimal(repr(value))
+        else:
+            amount = Decimal(value)
+    except (InvalidOperation, TypeError, ValueError):
+        raise ValueError("Сумма должна быть числом.")
+
+    if not amount.is_finite():
+        raise ValueError("Сумма должна быть числом.")
+
+    '''
+    Предел проверяется до quantize(): для значений больше точности контекста Decimal (1e100)
+    quantize() выбрасывает InvalidOperation, а не ValueError.
+    '''
+    if abs(amount) > MAX_AMOUNT:
+        raise ValueError(f"Сумма {amount} превышает допустимое значение {MAX_AMOUNT}.")
+    quantized = amount.quantize(CENT)
+    if quantized != amount:
+        raise ValueError(f"Сумма {amount} содержит больше двух знаков после запятой.")
+
+    return quantized
+
+
+def is_money_number(value) -> bool:
+    '''
+    Проверка, что значение из JSON является числом (целым или десятичным), но не логическим.
+    '''
+    return isinstance(value, (int, Decimal)) and not isinstance(value, bool)
+
+
+def json_default(o):
+    '''
+    Вывод `Decimal` в JSON-ответ числом.
+
+    Суммы DECIMAL(15, 2) содержат не более 15 значащих цифр, а такие десятичные
+    записи переживают перевод в float и обратно без изменений, поэтому в ответе
+    оказывается ровно то же число, что хранится в базе данных.
+    '''
+    if isinstance(o, Decimal):
+        return float(o)
+    return DefaultJSONProvider.default(o)
+
+
+class MoneyJSONProvider(DefaultJSONProvider):
+    '''
+    JSON-провайдер Flask, который разбирает дробные числа в `Decimal`
+    и выводит `Decimal` как JSON-числа.
+    '''
+    default = staticmethod(json_default)
+
+    def loads(self, s, **kwargs):
+        kwargs.setdefault('parse_float', Decimal)
+        return json.loads(s, **kwargs)
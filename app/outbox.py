@@ -0,0 +1,373 @@
+'''
+Публикация событий операций через transactional outbox.
+
+Получателям (учетные системы, уведомления) не нужно опрашивать таблицу transactions, чтобы узнать,
+что удержание списано, отменено или возвращено. Каждое изменение операции добавляет строку
+в таблицу outbox (см. database/outbox.py) той же транзакцией, что и само изменение: событие
+появляется тогда и только тогда, когда изменение зафиксировано, и не теряется при падении процесса
+между фиксацией и отправкой. События пишутся при `OUTBOX_ENABLED=true` для всех изменений:
+удержаний (HOLD, в том числе пакетных и через книгу резервирований), списаний (CHARGE, в том числе
+пакетных), отмен (CANCEL), освобождения просроченных удержаний (EXPIRE) и возвратов (REFUND).
+
+Ретранслятор (`python run.py outbox`) читает неотправленные события пакетами по `OUTBOX_BATCH_SIZE`
+в порядке `id`, отправляет пакет в приемник и отмечает события отправленными:
+- `file` - строки NDJSON в файле `OUTBOX_FILE` (заменитель брокера для проверок и отладки);
+- `redis` - поток Redis `OUTBOX_REDIS_STREAM` (XADD, по записи на событие);
+- `webhook` - POST пакета событий в JSON на `OUTBOX_WEBHOOK_URL`, с `OUTBOX_WEBHOOK_SECRET`
+  тело подписывается HMAC-SHA256 (заголовок `X-Outbox-Signature: sha256=<hex>`).
+
+Ошибка приемника увеличивает `attempts` и сохраняет `last_error` событий пакета, после чего
+ретранслятор повторяет тот же пакет с удваивающейся паузой до `OUTBOX_MAX_BACKOFF_SECONDS`.
+Следующие события не отправляются раньше неотправленных, поэтому получатель видит события
+одной операции в порядке изменений.
+
+Гарантии и ограничения:
+- доставка "хотя бы один раз": если приемник принял пакет, а отметка об отправке не зафиксирована,
+  пакет будет отправлен повторно. Получатели устраняют повторы по `event_id`;
+- одновременно работает один ретранслятор: пакет выбирается под `pg_try_advisory_xact_lock`,
+  остальные экземпляры ждут и подхватывают работу, если первый остановится;
+- `id` выдается при вставке, а видимой строка становится при фиксации, поэтому события разных
+  операций могут быть отправлены не строго в порядке `id`. События одной операции упорядочены:
+  следующее изменение операции начинается только после фиксации предыдущего;
+- отправленные события удаляются через `OUTBOX_RETENTION_SECONDS`, 0 - хранятся всегда.
+
+Формат события:
+
+```
+{
+    "event_id": "ZZZZZZZZ-ZZZZ-ZZZZ-ZZZZ-ZZZZZZZZZZZZ",
+    "sequence": 1042,
+    "event_type": "CHARGE",
+    "operation_id": "YYYYYYYY-YYYY-YYYY-YYYY-YYYYYYYYYYYY",
+    "account_id": "XXXXXXXX-XXXX-XXXX-XXXX-XXXXXXXXXXXX",
+    "currency": "KZT",
+    "amount": 100.00,
+    "balance": 900.00,
+    "held_balance": 0.00,
+    "occurred_at": "2026-10-19T10:15:00.123456"
+}
+```
+
+`balance` и `held_balance` - балансы счета сразу после изменения.
+'''
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+import urllib.request
+import uuid
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.orm import Session
+from app.database import Accounts, Outbox
+from app.db_session import session
+from app.metrics import registry, Counter, Histogram
+from app.money import json_default
+from app.redis_client import get_redis
+from app.settings import app_settings
+
+logger = logging.getLogger(__name__)
+
+'''
+Ключ advisory-блокировки ретранслятора ("outbox" в ASCII).
+'''
+RELAY_LOCK = 0x6F7574626F78
+
+published_total = registry.register(Counter(
+    'outbox_events_published_total', 'Количество отправленных событий outbox.', ()
+))
+publish_failures_total = registry.register(Counter(
+    'outbox_publish_failures_total', 'Количество неудачных отправок пакетов событий outbox.', ()
+))
+relay_batch_duration = registry.register(Histogram(
+    'outbox_relay_batch_duration_seconds', 'Длительность отправки пакета событий outbox в секундах.', ()
+))
+
+
+def publish(db: Session, event_type: str, operation_id: str, account_id: int, amount: Decimal,
+            balance: Decimal = None, held_balance: Decimal = None):
+    '''
+    Добавление события в outbox в транзакции `db` без ее фиксации. При откате транзакции
+    событие отбрасывается вместе с изменением.
+    '''
+    if not app_settings.outbox_enabled:
+        return
+    db.add(Outbox(
+        event_id=str(uuid.uuid4()),
+        event_type=event_type,
+        operation_id=operation_id,
+        account_id=account_id,
+        amount=amount,
+        balance=balance,
+        held_balance=held_balance,
+        created_at=datetime.now(timezone.utc)
+    ))
+
+
+def encode(event: dict) -> str:
+    return json.dumps(event, ensure_ascii=False, default=json_default)
+
+
+class FileSink:
+    '''
+    Дописывание событий в файл, по строке JSON на событие, с fsync после каждого пакета.
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def send(self, events: list):
+        with open(self.path, 'a', encoding='utf-8') as file:
+            file.write(''.join(encode(event) + '\n' for event in events))
+            file.flush()
+            os.fsync(file.fileno())
+
+
+class QueueSink:
+    '''
+    Приемник в памяти процесса для проверок: отправленные события накапливаются в `events`.
+    '''
+
+    def __init__(self):
+        self.events = []
+
+    def send(self, events: list):
+        self.events.extend(events)
+
+
+class RedisStreamSink:
+    '''
+    Добавление событий в поток Redis: поля `event_id`, `event_type` и `data` (событие в JSON).
+    '''
+
+    def __init__(self, stream: str, maxlen: int = None):
+        self.stream = stream
+        self.maxlen = maxlen
+
+    def send(self, events: list):
+        client = get_redis()
+        if client is None:
+            raise RuntimeError("Для приемника redis требуется REDIS_URL.")
+        pipeline = client.pipeline(transaction=False)
+        for event in events:
+            pipeline.xadd(
+                self.stream,
+                {"event_id": event["event_id"], "event_type": event["event_type"], "data": encode(event)},
+                maxlen=self.maxlen, approximate=True
+            )
+        pipeline.execute()
+
+
+class WebhookSink:
+    '''
+    POST пакета событий `{"events": [...]}` на адрес получателя. Ответ с кодом не из 2xx - ошибка.
+    '''
+
+    def __init__(self, url: str, secret: str = None, timeout: float = 5):
+        self.url = url
+        self.secret = secret
+        self.timeout = timeout
+
+    def send(self, events: list):
+        body = json.dumps({"events": events}, ensure_ascii=False, default=json_default).encode()
+        request = urllib.request.Request(self.url, data=body, method='POST', headers={"Content-Type": "application/json"})
+        if self.secret:
+            signature = hmac.new(self.secret.encode(), body, hashlib.sha256).hexdigest()
+            request.add_header('X-Outbox-Signature', f'sha256={signature}')
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            if not 200 <= response.status < 300:
+                raise RuntimeError(f"Получатель ответил кодом {response.status}.")
+
+
+def make_sink(name: str = None):
+    '''
+    Приемник по имени (`file`, `redis`, `webhook`), по умолчанию - `OUTBOX_SINK`.
+    '''
+    name = name or app_settings.outbox_sink
+    if name == 'file':
+        return FileSink(app_settings.outbox_file)
+    if name == 'redis':
+        return RedisStreamSink(app_settings.outbox_redis_stream, app_settings.outbox_redis_maxlen)
+    if name == 'webhook':
+        if not app_settings.outbox_webhook_url:
+            raise ValueError("Для приемника webhook требуется OUTBOX_WEBHOOK_URL.")
+        return WebhookSink(app_settings.outbox_webhook_url, app_settings.outbox_webhook_secret, app_settings.outbox_webhook_timeout)
+    raise ValueError(f"Неизвестный приемник событий '{name}'.")
+
+
+def _event(row) -> dict:
+    return {
+        "event_id": str(row.event_id),
+        "sequence": row.id,
+        "event_type": row.event_type,
+        "operation_id": str(row.operation_id),
+        "account_id": str(row.account_number),
+        "currency": row.currency,
+        "amount": row.amount,
+        "balance": row.balance,
+        "held_balance": row.held_balance,
+        "occurred_at": row.created_at.isoformat()
+    }
+
+
+class OutboxRelay:
+    def __init__(self, sink, batch_size: int = None, poll_interval: float = None, max_backoff: float = None):
+        self.sink = sink
+        self.batch_size = batch_size or app_settings.outbox_batch_size
+        self.poll_interval = poll_interval or app_settings.outbox_poll_interval_ms / 1000
+        self.max_backoff = max_backoff or app_settings.outbox_max_backoff_seconds
+
+    def relay_batch(self) -> int:
+        '''
+        Отправка одного пакета неотправленных событий.
+
+        Выходные данные - количество отправленных событий; 0, если событий нет или пакет
+        отправляет другой ретранслятор.
+
+        Ошибки приемника передаются вызывающей стороне после записи попытки в события пакета.
+        '''
+        db = session()
+        try:
+            if not db.scalar(select(func.pg_try_advisory_xact_lock(RELAY_LOCK))):
+                return 0
+            rows = db.execute(
+                select(
+                    Outbox.id, Outbox.event_id, Outbox.event_type, Outbox.operation_id, Outbox.amount,
+                    Outbox.balance, Outbox.held_balance, Outbox.created_at, Accounts.account_number, Accounts.currency
+                )
+                .join(Accounts, Accounts.id == Outbox.account_id)
+                .where(Outbox.published_at.is_(None))
+                .order_by(Outbox.id)
+                .limit(self.batch_size)
+            ).all()
+            if not rows:
+                return 0
+
+            ids = [row.id for row in rows]
+            started = time.perf_counter()
+            try:
+                self.sink.send([_event(row) for row in rows])
+            except Exception as e:
+                publish_failures_total.inc(())
+                db.execute(
+                    update(Outbox)
+                    .where(Outbox.id.in_(ids))
+                    .values(attempts=Outbox.attempts + 1, last_error=repr(e)[:1000])
+                    .execution_options(synchronize_session=False)
+                )
+                db.commit()
+                raise
+
+            db.execute(
+                update(Outbox)
+                .where(Outbox.id.in_(ids))
+                .values(published_at=datetime.now(timezone.utc), attempts=Outbox.attempts + 1, last_error=None)
+                .execution_options(synchronize_session=False)
+            )
+            db.commit()
+            published_total.inc((), len(rows))
+            relay_batch_duration.observe((), time.perf_counter() - started)
+            return len(rows)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def drain(self) -> int:
+        '''
+        Отправка всех неотправленных событий. Ошибка приемника прерывает отправку.
+
+        Выходные данные - количество отправленных событий.
+        '''
+        total = 0
+        while True:
+            published = self.relay_batch()
+            total += published
+            if published < self.batch_size:
+                return total
+
+    def run_forever(self):
+        '''
+        Отправка событий до остановки процесса. Если событий нет, ретранслятор ждет
+        `OUTBOX_POLL_INTERVAL_MS`; после ошибки - удваивающуюся паузу до `OUTBOX_MAX_BACKOFF_SECONDS`.
+        '''
+        failures = 0
+        purged_at = 0.0
+        while True:
+            try:
+                published = self.relay_batch()
+                failures = 0
+            except Exception:
+                failures += 1
+                backoff = min(self.max_backoff, self.poll_interval * 2 ** failures)
+                logger.warning("Не удалось отправить события outbox (попытка %d), повтор через %.1f с.", failures, backoff, exc_info=True)
+                time.sleep(backoff)
+                continue
+
+            if published:
+                logger.info("Отправлено событий outbox: %d.", published)
+            if published < self.batch_size:
+                if time.monotonic() - purged_at > 60:
+                    purged_at = time.monotonic()
+                    try:
+                        purge()
+                    except Exception:
+                        logger.warning("Не удалось удалить отправленные события outbox.", exc_info=True)
+                time.sleep(self.poll_interval)
+
+
+def purge(retention: int = None, batch_size: int = None) -> int:
+    '''
+    Удаление событий, отправленных раньше чем `retention` секунд назад, пакетами по `batch_size`.
+
+    Выходные данные - количество удаленных событий.
+    '''
+    retention = app_settings.outbox_retention_seconds if retention is None else retention
+    batch_size = batch_size or app_settings.outbox_batch_size
+    if retention <= 0:
+        return 0
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=retention)
+
+    total = 0
+    while True:
+        db = session()
+        try:
+            deleted = db.execute(
+                delete(Outbox).where(Outbox.id.in_(
+                    select(Outbox.id).where(Outbox.published_at < cutoff).limit(batch_size).scalar_subquery()
+                ))
+            ).rowcount
+            db.commit()
+        finally:
+            db.close()
+        total += deleted
+        if deleted < batch_size:
+            return total
+
+
+def outbox_stats(db: Session) -> dict:
+    '''
+    Состояние outbox:
+
+    ```
+    {"pending": 12, "failing": 0, "oldest_pending": "2026-10-19T10:15:00.123456"}
+    ```
+
+    `failing` - неотправленные события, для которых уже была неудачная попытка.
+    '''
+    row = db.execute(
+        select(
+            func.count(),
+            func.count().filter(Outbox.attempts > 0),
+            func.min(Outbox.created_at)
+        ).where(Outbox.published_at.is_(None))
+    ).one()
+    return {
+        "pending": row[0],
+        "failing": row[1],
+        "oldest_pending": row[2].isoformat() if row[2] else None
+    }
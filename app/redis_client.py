@@ -0,0 +1,41 @@
+'''
+Общее подключение к Redis.
+
+Клиент создается при первом обращении. Если `REDIS_URL` не задан, функции
+возвращают None, и вызывающий код использует хранилище в памяти процесса.
+
+`get_async_redis()` - клиент redis.asyncio для ASGI-приложения (см. async_services.py).
+Его соединения привязаны к циклу событий, поэтому клиент создается для каждого цикла.
+'''
+import asyncio
+import weakref
+from threading import Lock
+from app.settings import app_settings
+
+_client = None
+_async_clients = weakref.WeakKeyDictionary()
+_lock = Lock()
+
+
+def get_redis():
+    global _client
+
+    if app_settings.redis_url is None:
+        return None
+    if _client is None:
+        with _lock:
+            if _client is None:
+                import redis
+                _client = redis.Redis.from_url(app_settings.redis_url)
+    return _client
+
+
+def get_async_redis():
+    if app_settings.redis_url is None:
+        return None
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        import redis.asyncio
+        client = _async_clients[loop] = redis.asyncio.Redis.from_url(app_settings.redis_url)
+    return client
@@ -0,0 +1,257 @@
+'''
+Чтение с реплик только для чтения.
+
+На реплики направляется чтение, которое допускает отставание данных от основного сервера
+(см. `run_read()`): баланс счета при промахе проекции, история операций и поиск уже выполненных
+списаний, отмен и возвратов. Изменения и чтение с блокировкой (SELECT ... FOR UPDATE) всегда
+выполняются на основном сервере.
+
+Реплики задаются `DB_REPLICA_URLS` и выбираются по кругу. Реплика пропускается:
+- если ее отставание больше `DB_REPLICA_MAX_LAG_SECONDS`. Отставание измеряется не чаще раза
+  в `DB_REPLICA_CHECK_INTERVAL` секунд в каждом процессе; реплика, которая применила весь
+  полученный WAL, считается не отстающей, даже если на основном сервере давно не было изменений;
+- в течение `DB_REPLICA_RETRY_AFTER` секунд после ошибки соединения с ней.
+
+Если подходящей реплики нет или запрос на реплике завершился ошибкой соединения, чтение
+выполняется на основном сервере (`DB_REPLICA_FALLBACK`, по умолчанию включено). С выключенным
+`DB_REPLICA_FALLBACK` в этих случаях выбрасывается `ReplicaUnavailable`.
+
+ASGI-приложение (см. async_services.py) читает с реплик через `run_on_replica_async()`: для каждой
+реплики при первом обращении создается асинхронный движок с теми же параметрами, а выбор реплики
+и измерение отставания общие с синхронными движками.
+'''
+import logging
+import time
+from threading import Lock
+from sqlalchemy import create_engine, text, Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from app.db_session import engine_options, session, session_scope
+from app.settings import app_settings
+from app import sql_profiler
+
+logger = logging.getLogger(__name__)
+
+REPLICA_LAG_QUERY = text('''
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+''')
+
+
+class ReplicaUnavailable(Exception):
+    pass
+
+
+class Replica:
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self.async_engine = None
+        self.lag = None
+        self.checked_at = None
+        self.failed_until = 0.0
+
+
+class ReplicaRouter:
+    def __init__(self, engines: list, max_lag: float, check_interval: float, retry_after: float):
+        self.replicas = [Replica(engine) for engine in engines]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.retry_after = retry_after
+        self._next = 0
+        self._lock = Lock()
+
+    @property
+    def engines(self) -> list:
+        return [replica.engine for replica in self.replicas]
+
+    def _check(self, replica: Replica):
+        '''
+        Измерение отставания реплики. Проверку выполняет один поток, остальные
+        до ее окончания используют прежнее значение.
+        '''
+        try:
+            with replica.engine.connect() as connection:
+                replica.lag = float(connection.execute(REPLICA_LAG_QUERY).scalar())
+        except OperationalError:
+            self.mark_failed(replica.engine)
+            logger.warning("Реплика %s недоступна.", replica.engine.url.render_as_string(hide_password=True), exc_info=True)
+
+    async def _check_async(self, replica: Replica):
+        try:
+            async with self.async_engine(replica.engine).connect() as connection:
+                replica.lag = float((await connection.execute(REPLICA_LAG_QUERY)).scalar())
+        except OperationalError:
+            self.mark_failed(replica.engine)
+            logger.warning("Реплика %s недоступна.", replica.engine.url.render_as_string(hide_password=True), exc_info=True)
+
+    def _candidates(self):
+        '''
+        Реплики по кругу, начиная со следующей, кроме исключенных после ошибки: пары
+        (реплика, нужно ли измерить ее отставание).
+        '''
+        for _ in range(len(self.replicas)):
+            with self._lock:
+                replica = self.replicas[self._next]
+                self._next = (self._next + 1) % len(self.replicas)
+                now = time.monotonic()
+                if replica.failed_until > now:
+                    continue
+                check = replica.checked_at is None or now - replica.checked_at >= self.check_interval
+                if check:
+                    replica.checked_at = now
+            yield replica, check
+
+    def _usable(self, replica: Replica) -> bool:
+        return replica.failed_until <= time.monotonic() and replica.lag is not None and replica.lag <= self.max_lag
+
+    def pick(self):
+        '''
+        Выходные данные - движок следующей подходящей реплики или None.
+        '''
+        for replica, check in self._candidates():
+            if check:
+                self._check(replica)
+            if self._usable(replica):
+                return replica.engine
+        return None
+
+    async def pick_async(self):
+        '''
+        То же, что pick(), с измерением отставания через асинхронный движок реплики.
+        '''
+        for replica, check in self._candidates():
+            if check:
+                await self._check_async(replica)
+            if self._usable(replica):
+                return replica.engine
+        return None
+
+    def async_engine(self, engine: Engine):
+        '''
+        Асинхронный движок реплики с синхронным движком `engine`; создается при первом обращении.
+        '''
+        replica = next(replica for replica in self.replicas if replica.engine is engine)
+        if replica.async_engine is None:
+            with self._lock:
+                if replica.async_engine is None:
+                    replica.async_engine = create_async_engine(replica.engine.url, **engine_options())
+                    sql_profiler.attach(replica.async_engine.sync_engine)
+        return replica.async_engine
+
+    async def dispose_async(self):
+        for replica in self.replicas:
+            if replica.async_engine is not None:
+                await replica.async_engine.dispose()
+
+    def mark_failed(self, engine: Engine):
+        for replica in self.replicas:
+            if replica.engine is engine:
+                replica.failed_until = time.monotonic() + self.retry_after
+                replica.lag = None
+
+    def stats(self) -> list:
+        now = time.monotonic()
+        return [
+            {
+                "url": replica.engine.url.render_as_string(hide_password=True),
+                "lag_seconds": replica.lag,
+                "available": replica.failed_until <= now and replica.lag is not None and replica.lag <= self.max_lag
+            }
+            for replica in self.replicas
+        ]
+
+
+def _create_engine(url: str) -> Engine:
+    replica_engine = create_engine(url, **engine_options())
+    sql_profiler.attach(replica_engine)
+    return replica_engine
+
+
+replica_router = ReplicaRouter(
+    [_create_engine(url) for url in app_settings.db_replica_urls],
+    app_settings.db_replica_max_lag_seconds,
+    app_settings.db_replica_check_interval,
+    app_settings.db_replica_retry_after
+)
+
+
+def replicas_enabled() -> bool:
+    return bool(replica_router.replicas)
+
+
+def pick_read_engine():
+    '''
+    Движок для чтения: подходящая реплика или, если их нет и это разрешено, None - основной сервер.
+    '''
+    replica = replica_router.pick()
+    if replica is None and replicas_enabled() and not app_settings.db_replica_fallback:
+        raise ReplicaUnavailable("Нет доступных реплик для чтения.")
+    return replica
+
+
+def run_read(operation, *args):
+    '''
+    Выполнение `operation(db, *args)` без изменений в базе данных на реплике или на основном сервере.
+
+    Без заданных реплик - то же, что вызов в session_scope(). Ошибка соединения с репликой
+    исключает ее на `DB_REPLICA_RETRY_AFTER` секунд, а чтение повторяется на основном сервере.
+    '''
+    replica = pick_read_engine()
+    if replica is not None:
+        db = session(bind=replica)
+        try:
+            return operation(db, *args)
+        except OperationalError:
+            replica_router.mark_failed(replica)
+            if not app_settings.db_replica_fallback:
+                raise
+            logger.warning("Ошибка чтения с реплики %s, чтение на основном сервере.", replica.url.render_as_string(hide_password=True), exc_info=True)
+        finally:
+            db.close()
+
+    with session_scope() as db:
+        return operation(db, *args)
+
+
+def run_on_replica(operation, *args):
+    '''
+    Выполнение `operation(db, *args)` только на реплике - для чтения, которое лишь избавляет
+    основной сервер от работы (например, поиск уже выполненной операции перед ее выполнением).
+
+    Выходные данные - результат операции или None, если подходящей реплики нет или соединение
+    с ней прервалось. Основной сервер не используется независимо от `DB_REPLICA_FALLBACK`.
+    '''
+    replica = replica_router.pick()
+    if replica is None:
+        return None
+
+    db = session(bind=replica)
+    try:
+        return operation(db, *args)
+    except OperationalError:
+        replica_router.mark_failed(replica)
+        logger.warning("Ошибка чтения с реплики %s.", replica.url.render_as_string(hide_password=True), exc_info=True)
+        return None
+    finally:
+        db.close()
+
+
+async def run_on_replica_async(operation, *args):
+    '''
+    То же, что run_on_replica(), для ASGI-приложения: `operation(db, *args)` выполняется через
+    `AsyncSession.run_sync()` на асинхронном движке реплики.
+    '''
+    replica = await replica_router.pick_async()
+    if replica is None:
+        return None
+
+    async with AsyncSession(replica_router.async_engine(replica)) as db:
+        try:
+            return await db.run_sync(operation, *args)
+        except OperationalError:
+            replica_router.mark_failed(replica)
+            logger.warning("Ошибка чтения с реплики %s.", replica.url.render_as_string(hide_password=True), exc_info=True)
+            return None
@@ -0,0 +1,975 @@
+'''
+Книга резервирований: удержания и отмены "горячих" счетов в памяти процесса.
+
+С `RESERVATION_BOOK_ENABLED` удержание горячего счета (см. hot_accounts.py) не обращается
+к базе данных: каждый процесс сервера держит для счета собственную книгу - слот счета
+с отрицательным номером, который процесс занимает сессионной advisory-блокировкой
+`pg_try_advisory_lock(account_id, slot)` на отдельном соединении. Свободный остаток слота
+книги учтен в `accounts.held_balance`, как у обычного слота, а процесс-владелец расходует его
+в памяти:
+1. удержание и отмена проверяют и изменяют свободный остаток книги под блокировкой потока,
+   добавляют запись в журнал упреждающей записи (WAL) книги и ждут fsync журнала. Один fsync
+   подтверждает все записи, добавленные к его началу, поэтому параллельные операции ждут общий
+   fsync (group commit);
+2. фоновый поток раз в `RESERVATION_BOOK_FLUSH_INTERVAL_MS` или по набору
+   `RESERVATION_BOOK_FLUSH_SIZE` операций записывает накопленные операции в базу данных одной
+   транзакцией: пакетный INSERT транзакций, увеличение `held` слота книги, журнал изменений
+   балансов. В той же транзакции в слот записывается номер последней перенесенной записи WAL
+   (`wal_lsn`), после чего файлы WAL этой записи удаляются;
+3. если свободного остатка книги не хватает, книга пополняется из доступного баланса счета
+   (`hot_accounts.fund_book()`) - это единственный случай, когда удержание ждет базу данных.
+   Если доступного баланса не хватает, удержание получает обычную ошибку о недостатке средств.
+
+Перераспределение слотов никогда не уменьшает свободный остаток слота книги, а списания
+и отмены других процессов его только увеличивают, поэтому остаток в памяти владельца не бывает
+больше остатка в базе данных, и баланс счета не может уйти в минус. После каждой записи в базу
+данных остаток в памяти выравнивается по слоту.
+
+Восстановление после падения процесса: процесс, занявший слот книги, сначала переносит в базу
+данных записи WAL слота с номером больше `wal_lsn` (удержания с уже существующим operation_id
+пропускаются). Поэтому каталог `RESERVATION_BOOK_WAL_DIR` должен быть общим для всех процессов,
+которые могут занять слот, - обычно это каталог на диске сервера, где работают все процессы.
+Оставшиеся от остановленных процессов книги переносит и освобождает
+`python run.py reservation-book --recover`.
+
+Операции других процессов: удержание книги попадает в базу данных с задержкой до
+`RESERVATION_BOOK_FLUSH_INTERVAL_MS`, а клиент уже получил ответ об успехе. Поэтому списание
+и отмена, не нашедшие удержание в базе данных, сначала ищут operation_id в сегментах WAL книг
+в общем каталоге (`await_operation()`). Если операция подтверждена книгой другого процесса,
+операция дожидается ее записи в базу данных этим процессом (не дольше `AWAIT_TIMEOUT` секунд),
+а если процесс-владелец уже не держит слот книги - переносит книгу в базу данных сама. WAL
+проверяется раньше базы данных: сегменты удаляются только после фиксации записи, поэтому
+подтвержденная операция всегда видна хотя бы в одном из них.
+
+Повтор удержания книга распознает в памяти, без обращения к диску и базе данных: по своим
+незаписанным операциям и по operation_id удержаний счета за последние `IDEMPOTENCY_TTL` секунд -
+загруженным из базы данных и WAL при занятии слота и принятым книгой после этого. Повтор уже
+записанной операции выполняется в базе данных, которая отвечает на него так же, как без книги.
+Удержание счета, о котором книга не знает, может принять только книга другого процесса, поэтому
+в WAL этих книг и в базе данных удержание ищет operation_id, только если у счета есть книги
+других процессов. Их список фоновый поток обновляет по каталогу WAL раз
+в `RESERVATION_BOOK_FLUSH_INTERVAL_MS`.
+
+Ограничения:
+- операции книги видны другим процессам в истории и балансе только после записи в базу данных;
+- удержание книги проверяет уникальность operation_id только среди удержаний своего счета.
+  Удержание с operation_id удержания другого счета, а также одновременные удержания с одним
+  operation_id в разных процессах, ни одно из которых еще не подтверждено (или подтвержденные
+  книгой, которую фоновый поток еще не увидел в каталоге WAL), книга принимает, и при записи
+  в базу данных такое удержание отбрасывается с ошибкой в логе
+  (`reservation_book_operations_total{operation="conflict"}`);
+- поиск в WAL работает, только если каталог `RESERVATION_BOOK_WAL_DIR` общий для всех процессов.
+'''
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from sqlalchemy import select, update, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.account_cache import AccountRef, get_account_ref
+from app.cache import LRUCache
+from app.balance_cache import project_balance
+from app.database import Accounts, AccountSlots, Transactions
+from app.db_session import engine, session, session_scope
+from app.hot_accounts import account_balances, fund_book, release_book
+from app.idempotency import idempotency_cache
+from app.ledger import journal
+from app.outbox import publish
+from app.metrics import registry, Counter, Histogram
+from app.settings import app_settings
+
+logger = logging.getLogger(__name__)
+
+'''
+Наибольшее количество книг одного счета, то есть процессов, одновременно удерживающих его средства
+в памяти. Книга с номером N занимает слот -N.
+'''
+BOOK_SLOTS = 64
+
+'''
+Наибольшее время ожидания записи в базу данных операции, подтвержденной книгой другого процесса, в секундах.
+'''
+AWAIT_TIMEOUT = 5.0
+
+book_operations_total = registry.register(Counter(
+    'reservation_book_operations_total', 'Количество операций книг резервирований по типам.', ('operation',)
+))
+book_flush_duration = registry.register(Histogram(
+    'reservation_book_flush_duration_seconds', 'Длительность записи операций книги в базу данных в секундах.', ()
+))
+
+
+class BookEntry:
+    __slots__ = ('operation_id', 'amount', 'description', 'created_at', 'lsn', 'status', 'cancelled_at', 'cancel_lsn')
+
+    def __init__(self, operation_id: str, amount: Decimal, description: str, created_at: datetime, lsn: int):
+        self.operation_id = operation_id
+        self.amount = amount
+        self.description = description
+        self.created_at = created_at
+        self.lsn = lsn
+        self.status = 'PENDING'
+        self.cancelled_at = None
+        self.cancel_lsn = None
+
+
+class WriteAheadLog:
+    '''
+    Журнал упреждающей записи одной книги: файлы-сегменты `<account_id>.<номер книги>.<сегмент>.wal`,
+    одна запись JSON в строке. Каждая запись в базу данных закрывает текущий сегмент (`rotate()`),
+    и после ее фиксации закрытые сегменты удаляются.
+    '''
+
+    def __init__(self, directory: str, account_id: int, book: int, fsync: bool):
+        self.directory = directory
+        self.prefix = f"{account_id}.{book}."
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.written = 0
+        self.synced = 0
+        os.makedirs(directory, exist_ok=True)
+        existing = self.segments()
+        self.sealed = [path for _, path in existing]
+        self.segment = existing[-1][0] + 1 if existing else 1
+        self._open()
+
+    @staticmethod
+    def books(directory: str) -> list:
+        '''
+        Выходные данные - список пар `(account_id, номер книги)`, для которых в каталоге есть сегменты.
+        '''
+        if not os.path.isdir(directory):
+            return []
+        found = set()
+        for name in os.listdir(directory):
+            parts = name.split('.')
+            if len(parts) == 4 and parts[3] == 'wal' and parts[0].isdigit() and parts[1].isdigit():
+                found.add((int(parts[0]), int(parts[1])))
+        return sorted(found)
+
+    @staticmethod
+    def find(directory: str, operation_ids, account_id: int = None, books=None) -> dict:
+        '''
+        Поиск операций `operation_ids` в сегментах WAL книг каталога (только книг счета `account_id`
+        и только книг с номерами `books`, если они указаны). Каждый сегмент читается один раз
+        для всех операций.
+
+        Выходные данные - словарь `{operation_id: (account_id, номер книги)}` найденных операций.
+        '''
+        found = {}
+        if not os.path.isdir(directory):
+            return found
+        needles = {
+            operation_id: json.dumps({"operation_id": operation_id})[1:-1].encode()
+            for operation_id in operation_ids
+        }
+        for name in os.listdir(directory):
+            parts = name.split('.')
+            if len(parts) != 4 or parts[3] != 'wal' or not parts[0].isdigit() or not parts[1].isdigit():
+                continue
+            if account_id is not None and int(parts[0]) != account_id:
+                continue
+            if books is not None and int(parts[1]) not in books:
+                continue
+            try:
+                with open(os.path.join(directory, name), 'rb') as file:
+                    content = file.read()
+            except FileNotFoundError:
+                '''
+                Сегмент удален после записи книги в базу данных.
+                '''
+                continue
+            for operation_id, needle in list(needles.items()):
+                if needle in content:
+                    found[operation_id] = (int(parts[0]), int(parts[1]))
+                    del needles[operation_id]
+            if not needles:
+                break
+        return found
+
+    def segments(self) -> list:
+        result = []
+        for name in os.listdir(self.directory):
+            if name.startswith(self.prefix) and name.endswith('.wal'):
+                number = name[len(self.prefix):-len('.wal')]
+                if number.isdigit():
+                    result.append((int(number), os.path.join(self.directory, name)))
+        return sorted(result)
+
+    def read(self) -> list:
+        '''
+        Все записи сегментов книги в порядке номеров. Недописанная последняя строка сегмента
+        (процесс упал до fsync, операция не была подтверждена) пропускается.
+        '''
+        records = []
+        for _, path in self.segments():
+            with open(path, encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        logger.warning("Пропущена недописанная запись WAL в %s.", path)
+        return sorted(records, key=lambda record: record["lsn"])
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{self.prefix}{segment:08d}.wal")
+
+    def _open(self):
+        self.file = open(self._path(self.segment), 'a', encoding='utf-8')
+        if self.fsync:
+            '''
+            Новый файл переживает сбой сервера, только если записан и каталог, в котором он создан.
+            '''
+            directory = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+
+    def append(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.written = record["lsn"]
+
+    def sync(self, lsn: int):
+        '''
+        Ожидание, пока запись `lsn` не будет записана на диск. Поток, получивший `sync_lock`,
+        выполняет один fsync для всех записей, добавленных к этому моменту; остальные потоки
+        находят свои записи уже записанными.
+        '''
+        if self.synced >= lsn:
+            return
+        with self.sync_lock:
+            if self.synced >= lsn:
+                return
+            with self.lock:
+                target = self.written
+                self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+            self.synced = target
+
+    def rotate(self) -> list:
+        '''
+        Закрытие текущего сегмента и начало следующего.
+
+        Выходные данные - все закрытые и еще не удаленные сегменты.
+        '''
+        with self.sync_lock, self.lock:
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+            self.file.close()
+            self.synced = self.written
+            self.sealed.append(self._path(self.segment))
+            self.segment += 1
+            self._open()
+            return list(self.sealed)
+
+    def remove(self, paths: list):
+        for path in paths:
+            os.remove(path)
+            self.sealed.remove(path)
+
+    def close(self):
+        with self.sync_lock, self.lock:
+            self.file.close()
+            if os.path.getsize(self._path(self.segment)) == 0:
+                os.remove(self._path(self.segment))
+
+
+class AccountBook:
+    '''
+    Книга одного счета в одном процессе.
+
+    - `free` - свободный остаток слота книги за вычетом операций, еще не записанных в базу данных;
+    - `pending` - операции, еще не записанные в базу данных, по operation_id;
+    - `flushing` - операции, которые записываются сейчас. Отмена такой операции ждет окончания
+      записи и выполняется в базе данных;
+    - `operations` - operation_id удержаний счета за `IDEMPOTENCY_TTL`: загруженные при занятии
+      слота и принятые книгой. Повтор такого удержания после записи выполняется в базе данных;
+    - `peers` - номера книг других процессов этого счета, в WAL которых удержание ищет operation_id.
+
+    `lock` защищает состояние в памяти, `db_lock` - очередность записи в базу данных и пополнений.
+    '''
+
+    def __init__(self, account, slot: int, wal: WriteAheadLog):
+        self.account = account
+        self.slot = slot
+        self.wal = wal
+        self.lock = threading.Lock()
+        self.flushed = threading.Condition(self.lock)
+        self.db_lock = threading.Lock()
+        self.free = Decimal('0.00')
+        self.lsn = 0
+        self.pending = {}
+        self.flushing = {}
+        self.operations = LRUCache(app_settings.idempotency_memory_size, app_settings.idempotency_ttl)
+        self.peers = set()
+        self.enabled = True
+        self.lost = False
+
+    def _unflushed(self) -> Decimal:
+        return sum((entry.amount for entry in self.pending.values() if entry.status == 'PENDING'), Decimal('0.00'))
+
+    def _result(self, entry: BookEntry, message: str) -> dict:
+        return {
+            "operation_id": entry.operation_id,
+            "account_id": self.account.account_number,
+            "amount": entry.amount,
+            "status": entry.status,
+            "message": message
+        }
+
+    def recover(self, records: list, wal_lsn: int, db_free: Decimal):
+        '''
+        Восстановление операций из записей WAL с номером больше `wal_lsn`, не перенесенных
+        в базу данных предыдущим владельцем слота.
+        '''
+        self.lsn = wal_lsn
+        for record in records:
+            self.lsn = max(self.lsn, record["lsn"])
+            if record["type"] == 'HOLD':
+                self.operations.set(record["operation_id"], True)
+            if record["lsn"] <= wal_lsn:
+                continue
+            if record["type"] == 'HOLD':
+                self.pending[record["operation_id"]] = BookEntry(
+                    record["operation_id"], Decimal(record["amount"]), record["description"],
+                    datetime.fromisoformat(record["created_at"]), record["lsn"]
+                )
+            elif record["type"] == 'CANCEL' and record["operation_id"] in self.pending:
+                entry = self.pending[record["operation_id"]]
+                entry.status = 'CANCELLED'
+                entry.cancelled_at = datetime.fromisoformat(record["created_at"])
+                entry.cancel_lsn = record["lsn"]
+        self.free = db_free - self._unflushed()
+        if self.pending:
+            logger.warning(
+                "Книга счета %s: восстановлено из WAL операций: %d.", self.account.account_number, len(self.pending)
+            )
+
+    def hold(self, operation_id: str, amount: Decimal, description: str):
+        '''
+        Удержание через книгу. Выходные данные - ответ как у services.hold_funds() или None,
+        если режим слотов для счета выключен или операция уже записана книгой в базу данных
+        (удержание выполняется в базе данных).
+        '''
+        for _ in range(10):
+            with self.lock:
+                entry = self.pending.get(operation_id) or self.flushing.get(operation_id)
+                if entry is not None:
+                    if entry.status != 'PENDING':
+                        raise ValueError(f"Операция с ID '{operation_id}' уже существует и имеет статус '{entry.status}'.")
+                    return self._result(entry, "Операция удержания с данным ID уже существует и активна.")
+                if not self.enabled or self.operations.get(operation_id) is not None:
+                    return None
+                if self.free >= amount:
+                    self.free -= amount
+                    self.lsn += 1
+                    entry = BookEntry(operation_id, amount, description, datetime.now(timezone.utc), self.lsn)
+                    self.pending[operation_id] = entry
+                    self.operations.set(operation_id, True)
+                    self.wal.append({
+                        "lsn": entry.lsn, "type": 'HOLD', "operation_id": operation_id, "amount": str(amount),
+                        "description": description, "created_at": entry.created_at.isoformat()
+                    })
+                    break
+            self._refill(amount)
+        else:
+            raise ValueError(f"Недостаточно средств на счету {self.account.account_number}. Доступно: {self.free}, запрошено: {amount}.")
+
+        self.wal.sync(entry.lsn)
+        book_operations_total.inc(('hold',))
+        result = self._result(entry, "Средства успешно удержаны.")
+        idempotency_cache.store(operation_id, 'hold', {**result, "message": "Операция удержания с данным ID уже существует и активна."})
+        return result
+
+    def cancel(self, operation_id: str):
+        '''
+        Отмена удержания, еще не записанного в базу данных. Выходные данные - ответ как
+        у services.cancel_hold() или None, если удержания в книге нет.
+        '''
+        with self.lock:
+            while operation_id in self.flushing:
+                self.flushed.wait()
+            entry = self.pending.get(operation_id)
+            if entry is None:
+                return None
+            if entry.status == 'CANCELLED':
+                return self._result(entry, "Средства по данной операции уже отменены.")
+            entry.status = 'CANCELLED'
+            entry.cancelled_at = datetime.now(timezone.utc)
+            self.lsn += 1
+            entry.cancel_lsn = self.lsn
+            self.free += entry.amount
+            self.wal.append({
+                "lsn": entry.cancel_lsn, "type": 'CANCEL', "operation_id": operation_id,
+                "created_at": entry.cancelled_at.isoformat()
+            })
+
+        self.wal.sync(entry.cancel_lsn)
+        book_operations_total.inc(('cancel',))
+        result = self._result(entry, "Удержание средств успешно отменено.")
+        idempotency_cache.forget(operation_id, 'hold')
+        idempotency_cache.store(operation_id, 'cancel', {**result, "message": "Средства по данной операции уже отменены."})
+        return result
+
+    def contains(self, operation_id: str) -> bool:
+        with self.lock:
+            return operation_id in self.pending or operation_id in self.flushing
+
+    def knows(self, operation_id: str) -> bool:
+        return self.contains(operation_id) or self.operations.get(operation_id) is not None
+
+    def _refill(self, amount: Decimal):
+        '''
+        Пополнение книги из доступного баланса счета. Операции книги на время пополнения
+        останавливаются: слот получает ровно сумму еще не записанных удержаний, `amount` и долю.
+        '''
+        with self.db_lock, self.lock:
+            if self.free >= amount or not self.enabled:
+                return
+            db = session()
+            try:
+                enabled = fund_book(db, self.account.id, self.slot, amount, self._unflushed())
+                db_free = self._db_free(db)
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+            book_operations_total.inc(('refill',))
+            if not enabled:
+                self.enabled = False
+            self.free = db_free - self._unflushed()
+
+    def _db_free(self, db) -> Decimal:
+        row = db.execute(
+            select(AccountSlots.reserved, AccountSlots.held, AccountSlots.charged)
+            .where(AccountSlots.account_id == self.account.id, AccountSlots.slot == self.slot)
+        ).one()
+        return row.reserved - row.held - row.charged
+
+    def flush(self) -> int:
+        '''
+        Запись накопленных операций в базу данных одной транзакцией.
+
+        Выходные данные - количество записанных операций. При ошибке операции возвращаются
+        в `pending` и записываются следующей попыткой; сегменты WAL остаются до успешной записи.
+        '''
+        with self.db_lock:
+            with self.lock:
+                if not self.pending:
+                    return 0
+                self.flushing, self.pending = self.pending, {}
+                entries = list(self.flushing.values())
+                last_lsn = self.lsn
+                segments = self.wal.rotate()
+
+            started = time.perf_counter()
+            try:
+                db_free, conflicts = self._write(entries, last_lsn)
+            except Exception:
+                with self.lock:
+                    self.pending = {**self.flushing, **self.pending}
+                    self.flushing = {}
+                    self.flushed.notify_all()
+                raise
+            with self.lock:
+                self.flushing = {}
+                self.free = db_free - self._unflushed()
+                self.flushed.notify_all()
+            book_flush_duration.observe((), time.perf_counter() - started)
+            self.wal.remove(segments)
+
+        for entry in conflicts:
+            book_operations_total.inc(('conflict',))
+            idempotency_cache.forget(entry.operation_id, 'hold')
+            logger.error(
+                "Книга счета %s: операция '%s' уже существует в базе данных, удержание %s отброшено.",
+                self.account.account_number, entry.operation_id, entry.amount
+            )
+        return len(entries)
+
+    def _write(self, entries: list, last_lsn: int) -> tuple:
+        db = session()
+        try:
+            inserted = {
+                str(transaction_id)
+                for transaction_id in db.scalars(
+                    pg_insert(Transactions)
+                    .values([
+                        {
+                            "transaction_id": entry.operation_id,
+                            "account_id": self.account.id,
+                            "transaction_type": 'HOLD',
+                            "transaction_date": entry.cancelled_at or entry.created_at,
+                            "amount": entry.amount,
+                            "description": entry.description,
+                            "transaction_status": entry.status,
+                            "hold_slot": self.slot
+                        }
+                        for entry in entries
+                    ])
+                    .on_conflict_do_nothing(index_elements=['transaction_id'])
+                    .returning(Transactions.transaction_id)
+                )
+            }
+            written = [entry for entry in entries if entry.operation_id in inserted]
+            conflicts = [entry for entry in entries if entry.operation_id not in inserted]
+            held = sum((entry.amount for entry in written if entry.status == 'PENDING'), Decimal('0.00'))
+
+            slot = db.execute(
+                update(AccountSlots)
+                .where(AccountSlots.account_id == self.account.id, AccountSlots.slot == self.slot)
+                .values(held=AccountSlots.held + held, wal_lsn=last_lsn)
+                .returning(AccountSlots.reserved, AccountSlots.held, AccountSlots.charged)
+                .execution_options(synchronize_session=False)
+            ).first()
+            if slot is None:
+                raise RuntimeError(f"Слот {self.slot} счета {self.account.account_number} не найден.")
+            account = account_balances(db, self.account.id)
+
+            '''
+            Журнал получает события в порядке WAL; удерживаемый баланс после каждого события
+            восстанавливается от значения после всей записи.
+            '''
+            events = [(entry.lsn, 'HOLD', entry) for entry in written]
+            events += [(entry.cancel_lsn, 'CANCEL', entry) for entry in written if entry.status == 'CANCELLED']
+            held_balance = account.held_balance - held
+            for _, entry_type, entry in sorted(events, key=lambda event: event[0]):
+                delta = entry.amount if entry_type == 'HOLD' else -entry.amount
+                held_balance += delta
+                journal(db, entry.operation_id, self.account.id, entry_type, entry.amount, Decimal('0.00'), delta, account.balance, held_balance)
+                publish(db, entry_type, entry.operation_id, self.account.id, entry.amount, account.balance, held_balance)
+            project_balance(db, account.account_number, account.currency, account.balance, account.held_balance)
+
+            db.commit()
+            return slot.reserved - slot.held - slot.charged, conflicts
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def close(self):
+        '''
+        Запись оставшихся операций и возврат свободного остатка книги в строку счета.
+        '''
+        self.flush()
+        with self.db_lock, self.lock:
+            self.enabled = False
+            if not self.lost:
+                db = session()
+                try:
+                    release_book(db, self.account.id, self.slot)
+                    db.commit()
+                except Exception:
+                    db.rollback()
+                    raise
+                finally:
+                    db.close()
+                self.free = Decimal('0.00')
+        self.wal.close()
+
+
+class ReservationBook:
+    '''
+    Книги всех горячих счетов процесса и фоновый поток записи в базу данных.
+    '''
+
+    def __init__(self, directory: str, fsync: bool, flush_interval: float, flush_size: int):
+        self.directory = directory
+        self.fsync = fsync
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.lock = threading.Lock()
+        self.books = {}
+        self.by_number = {}
+        self.lease = None
+        self.thread = None
+        self.pid = None
+        self.wakeup = threading.Event()
+        self.stopping = False
+
+    def _ensure_started(self):
+        '''
+        Поток и соединение блокировок создаются при первой операции в каждом процессе:
+        ни потоки, ни соединения не переходят в дочерние процессы при fork (см. server.py).
+        '''
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.books = {}
+            self.by_number = {}
+            self.lease = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+            self.stopping = False
+            self.thread = threading.Thread(target=self._run, name='reservation-book', daemon=True)
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def _try_lock(self, account_id: int, slot: int) -> bool:
+        return self.lease.execute(text("SELECT pg_try_advisory_lock(:account_id, :slot)"), {"account_id": account_id, "slot": slot}).scalar()
+
+    def _unlock(self, account_id: int, slot: int):
+        self.lease.execute(text("SELECT pg_advisory_unlock(:account_id, :slot)"), {"account_id": account_id, "slot": slot})
+
+    def _open(self, account, numbers) -> AccountBook:
+        '''
+        Занятие первого свободного слота книги из номеров `numbers` и восстановление его операций из WAL.
+        Вызывается под `self.lock`.
+        '''
+        for number in numbers:
+            if self._try_lock(account.id, -number):
+                break
+        else:
+            return None
+
+        slot = -number
+        db = session()
+        try:
+            db.execute(
+                pg_insert(AccountSlots)
+                .values(account_id=account.id, slot=slot, reserved=0, held=0, charged=0, wal_lsn=0)
+                .on_conflict_do_nothing(constraint='uq_account_slots_account_id_slot')
+            )
+            row = db.execute(
+                select(AccountSlots.reserved, AccountSlots.held, AccountSlots.charged, AccountSlots.wal_lsn)
+                .where(AccountSlots.account_id == account.id, AccountSlots.slot == slot)
+            ).one()
+            recent = db.scalars(
+                select(Transactions.transaction_id)
+                .where(
+                    Transactions.account_id == account.id,
+                    Transactions.transaction_type == 'HOLD',
+                    Transactions.transaction_date > datetime.now(timezone.utc) - timedelta(seconds=app_settings.idempotency_ttl)
+                )
+                .order_by(Transactions.transaction_date.desc(), Transactions.id.desc())
+                .limit(app_settings.idempotency_memory_size)
+            ).all()
+            db.commit()
+        except Exception:
+            db.rollback()
+            self._unlock(account.id, slot)
+            raise
+        finally:
+            db.close()
+
+        wal = WriteAheadLog(self.directory, account.id, number, self.fsync)
+        book = AccountBook(account, slot, wal)
+        book.peers = {other for account_id, other in WriteAheadLog.books(self.directory) if account_id == account.id and other != number}
+        for operation_id in reversed(recent):
+            book.operations.set(str(operation_id), True)
+        book.recover(wal.read(), row.wal_lsn or 0, row.reserved - row.held - row.charged)
+        book.flush()
+        if not book.pending and wal.sealed:
+            wal.remove(list(wal.sealed))
+        return book
+
+    def _book(self, account_identifier: str):
+        '''
+        Книга счета: уже открытая книга находится по номеру счета без обращения к кэшу счетов.
+        '''
+        if self.pid == os.getpid():
+            book = self.by_number.get(account_identifier)
+            if book is not None:
+                return book
+
+        with session_scope() as db:
+            account = get_account_ref(db, account_identifier)
+        if account is None or not account.hold_slots:
+            return None
+
+        self._ensure_started()
+        book = self.books.get(account.id)
+        if book is None and account.id not in self.books:
+            with self.lock:
+                if account.id not in self.books:
+                    self.books[account.id] = self._open(account, range(1, BOOK_SLOTS + 1))
+                book = self.books[account.id]
+        if book is not None:
+            self.by_number[account_identifier] = book
+        return book
+
+    def hold(self, operation_id: str, account_identifier: str, amount: Decimal, description: str):
+        '''
+        Удержание через книгу счета `account_identifier`.
+
+        Выходные данные - ответ как у services.hold_funds() или None, если счет не горячий,
+        не найден или все слоты книг счета заняты другими процессами: удержание выполняется
+        в базе данных.
+
+        Ошибки:
+        - `ValueError` - недостаточно средств; operation_id принадлежит отмененному удержанию книги.
+        '''
+        book = self._book(account_identifier)
+        if book is None:
+            return None
+        if book.peers and not book.knows(operation_id) and (
+            self.await_operations([operation_id], book.account.id, book.peers) or self._recorded(operation_id)
+        ):
+            '''
+            Операция уже подтверждена книгой другого процесса: удержание выполняется в базе данных,
+            которая ответит на повтор так же, как без книги.
+            '''
+            return None
+        result = book.hold(operation_id, amount, description)
+        if result is not None and len(book.pending) >= self.flush_size:
+            self.wakeup.set()
+        return result
+
+    def cancel(self, operation_id: str):
+        '''
+        Отмена удержания, еще не записанного в базу данных книгой этого процесса.
+
+        Выходные данные - ответ как у services.cancel_hold() или None, если отмену нужно
+        выполнить в базе данных.
+        '''
+        if self.pid != os.getpid():
+            return None
+        for book in list(self.books.values()):
+            if book is not None:
+                result = book.cancel(operation_id)
+                if result is not None:
+                    return result
+        return None
+
+    def flush_operation(self, *operation_ids: str):
+        '''
+        Запись в базу данных книг, в которых есть операции `operation_ids`, - перед операциями,
+        которые ищут удержание в базе данных (списание).
+        '''
+        if self.pid != os.getpid():
+            return
+        for book in list(self.books.values()):
+            if book is not None and any(book.contains(operation_id) for operation_id in operation_ids):
+                book.flush()
+
+    def await_operation(self, operation_id: str, account_id: int = None) -> bool:
+        '''
+        Ожидание записи в базу данных операции `operation_id`, подтвержденной книгой этого или
+        другого процесса (см. описание модуля), - перед поиском удержания в базе данных.
+
+        Входные аргументы:
+        - `operation_id` - идентификатор операции;
+        - `account_id` - искать только в книгах этого счета.
+
+        Выходные данные - True, если операция найдена в книге.
+        '''
+        return bool(self.await_operations([operation_id], account_id))
+
+    def await_operations(self, operation_ids: list, account_id: int = None, books=None) -> set:
+        '''
+        То же, что await_operation(), для нескольких операций (пакетное удержание): сегменты WAL
+        читаются один раз для всех операций. `books` - искать только в книгах с этими номерами.
+
+        Выходные данные - множество операций, найденных в книгах.
+        '''
+        self.flush_operation(*operation_ids)
+        found = WriteAheadLog.find(self.directory, operation_ids, account_id, books)
+        for operation_id, (book_account_id, number) in found.items():
+            self._await_recorded(operation_id, book_account_id, number)
+        return set(found)
+
+    def _await_recorded(self, operation_id: str, book_account_id: int, number: int):
+        '''
+        Ожидание записи операции книги `number` счета `book_account_id` в базу данных или,
+        если процесс-владелец уже не держит слот книги, перенос книги в базу данных.
+        '''
+        deadline = time.monotonic() + AWAIT_TIMEOUT
+        while not self._recorded(operation_id):
+            with session_scope() as db:
+                owned = db.scalar(
+                    text(
+                        "SELECT EXISTS (SELECT 1 FROM pg_locks WHERE locktype = 'advisory' AND objsubid = 2 "
+                        "AND classid::bigint = :account_id AND objid::bigint = :slot)"
+                    ),
+                    {"account_id": book_account_id, "slot": -number & 0xFFFFFFFF}
+                )
+            if not owned:
+                '''
+                Процесс-владелец остановлен, не записав книгу.
+                '''
+                with session_scope() as db:
+                    account = self._account_refs(db, [book_account_id]).get(book_account_id)
+                if account is not None:
+                    self._ensure_started()
+                    self._recover_book(account, number)
+                break
+            if time.monotonic() >= deadline:
+                logger.warning("Операция '%s' книги счета %d не записана в базу данных за %s с.", operation_id, book_account_id, AWAIT_TIMEOUT)
+                break
+            time.sleep(min(self.flush_interval, 0.01))
+        book_operations_total.inc(('await',))
+
+    def _recorded(self, operation_id: str) -> bool:
+        with session_scope() as db:
+            return db.scalar(select(Transactions.transaction_id).where(Transactions.transaction_id == operation_id)) is not None
+
+    def flush(self) -> int:
+        if self.pid != os.getpid():
+            return 0
+        flushed = 0
+        for book in list(self.books.values()):
+            if book is not None:
+                flushed += book.flush()
+        return flushed
+
+    def _check_lease(self):
+        '''
+        Проверка, что соединение блокировок живо и все слоты книг по-прежнему заняты этим процессом.
+        Книга, потерявшая слот, перестает принимать операции: слот мог занять другой процесс.
+        '''
+        books = [book for book in list(self.books.values()) if book is not None and not book.lost]
+        if not books:
+            return
+        try:
+            with self.lock:
+                held = {
+                    (row.classid, row.objid)
+                    for row in self.lease.execute(text(
+                        "SELECT classid::bigint AS classid, objid::bigint AS objid FROM pg_locks "
+                        "WHERE locktype = 'advisory' AND objsubid = 2 AND pid = pg_backend_pid()"
+                    ))
+                }
+        except Exception:
+            logger.error("Соединение блокировок книг резервирований потеряно.", exc_info=True)
+            held = set()
+        for book in books:
+            if (book.account.id, book.slot & 0xFFFFFFFF) not in held:
+                logger.error("Книга счета %s потеряла слот %d.", book.account.account_number, book.slot)
+                with book.lock:
+                    book.enabled = False
+                    book.lost = True
+
+    def _refresh_peers(self):
+        '''
+        Обновление списков книг других процессов у открытых книг по сегментам WAL в каталоге.
+        '''
+        books = WriteAheadLog.books(self.directory)
+        for book in list(self.books.values()):
+            if book is not None:
+                book.peers = {number for account_id, number in books if account_id == book.account.id and number != -book.slot}
+
+    def _run(self):
+        while not self.stopping:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self._check_lease()
+            self._refresh_peers()
+            for account_id, book in list(self.books.items()):
+                if book is None:
+                    continue
+                try:
+                    book.flush()
+                    if not book.enabled and not book.pending:
+                        '''
+                        Режим слотов счета выключен: остаток книги возвращается счету.
+                        '''
+                        book.close()
+                        with self.lock:
+                            if not book.lost:
+                                self._unlock(account_id, book.slot)
+                            del self.books[account_id]
+                            self.by_number = {number: item for number, item in self.by_number.items() if item is not book}
+                except Exception:
+                    logger.error("Ошибка записи книги счета %s.", book.account.account_number, exc_info=True)
+
+    def stop(self):
+        '''
+        Остановка книг процесса: запись операций, возврат свободных остатков счетам, освобождение слотов.
+        '''
+        if self.pid != os.getpid():
+            return
+        self.stopping = True
+        self.wakeup.set()
+        self.thread.join()
+        with self.lock:
+            for account_id, book in list(self.books.items()):
+                if book is None:
+                    continue
+                try:
+                    book.close()
+                    if not book.lost:
+                        self._unlock(account_id, book.slot)
+                except Exception:
+                    logger.error("Не удалось остановить книгу счета %s.", book.account.account_number, exc_info=True)
+            self.books = {}
+            self.by_number = {}
+            self.lease.close()
+            self.pid = None
+
+    def recover(self) -> int:
+        '''
+        Перенос в базу данных и освобождение книг, оставшихся от остановленных процессов:
+        книг с сегментами WAL в каталоге и слотов книг со свободным остатком, которые не заняты
+        ни одним процессом. Должна выполняться там же, где работают процессы сервера, - с тем же
+        каталогом WAL.
+
+        Выходные данные - количество освобожденных книг.
+        '''
+        self._ensure_started()
+        db = session()
+        try:
+            candidates = set(WriteAheadLog.books(self.directory))
+            candidates.update(
+                (row.account_id, -row.slot)
+                for row in db.execute(
+                    select(AccountSlots.account_id, AccountSlots.slot)
+                    .where(AccountSlots.slot < 0, AccountSlots.reserved - AccountSlots.held - AccountSlots.charged != 0)
+                )
+            )
+            accounts = self._account_refs(db, {account_id for account_id, _ in candidates})
+        finally:
+            db.close()
+
+        recovered = 0
+        for account_id, number in sorted(candidates):
+            account = accounts.get(account_id)
+            if account is None or account_id in self.books:
+                continue
+            if self._recover_book(account, number):
+                recovered += 1
+        return recovered
+
+    @staticmethod
+    def _account_refs(db, account_ids) -> dict:
+        return {
+            row.id: AccountRef(row.id, str(row.account_number), row.currency, row.client_id, row.hold_slots)
+            for row in db.execute(
+                select(Accounts.id, Accounts.account_number, Accounts.currency, Accounts.client_id, Accounts.hold_slots)
+                .where(Accounts.id.in_(account_ids))
+            )
+        }
+
+    def _recover_book(self, account, number: int) -> bool:
+        '''
+        Перенос в базу данных и освобождение книги `number` счета, если ее слот не занят ни одним процессом.
+        '''
+        with self.lock:
+            book = self._open(account, [number])
+        if book is None:
+            return False
+        book.close()
+        with self.lock:
+            self._unlock(account.id, book.slot)
+        return True
+
+
+reservation_book = ReservationBook(
+    app_settings.reservation_book_wal_dir,
+    app_settings.reservation_book_fsync,
+    app_settings.reservation_book_flush_interval_ms / 1000,
+    app_settings.reservation_book_flush_size
+)
+atexit.register(reservation_book.stop)
@@ -1,12 +1,32 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request
 from app.services import (
     get_welcome_message, 
     get_example_data,
     process_charge_funds,
     process_hold_funds,
     process_cancel_hold,
-    process_refund_funds
+    process_refund_funds,
+    process_hold_funds_batch
+)
+from app.schemas import (
+    validate_operation_id,
+    validate_account_number,
+    load_hold_request,
+    load_refund_request,
+    load_history_query,
+    validate_settlement_id,
+    load_settlement_request
 )
+from app.account_cache import get_account_ref
+from app.balance_cache import get_balance
+from app.history import get_history_page, stream_history
+from app.settlement import settle, get_settlement_report
+
+from app.db_session import get_pool_stats
+from app.replicas import run_read, replica_router
+from app.settings import app_settings
+from app import metrics
+from app.sql_profiler import sql_profiler
 
 bp = Blueprint('main', __name__)
 
@@ -26,6 +46,7 @@ def example_endpoint():
     return jsonify({'data': data})
 
 @bp.route('/api/operation/<string:operation_id>/hold', methods=['POST'])
+@metrics.instrument('hold')
 def hold_funds_endpoint(operation_id: str):
     '''
     Эндпоинт для удержания средств на счету.
@@ -41,27 +62,23 @@ def hold_funds_endpoint(operation_id: str):
         - 400 - ошибка в запросе;
         - 500 - другая ошибка.
     
-    Сперва ведется проверка входных данных. После успешной проверки выполняется удержание требуемого значения на счету.
+    Сперва ведется проверка входных данных (см. schemas.py). После успешной проверки выполняется удержание требуемого значения на счету.
     '''
 
-    data = request.get_json()
+    with metrics.stage('json_parse'):
+        data = request.get_json(silent=True)
 
-    if not data:
-        return jsonify({'message': 'Требуется JSON-тело запроса.'}), 400
-    if 'account_identifier' not in data or not data['account_identifier']:
-        return jsonify({'message': 'Поле "account_identifier" обязательно.'}), 400
-    if 'amount' not in data or not isinstance(data['amount'], (int, float)):
-        return jsonify({'message': 'Поле "amount" обязательно и должно быть числом.'}), 400
-    if 'description' not in data or not data['description']:
-        return jsonify({'message': 'Поле "description" обязательно.'}), 400
-
-    account_identifier = data['account_identifier']
-    amount = float(data['amount'])
-    description = data['description']
+    try:
+        operation_id = validate_operation_id(operation_id)
+        account_identifier, amount, description = load_hold_request(data)
+    except ValueError as e:
+        metrics.mark('validation_error')
+        return jsonify({'message': str(e)}), 400
 
     try:
         result = process_hold_funds(operation_id, account_identifier, amount, description)
         if "Операция удержания с данным ID уже существует" in result.get("message", ""):
+            metrics.mark('replay')
             return jsonify(result), 200
         else:
             return jsonify(result), 201
@@ -72,6 +89,7 @@ def hold_funds_endpoint(operation_id: str):
         return jsonify({'message': 'Произошла внутренняя ошибка сервера.', 'error': str(e)}), 500
 
 @bp.route('/api/operation/<string:operation_id>/charge', methods=['POST'])
+@metrics.instrument('charge')
 def charge_funds_endpoint(operation_id: str):
     '''
     Эндпоинт для списания (завершения) ранее удержанных средств.
@@ -87,9 +105,16 @@ def charge_funds_endpoint(operation_id: str):
         - 500 - другая ошибка.
     '''
 
+    try:
+        operation_id = validate_operation_id(operation_id)
+    except ValueError as e:
+        metrics.mark('validation_error')
+        return jsonify({'message': str(e)}), 400
+
     try:
         result = process_charge_funds(operation_id)
         if "Средства по данной операции уже списаны." in result.get("message", ""):
+            metrics.mark('replay')
             return jsonify(result), 200
         else:
             return jsonify(result), 200
@@ -100,6 +125,7 @@ def charge_funds_endpoint(operation_id: str):
         return jsonify({'message': 'Произошла внутренняя ошибка сервера.', 'error': str(e)}), 500
 
 @bp.route('/api/operation/<string:operation_id>/cancel', methods=['POST'])
+@metrics.instrument('cancel')
 def cancel_hold_endpoint(operation_id: str):
     '''
     Эндпоинт для отмены ранее удержанных средств.
@@ -114,10 +140,18 @@ def cancel_hold_endpoint(operation_id: str):
         - 400 - ошибка в запросе;
         - 500 - другая ошибка.
     '''
+
+    try:
+        operation_id = validate_operation_id(operation_id)
+    except ValueError as e:
+        metrics.mark('validation_error')
+        return jsonify({'message': str(e)}), 400
+
     try:
         result = process_cancel_hold(operation_id)
         
         if "Средства по данной операции уже отменены." in result.get("message", ""):
+            metrics.mark('replay')
             return jsonify(result), 200
         else:
             return jsonify(result), 200 
@@ -128,6 +162,7 @@ def cancel_hold_endpoint(operation_id: str):
         return jsonify({'message': 'Произошла внутренняя ошибка сервера.', 'error': str(e)}), 500
 
 @bp.route('/api/operation/<string:operation_id>/refund', methods=['POST'])
+@metrics.instrument('refund')
 def refund_funds_endpoint(operation_id: str):
     '''
     Эндпоинт для возврата средств.
@@ -144,13 +179,20 @@ def refund_funds_endpoint(operation_id: str):
         - 500 - другая ошибка.
     '''
 
-    data = request.get_json() or {}
+    with metrics.stage('json_parse'):
+        data = request.get_json(silent=True)
 
-    description = data.get('description', "Возврат средств")
+    try:
+        operation_id = validate_operation_id(operation_id)
+        description = load_refund_request(data)
+    except ValueError as e:
+        metrics.mark('validation_error')
+        return jsonify({'message': str(e)}), 400
 
     try:
         result = process_refund_funds(operation_id, description)
         if "Средства по данной операции уже были возвращены." in result.get("message", ""):
+            metrics.mark('replay')
             return jsonify(result), 200
         else:
             return jsonify(result), 201
@@ -159,3 +201,275 @@ def refund_funds_endpoint(operation_id: str):
         return jsonify({'message': str(e)}), 400
     except Exception as e:
         return jsonify({'message': 'Произошла внутренняя ошибка сервера.', 'error': str(e)}), 500
+
+
+@bp.route('/api/operations/hold:batch', methods=['POST'])
+@metrics.instrument('hold_batch')
+def hold_funds_batch_endpoint():
+    '''
+    Эндпоинт для пакетного удержания средств.
+
+    Входные данные - JSON-массив объектов:
+    - `operation_id` - UUID;
+    - `account_identifier` - UUID счета;
+    - `amount` - сумма удержания;
+    - `description` - описание удержания.
+
+    Выходные данные:
+    - JSON-ответ (см. services.py - process_hold_funds_batch());
+    - Код ответа:
+        - 200 - пакет обработан, результат каждого элемента указан в его поле `code`;
+        - 400 - ошибка в запросе;
+        - 500 - другая ошибка.
+    '''
+
+    with metrics.stage('json_parse'):
+        data = request.get_json(silent=True)
+
+    if not isinstance(data, list) or not data:
+        metrics.mark('validation_error')
+        return jsonify({'message': 'Требуется JSON-массив операций.'}), 400
+
+    try:
+        result = process_hold_funds_batch(data)
+        return jsonify(result), 200
+
+    except ValueError as e:
+        metrics.mark('validation_error')
+        return jsonify({'message': str(e)}), 400
+    except Exception as e:
+        return jsonify({'message': 'Произошла внутренняя ошибка сервера.', 'error': str(e)}), 500
+
+
+@bp.route('/api/settlements/<string:settlement_id>', methods=['POST'])
+@metrics.instrument('settlement')
+def settlement_endpoint(settlement_id: str):
+    '''
+    Эндпоинт для пакетного списания удержаний (см. settlement.py).
+
+    Входные данные - JSON-объект с одним из полей:
+    - `operation_ids` - список UUID удержаний;
+    - `account_identifier` - UUID счета: списываются все его удержания в статусе PENDING,
+      созданные раньше `created_before` (ISO 8601, необязательно).
+
+    Повторный запрос с тем же `settlement_id` продолжает обработку прерванного пакета
+    (тело запроса при этом не требуется и не учитывается) и возвращает отчет.
+
+    Выходные данные:
+    - JSON-ответ (см. settlement.py - settlement_report());
+    - Код ответа:
+        - 200 - пакет уже существовал;
+        - 201 - пакет создан и обработан;
+        - 400 - ошибка в запросе;
+        - 404 - пакета нет, а тело запроса не передано;
+        - 500 - другая ошибка.
+    '''
+
+    with metrics.stage('json_parse'):
+        data = request.get_json(silent=True)
+
+    try:
+        settlement_id = validate_settlement_id(settlement_id)
+        settlement_request = load_settlement_request(data) if data else None
+    except ValueError as e:
+        metrics.mark('validation_error')
+        return jsonify({'message': str(e)}), 400
+
+    try:
+        account_id = None
+        if settlement_request is None:
+            if get_settlement_report(settlement_id, items=False) is None:
+                return jsonify({'message': f"Пакетное списание с ID '{settlement_id}' не найдено."}), 404
+        elif settlement_request["account_identifier"] is not None:
+            account = run_read(get_account_ref, settlement_request["account_identifier"])
+            if account is None:
+                raise ValueError(f"Счет с номером '{settlement_request['account_identifier']}' не найден.")
+            account_id = account.id
+
+        created, _ = settle(
+            settlement_id,
+            settlement_request["operation_ids"] if settlement_request else None,
+            account_id,
+            settlement_request["created_before"] if settlement_request else None
+        )
+        return jsonify(get_settlement_report(settlement_id)), 201 if created else 200
+
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    except Exception as e:
+        return jsonify({'message': 'Произошла внутренняя ошибка сервера.', 'error': str(e)}), 500
+
+
+@bp.route('/api/settlements/<string:settlement_id>', methods=['GET'])
+def settlement_report_endpoint(settlement_id: str):
+    '''
+    Эндпоинт с отчетом по пакетному списанию.
+
+    Выходные данные:
+    - JSON-ответ (см. settlement.py - settlement_report());
+    - Код ответа:
+        - 200 - отчет;
+        - 400 - ошибка в запросе;
+        - 404 - пакет не найден.
+    '''
+
+    try:
+        settlement_id = validate_settlement_id(settlement_id)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    report = get_settlement_report(settlement_id)
+    if report is None:
+        return jsonify({'message': f"Пакетное списание с ID '{settlement_id}' не найдено."}), 404
+    return jsonify(report), 200
+
+
+@bp.route('/api/account/<string:account_number>/transactions', methods=['GET'])
+@metrics.instrument('history')
+def account_history_endpoint(account_number: str):
+    '''
+    Эндпоинт с историей операций счета (см. history.py).
+
+    Параметры запроса:
+    - `type` - типы операций через запятую (HOLD, REFUND);
+    - `status` - статусы операций через запятую (PENDING, COMPLETED, CANCELLED, EXPIRED);
+    - `from`, `to` - интервал дат операций `[from, to)` в формате ISO 8601;
+    - `order` - desc (сначала новые, по умолчанию) или asc;
+    - `limit` - количество операций на странице;
+    - `cursor` - курсор следующей страницы из предыдущего ответа;
+    - `format` - `ndjson` для выгрузки всех операций потоком (также по заголовку `Accept: application/x-ndjson`).
+
+    Выходные данные:
+    - JSON-ответ (см. history.py - get_history_page()) или NDJSON, одна операция в строке;
+    - Код ответа:
+        - 200 - запрос выполнен;
+        - 400 - ошибка в запросе;
+        - 404 - счет не найден;
+        - 500 - другая ошибка.
+    '''
+
+    stream = (
+        request.args.get('format') == 'ndjson'
+        or request.accept_mimetypes.best == 'application/x-ndjson'
+    )
+
+    try:
+        account_number = validate_account_number(account_number)
+        filters = load_history_query(request.args, stream=stream)
+    except ValueError as e:
+        metrics.mark('validation_error')
+        return jsonify({'message': str(e)}), 400
+
+    try:
+        account = run_read(get_account_ref, account_number)
+        if account is None:
+            return jsonify({'message': f"Счет '{account_number}' не найден."}), 404
+
+        if stream:
+            return Response(stream_history(account.id, filters), mimetype='application/x-ndjson')
+        return jsonify(run_read(get_history_page, account.id, filters)), 200
+
+    except ValueError as e:
+        metrics.mark('validation_error')
+        return jsonify({'message': str(e)}), 400
+    except Exception as e:
+        return jsonify({'message': 'Произошла внутренняя ошибка сервера.', 'error': str(e)}), 500
+
+
+@bp.route('/api/account/<string:account_number>/balance', methods=['GET'])
+@metrics.instrument('balance')
+def account_balance_endpoint(account_number: str):
+    '''
+    Эндпоинт с балансом счета (см. balance_cache.py).
+
+    Доступный баланс - ориентир перед удержанием: значение может отставать от базы данных
+    до `BALANCE_CACHE_TTL` секунд, а достаточность средств проверяется самим удержанием.
+
+    Выходные данные:
+    - JSON-ответ (см. balance_cache.py - get_balance());
+    - Код ответа:
+        - 200 - запрос выполнен;
+        - 400 - ошибка в запросе;
+        - 404 - счет не найден;
+        - 500 - другая ошибка.
+    '''
+
+    try:
+        account_number = validate_account_number(account_number)
+    except ValueError as e:
+        metrics.mark('validation_error')
+        return jsonify({'message': str(e)}), 400
+
+    try:
+        result = get_balance(account_number)
+        if result is None:
+            return jsonify({'message': f"Счет '{account_number}' не найден."}), 404
+        return jsonify(result), 200
+
+    except Exception as e:
+        return jsonify({'message': 'Произошла внутренняя ошибка сервера.', 'error': str(e)}), 500
+
+
+@bp.route('/api/admin/pool', methods=['GET'])
+def pool_stats_endpoint():
+    '''
+    Эндпоинт со статистикой пула соединений с базой данных и состоянием реплик.
+
+    Выходные данные:
+    - JSON-ответ (см. db_session.py - get_pool_stats()) с дополнительным полем `replicas`
+      (см. replicas.py - ReplicaRouter.stats());
+    - Код ответа 200.
+    '''
+
+    return jsonify({**get_pool_stats(), "replicas": replica_router.stats()}), 200
+
+
+
+@bp.route('/api/admin/sql-profile', methods=['GET', 'DELETE'])
+def sql_profile_endpoint():
+    '''
+    Эндпоинт с профилем SQL-запросов (см. sql_profiler.py).
+
+    Параметры запроса (GET):
+    - `limit` - количество запросов в отчете, по умолчанию 20;
+    - `order` - порядок сортировки: total, calls, max или avg, по умолчанию total.
+
+    DELETE сбрасывает накопленную статистику.
+
+    Выходные данные:
+    - JSON-ответ (см. sql_profiler.py - SqlProfiler.report());
+    - Код ответа:
+        - 200 - отчет;
+        - 400 - ошибка в параметрах;
+        - 404 - профилирование выключено (`SQL_PROFILE=false`).
+    '''
+
+    if sql_profiler is None:
+        return jsonify({'message': 'Профилирование SQL-запросов выключено.'}), 404
+
+    if request.method == 'DELETE':
+        sql_profiler.reset()
+        return jsonify({'message': 'Статистика SQL-запросов сброшена.'}), 200
+
+    try:
+        limit = int(request.args.get('limit', 20))
+        return jsonify(sql_profiler.report(limit, request.args.get('order', 'total'))), 200
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+
+@bp.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    '''
+    Эндпоинт с метриками в текстовом формате Prometheus (см. metrics.py).
+
+    Выходные данные:
+    - Код ответа:
+        - 200 - метрики;
+        - 404 - сбор метрик выключен (`METRICS_ENABLED=false`).
+    '''
+
+    if not app_settings.metrics_enabled:
+        return jsonify({'message': 'Сбор метрик выключен.'}), 404
+
+    return metrics.expose(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
\ No newline at end of file
@@ -0,0 +1,360 @@
+'''
+Проверка входных данных эндпоинтов операций.
+
+Проверка выполняется до обращения к сервисам, поэтому запрос с некорректным
+operation_id, счетом или суммой получает ответ 400 без открытия сессии и без
+получения соединения из пула.
+
+Схемы marshmallow создаются один раз при импорте модуля. Для типичного корректного
+запроса используется быстрая проверка без схемы: типы полей сравниваются напрямую,
+UUID проверяются заранее скомпилированным регулярным выражением. Если быстрая проверка
+не прошла, запрос проверяется схемой, которая формирует сообщение об ошибке.
+
+Все функции при ошибке выбрасывают `ValueError` с сообщением для клиента. Ошибки
+`decimal` при разборе суммы (`ArithmeticError`) тоже приводятся к `ValueError`, чтобы
+некорректная сумма не превращалась в ответ 500.
+'''
+import re
+from datetime import datetime, timezone
+from decimal import Decimal
+from marshmallow import Schema, ValidationError, fields, validate, EXCLUDE
+from app.money import to_money, is_money_number
+from app.settings import app_settings
+
+UUID_PATTERN = re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$')
+
+_AMOUNT_TYPES = (int, Decimal)
+
+TRANSACTION_TYPES = ('HOLD', 'REFUND')
+TRANSACTION_STATUSES = ('PENDING', 'HELD', 'COMPLETED', 'CANCELLED', 'EXPIRED')
+
+
+class UUIDString(fields.Field):
+    '''
+    UUID в каноническом виде. Результат - строка в нижнем регистре.
+    '''
+
+    def __init__(self, invalid: str, **kwargs):
+        super().__init__(**kwargs)
+        self.invalid = invalid
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        if value == '':
+            raise self.make_error('required')
+        if not isinstance(value, str) or not UUID_PATTERN.match(value):
+            raise ValidationError(self.invalid.format(input=value))
+        return value.lower()
+
+
+class Money(fields.Field):
+    '''
+    Денежная сумма (см. money.py - to_money()). Принимаются только целые числа и числа
+    с дробной частью из JSON (Decimal), но не строки и не логические значения.
+    '''
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        if not is_money_number(value):
+            raise self.make_error('required')
+        try:
+            return to_money(value)
+        except (ValueError, ArithmeticError) as e:
+            raise ValidationError(str(e) or "Сумма должна быть числом.")
+
+
+def _required(message: str) -> dict:
+    return {'required': message, 'null': message}
+
+
+class HoldRequestSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    account_identifier = UUIDString(
+        required=True,
+        invalid='Поле "account_identifier" должно быть UUID.',
+        error_messages=_required('Поле "account_identifier" обязательно.')
+    )
+    amount = Money(
+        required=True,
+        validate=validate.Range(min=0, min_inclusive=False, error="Сумма удержания должна быть положительной."),
+        error_messages=_required('Поле "amount" обязательно и должно быть числом.')
+    )
+    description = fields.String(
+        required=True,
+        validate=validate.Length(min=1, error='Поле "description" обязательно.'),
+        error_messages={**_required('Поле "description" обязательно.'), 'invalid': 'Поле "description" должно быть строкой.'}
+    )
+
+
+class BatchHoldItemSchema(HoldRequestSchema):
+    operation_id = UUIDString(
+        required=True,
+        invalid="Идентификатор операции '{input}' не является UUID.",
+        error_messages=_required('Поле "operation_id" обязательно.')
+    )
+
+    class Meta:
+        unknown = EXCLUDE
+        fields = ('operation_id', 'account_identifier', 'amount', 'description')
+
+
+class RefundRequestSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    description = fields.String(
+        load_default="Возврат средств",
+        error_messages={'invalid': 'Поле "description" должно быть строкой.', 'null': 'Поле "description" должно быть строкой.'}
+    )
+
+
+hold_request_schema = HoldRequestSchema()
+batch_hold_item_schema = BatchHoldItemSchema()
+refund_request_schema = RefundRequestSchema()
+
+
+def _load(schema: Schema, data) -> dict:
+    '''
+    Проверка `data` схемой. Сообщение ошибки - первое по порядку полей схемы.
+    '''
+    try:
+        return schema.load(data)
+    except ValidationError as e:
+        for name in schema.fields:
+            if name in e.messages:
+                messages = e.messages[name]
+                raise ValueError(messages[0] if isinstance(messages, list) else str(messages))
+        raise ValueError('Некорректное тело запроса.')
+
+
+def validate_operation_id(operation_id: str) -> str:
+    '''
+    Проверка operation_id из URL. Выходные данные - UUID в нижнем регистре.
+    '''
+    if not UUID_PATTERN.match(operation_id):
+        raise ValueError(f"Идентификатор операции '{operation_id}' не является UUID.")
+    return operation_id.lower()
+
+
+def _fast_hold(data: dict):
+    '''
+    Быстрая проверка полей удержания. Выходные данные - кортеж
+    `(account_identifier, amount, description)` или None, если нужна полная проверка.
+    '''
+    account_identifier = data.get('account_identifier')
+    amount = data.get('amount')
+    description = data.get('description')
+    if (
+        type(account_identifier) is str and UUID_PATTERN.match(account_identifier)
+        and type(amount) in _AMOUNT_TYPES
+        and type(description) is str and description
+    ):
+        try:
+            amount = to_money(amount)
+        except (ValueError, ArithmeticError):
+            return None
+        if amount > 0:
+            return account_identifier.lower(), amount, description
+    return None
+
+
+def load_hold_request(data) -> tuple:
+    '''
+    Проверка JSON-тела запроса удержания средств.
+
+    Выходные данные - кортеж `(account_identifier, amount, description)`, где `amount` уже
+    приведен к денежной сумме.
+    '''
+    if not data or not isinstance(data, dict):
+        raise ValueError('Требуется JSON-тело запроса.')
+
+    result = _fast_hold(data)
+    if result is not None:
+        return result
+
+    loaded = _load(hold_request_schema, data)
+    return loaded['account_identifier'], loaded['amount'], loaded['description']
+
+
+def load_batch_hold_item(item) -> tuple:
+    '''
+    Проверка элемента пакетного удержания.
+
+    Выходные данные - кортеж `(operation_id, account_identifier, amount, description)`.
+    '''
+    if not isinstance(item, dict):
+        raise ValueError("Элемент пакета должен быть объектом.")
+
+    operation_id = item.get('operation_id')
+    if type(operation_id) is str and UUID_PATTERN.match(operation_id):
+        result = _fast_hold(item)
+        if result is not None:
+            return (operation_id.lower(),) + result
+
+    loaded = _load(batch_hold_item_schema, item)
+    return loaded['operation_id'], loaded['account_identifier'], loaded['amount'], loaded['description']
+
+
+def load_refund_request(data) -> str:
+    '''
+    Проверка необязательного JSON-тела запроса возврата. Выходные данные - описание возврата.
+    '''
+    if not data:
+        return "Возврат средств"
+    if not isinstance(data, dict):
+        raise ValueError('Тело запроса должно быть JSON-объектом.')
+
+    description = data.get('description')
+    if type(description) is str:
+        return description
+
+    return _load(refund_request_schema, data)['description']
+
+
+def validate_account_number(account_number: str) -> str:
+    '''
+    Проверка номера счета из URL. Выходные данные - UUID в нижнем регистре.
+    '''
+    if not UUID_PATTERN.match(account_number):
+        raise ValueError(f"Номер счета '{account_number}' не является UUID.")
+    return account_number.lower()
+
+
+def _choices(args, name: str, allowed: tuple) -> list:
+    '''
+    Значения параметра `name` через запятую или повторением параметра.
+    '''
+    values = []
+    for raw in args.getlist(name):
+        for value in raw.split(','):
+            value = value.strip().upper()
+            if not value:
+                continue
+            if value not in allowed:
+                raise ValueError(f'Параметр "{name}" принимает значения: {", ".join(allowed)}.')
+            values.append(value)
+    return values
+
+
+def parse_timestamp(raw: str, name: str) -> datetime:
+    '''
+    Дата и время в формате ISO 8601. Значение без часового пояса считается указанным в UTC.
+    Возвращается дата с часовым поясом: в запросах она приводится к часовому поясу сессии
+    базы данных так же, как даты, которые записывают операции (`datetime.now(timezone.utc)`).
+    '''
+    try:
+        value = datetime.fromisoformat(raw)
+    except (TypeError, ValueError):
+        raise ValueError(f'Параметр "{name}" должен быть датой в формате ISO 8601.')
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def _timestamp(args, name: str):
+    raw = args.get(name)
+    if not raw:
+        return None
+    return parse_timestamp(raw, name)
+
+
+def load_history_query(args, stream: bool = False) -> dict:
+    '''
+    Проверка параметров запроса истории операций счета.
+
+    Входные аргументы:
+    - `args` - параметры запроса (`request.args`);
+    - `stream` - выгрузка NDJSON: без `limit` выводятся все операции.
+
+    Выходные данные:
+
+    ```
+    {
+        "types": ["HOLD"],
+        "statuses": [],
+        "date_from": datetime(2026, 1, 1, tzinfo=timezone.utc),
+        "date_to": None,
+        "order": "desc",
+        "limit": 50,
+        "cursor": None
+    }
+    ```
+    '''
+    order = args.get('order', 'desc').lower()
+    if order not in ('asc', 'desc'):
+        raise ValueError('Параметр "order" принимает значения: asc, desc.')
+
+    raw_limit = args.get('limit')
+    if raw_limit is None:
+        limit = None if stream else app_settings.history_page_size
+    else:
+        try:
+            limit = int(raw_limit)
+        except ValueError:
+            raise ValueError('Параметр "limit" должен быть целым числом.')
+        if limit < 1 or (not stream and limit > app_settings.history_page_max_size):
+            raise ValueError(f'Параметр "limit" должен быть от 1 до {app_settings.history_page_max_size}.')
+
+    date_from = _timestamp(args, 'from')
+    date_to = _timestamp(args, 'to')
+    if date_from is not None and date_to is not None and date_from >= date_to:
+        raise ValueError('Параметр "from" должен быть раньше "to".')
+
+    return {
+        "types": _choices(args, 'type', TRANSACTION_TYPES),
+        "statuses": _choices(args, 'status', TRANSACTION_STATUSES),
+        "date_from": date_from,
+        "date_to": date_to,
+        "order": order,
+        "limit": limit,
+        "cursor": args.get('cursor') or None
+    }
+
+
+def validate_settlement_id(settlement_id: str) -> str:
+    '''
+    Проверка идентификатора пакетного списания из URL. Выходные данные - UUID в нижнем регистре.
+    '''
+    if not UUID_PATTERN.match(settlement_id):
+        raise ValueError(f"Идентификатор пакетного списания '{settlement_id}' не является UUID.")
+    return settlement_id.lower()
+
+
+def load_settlement_request(data) -> dict:
+    '''
+    Проверка JSON-тела запроса пакетного списания: либо список `operation_ids`, либо номер
+    счета `account_identifier` с необязательной границей `created_before` (ISO 8601).
+
+    Выходные данные:
+
+    ```
+    {"operation_ids": ["..."], "account_identifier": None, "created_before": None}
+    ```
+    '''
+    if not isinstance(data, dict):
+        raise ValueError('Требуется JSON-тело запроса.')
+
+    operation_ids = data.get('operation_ids')
+    account_identifier = data.get('account_identifier')
+    if (operation_ids is None) == (account_identifier is None):
+        raise ValueError('Требуется одно из полей "operation_ids" или "account_identifier".')
+
+    if operation_ids is not None:
+        if not isinstance(operation_ids, list) or not operation_ids:
+            raise ValueError('Поле "operation_ids" должно быть непустым списком.')
+        if len(operation_ids) > app_settings.settlement_max_items:
+            raise ValueError(f'Размер пакета превышает допустимый: {app_settings.settlement_max_items}.')
+        return {
+            "operation_ids": [validate_operation_id(str(operation_id)) for operation_id in operation_ids],
+            "account_identifier": None,
+            "created_before": None
+        }
+
+    if not isinstance(account_identifier, str) or not UUID_PATTERN.match(account_identifier):
+        raise ValueError('Поле "account_identifier" должно быть UUID.')
+    created_before = data.get('created_before')
+    return {
+        "operation_ids": None,
+        "account_identifier": account_identifier.lower(),
+        "created_before": parse_timestamp(created_before, 'created_before') if created_before is not None else None
+    }
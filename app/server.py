@@ -0,0 +1,79 @@
+'''
+Production-сервер на основе gunicorn.
+
+Главный процесс загружает приложение один раз и порождает (fork) несколько
+процессов-обработчиков, в каждом из которых работает несколько потоков. Соединения
+с базой данных не должны переходить из главного процесса в дочерние, поэтому после
+fork пул движка SQLAlchemy сбрасывается, и каждый обработчик открывает свои соединения.
+
+При остановке (SIGTERM) обработчики перестают принимать новые соединения, завершают
+текущие запросы в пределах `server_graceful_timeout` и закрывают пул соединений.
+'''
+import logging
+from gunicorn.app.base import BaseApplication
+from app.db_session import engine
+from app.replicas import replica_router
+from app.settings import app_settings
+
+logger = logging.getLogger(__name__)
+
+
+def post_fork(server, worker):
+    '''
+    Соединения, унаследованные от главного процесса, отбрасываются без закрытия,
+    чтобы не разорвать соединения, которые принадлежат главному процессу.
+    '''
+    for pooled_engine in (engine, *replica_router.engines):
+        pooled_engine.dispose(close=False)
+
+
+def worker_exit(server, worker):
+    for pooled_engine in (engine, *replica_router.engines):
+        pooled_engine.dispose()
+
+
+class ProductionServer(BaseApplication):
+    '''
+    Встраивание gunicorn без отдельного конфигурационного файла: параметры берутся из настроек.
+    '''
+
+    def __init__(self, application_factory, options: dict):
+        self.application_factory = application_factory
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application_factory()
+
+
+def serve(application_factory, bind: str = None, workers: int = None, threads: int = None):
+    '''
+    Запуск приложения, которое создает `application_factory()`, в production-режиме.
+
+    Аргументы `bind`, `workers` и `threads` переопределяют значения из настроек.
+    '''
+    threads = threads or app_settings.server_threads
+    options = {
+        'bind': bind or app_settings.server_bind,
+        'workers': workers or app_settings.server_workers,
+        'threads': threads,
+        'worker_class': 'gthread' if threads > 1 else 'sync',
+        'timeout': app_settings.server_timeout,
+        'graceful_timeout': app_settings.server_graceful_timeout,
+        'max_requests': app_settings.server_max_requests,
+        'max_requests_jitter': app_settings.server_max_requests // 10,
+        'preload_app': True,
+        'post_fork': post_fork,
+        'worker_exit': worker_exit,
+    }
+    if options['workers'] > 1 and app_settings.redis_url is None:
+        logger.warning(
+            "REDIS_URL не задан: у каждого из %d процессов свой кэш идемпотентности, "
+            "и повтор удержания после списания или отмены в другом процессе может получить устаревший ответ (см. app/idempotency.py).",
+            options['workers']
+        )
+    ProductionServer(application_factory, options).run()
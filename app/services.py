@@ -1,8 +1,25 @@
 from datetime import datetime, timezone
+from sqlalchemy import select, update, func, bindparam, literal, Integer
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from app.db_session import get_db
+from sqlalchemy.dialects.postgresql import ARRAY, UUID, insert as pg_insert
+from app.db_session import session_scope, after_commit
 from app.database.accounts import Accounts
 from app.database.transactions import Transactions
+from app.settings import app_settings
+from app.money import to_money
+from app.schemas import load_batch_hold_item
+from app.idempotency import idempotency_cache
+from app.account_cache import get_account_ref, invalidate_account
+from app.balance_cache import project_balance, store_balance
+from app.hot_accounts import BALANCE, HELD_BALANCE, account_balances, hold_on_slot, release_slot, collapse
+from app.replicas import run_on_replica
+from app.reservation_book import reservation_book
+from app.group_commit import group_committer
+from app.ledger import journal
+from app.outbox import publish
+from app import metrics
+from decimal import Decimal
 import uuid
 
 def get_welcome_message():
@@ -11,14 +28,162 @@ def get_welcome_message():
 def get_example_data():
     return {'item1': 'Значение 1', 'item2': 'Значение 2', 'status': 'успешно'}
 
-def process_hold_funds(operation_id: str, account_identifier: str, amount: float, description: str):
+def _remember(db: Session, operation_id: str, action: str, result: dict, message: str) -> dict:
+    '''
+    Запись в кэш идемпотентности ответа, который получит повторный запрос той же операции.
+
+    Ответ повтора совпадает с ответом `result`, но с сообщением `message`
+    ("уже списаны", "уже отменены" и т.п.), по которому эндпоинты выбирают код ответа.
+    Запись выполняется только после фиксации транзакции `db`. Возвращает `result` без изменений.
+    '''
+    after_commit(db, idempotency_cache.store, operation_id, action, {**result, "message": message})
+    return result
+
+def run_in_transaction(operation, *args):
+    '''
+    Выполнение операции `operation(db, *args)` в одной транзакции.
+
+    Функции операций (`hold_funds()`, `charge_funds()` и т.д.) содержат всю проверку и
+    бизнес-логику, но не фиксируют транзакцию сами - это делает вызывающая сторона:
+    эта функция для синхронного API или async_services.py для ASGI-приложения.
+    При любой ошибке транзакция откатывается.
+
+    При включенной групповой фиксации операция выполняется в общей транзакции с параллельными
+    операциями процесса (см. group_commit.py).
+    '''
+    if app_settings.group_commit_enabled:
+        return group_committer.submit(operation, *args)
+
+    with session_scope() as db:
+        try:
+            result = operation(db, *args)
+            with metrics.stage('commit'):
+                db.commit()
+            return result
+        except Exception:
+            db.rollback()
+            raise
+
+def _charged_result(hold_transaction) -> dict:
+    return {
+        "operation_id": hold_transaction.transaction_id,
+        "account_id": hold_transaction.account_id,
+        "amount": hold_transaction.amount,
+        "status": hold_transaction.transaction_status,
+        "message": "Средства по данной операции уже списаны."
+    }
+
+def _cancelled_result(hold_transaction) -> dict:
+    return {
+        "operation_id": hold_transaction.transaction_id,
+        "account_id": hold_transaction.account_id,
+        "amount": hold_transaction.amount,
+        "status": hold_transaction.transaction_status,
+        "message": "Средства по данной операции уже отменены."
+    }
+
+def _refunded_result(original_transaction, refund_transaction) -> dict:
+    return {
+        "operation_id": original_transaction.transaction_id,
+        "refund_transaction_id": refund_transaction.transaction_id,
+        "account_id": refund_transaction.account_id,
+        "amount": refund_transaction.amount,
+        "status": refund_transaction.transaction_status,
+        "message": "Средства по данной операции уже были возвращены."
+    }
+
+def find_finished_operation(db: Session, operation_id: str, action: str):
+    '''
+    Поиск уже выполненного списания (`charge`), отмены (`cancel`) или возврата (`refund`)
+    без блокировок - для ответа на повтор с реплики (см. replicas.py).
+
+    Статусы COMPLETED и CANCELLED и созданный возврат после фиксации не меняются, поэтому
+    найденная даже на отстающей реплике операция действительно выполнена. Если операция
+    на реплике не найдена, запрос выполняется на основном сервере как обычно.
+
+    Выходные данные - ответ на повтор или None.
+    '''
+    hold_transaction = db.scalars(
+        select(Transactions).where(
+            Transactions.transaction_id == operation_id,
+            Transactions.transaction_type == 'HOLD'
+        )
+    ).first()
+    if hold_transaction is None:
+        return None
+
+    if action == 'charge' and hold_transaction.transaction_status == 'COMPLETED':
+        return _charged_result(hold_transaction)
+    if action == 'cancel' and hold_transaction.transaction_status == 'CANCELLED':
+        return _cancelled_result(hold_transaction)
+    if action == 'refund' and hold_transaction.transaction_status == 'COMPLETED':
+        refund_transaction = db.scalars(
+            select(Transactions).where(
+                Transactions.original_transaction_id == hold_transaction.transaction_id,
+                Transactions.transaction_type == 'REFUND'
+            )
+        ).first()
+        if refund_transaction is not None:
+            return _refunded_result(hold_transaction, refund_transaction)
+    return None
+
+def find_replayed(operation_id: str, action: str):
+    '''
+    Ответ на повтор уже выполненного списания, отмены или возврата из кэша идемпотентности или,
+    если есть подходящая реплика, с реплики (см. replicas.py - run_on_replica()). Найденный на реплике
+    ответ сохраняется в кэше идемпотентности.
+
+    Выходные данные - ответ на повтор или None, если операцию нужно выполнить на основном сервере.
+    '''
+    result = idempotency_cache.get(operation_id, action)
+    if result is None:
+        result = run_on_replica(find_finished_operation, operation_id, action)
+        if result is not None:
+            idempotency_cache.store(operation_id, action, result)
+    return result
+
+def normalize_hold_amount(amount) -> Decimal:
+    '''
+    Приведение суммы удержания к денежной сумме и проверка, что она положительная.
+    '''
+    amount = to_money(amount)
+    if amount <= 0:
+        raise ValueError("Сумма удержания должна быть положительной.")
+    return amount
+
+def find_active_hold(db: Session, operation_id: str):
+    '''
+    Поиск активного удержания с данным operation_id.
+
+    Выходные данные - ответ на повтор удержания или None, если активного удержания нет.
+    '''
+    existing_hold_transaction = db.query(Transactions).filter(
+        Transactions.transaction_id == operation_id,
+        Transactions.transaction_type == 'HOLD',
+        Transactions.transaction_status.in_(['PENDING', 'HELD'])
+    ).first()
+
+    if not existing_hold_transaction:
+        return None
+
+    result = {
+        "operation_id": existing_hold_transaction.transaction_id,
+        "account_id": existing_hold_transaction.account_id,
+        "amount": existing_hold_transaction.amount,
+        "status": existing_hold_transaction.transaction_status,
+        "message": "Операция удержания с данным ID уже существует и активна."
+    }
+    after_commit(db, idempotency_cache.store, operation_id, 'hold', result)
+    return result
+
+def process_hold_funds(operation_id: str, account_identifier: str, amount: Decimal, description: str):
     '''
     Реализация удержания средств на счету
 
     Входные аргументы:
     - `operation_id` - идентификатор операции, полученная из URL;
     - `account_identifer` - идентификатор аккаунта в формате UUID версии 4;
-    - `amount` - сумма средств для удержания. Принимает целочисленные (int) и числа с плавающей точкой (float);
+    - `amount` - сумма средств для удержания. Приводится к денежной сумме (см. money.py - to_money());
     - `description` - описание удержания.
 
     Выходные данные - JSON-ответ:
@@ -40,98 +205,148 @@ def process_hold_funds(operation_id: str, account_identifier: str, amount: float
         - операция уже существует.
     '''
 
-    if amount <= 0:
-        raise ValueError("Сумма удержания должна быть положительной.")
+    amount = normalize_hold_amount(amount)
+
+    '''
+    Повтор уже выполненного удержания отвечается из кэша идемпотентности без обращения к базе данных.
+    '''
+    cached_result = idempotency_cache.get(operation_id, 'hold')
+    if cached_result is not None:
+        return cached_result
+
+    '''
+    Удержание "горячего" счета при включенной книге резервирований выполняется в памяти процесса
+    (см. reservation_book.py).
+    '''
+    if app_settings.reservation_book_enabled:
+        result = reservation_book.hold(operation_id, account_identifier, amount, description)
+        if result is not None:
+            return result
 
-    db: Session = next(get_db())
     try:
+        return run_in_transaction(hold_funds, operation_id, account_identifier, amount, description)
+    except IntegrityError:
         '''
-        Проверка уникальности operation_id и поиск незавершенной или отмененной транзакции с этим же идентификатором.
-        
-        Реализована через извлечение идентификаторов транзакций и сравнение, а затем проверку типов и статусов транзакций.
+        Параллельный запрос с тем же operation_id успел создать удержание раньше.
+        Изменения этого запроса откатываются, а клиенту возвращается существующая операция.
         '''
+        result = run_in_transaction(find_active_hold, operation_id)
+        if result is None:
+            raise
+        return result
 
-        existing_hold_transaction = db.query(Transactions).filter(
-            Transactions.transaction_id == operation_id,
-            Transactions.transaction_type == 'HOLD',
-            Transactions.transaction_status.in_(['PENDING', 'HELD']) 
-        ).first()
+def hold_funds(db: Session, operation_id: str, account_identifier: str, amount: Decimal, description: str) -> dict:
+    '''
+    Удержание средств в рамках транзакции `db` без ее фиксации. Описание входных и выходных данных - см. process_hold_funds().
+    '''
 
-        if existing_hold_transaction:
-            '''
-            Возвращение информации об операции с существующим идентификатором, если проверка выше выполняется.
-            '''
+    '''
+    Проверка уникальности operation_id и поиск незавершенной или отмененной транзакции с этим же идентификатором.
 
-            return {
-                "operation_id": existing_hold_transaction.transaction_id,
-                "account_id": existing_hold_transaction.account_id,
-                "amount": float(existing_hold_transaction.amount),
-                "status": existing_hold_transaction.transaction_status,
-                "message": "Операция удержания с данным ID уже существует и активна."
-            }
+    Реализована через извлечение идентификаторов транзакций и сравнение, а затем проверку типов и статусов транзакций.
+    '''
 
-        '''
-        Проверка на существование аккаунта с предоставленным идентификатором.
+    existing_result = find_active_hold(db, operation_id)
 
-        Ошибка, если аккаунта не существует.
+    if existing_result is not None:
         '''
-        account = db.query(Accounts).filter(
-            Accounts.account_number == account_identifier
-        ).first()
+        Возвращение информации об операции с существующим идентификатором, если проверка выше выполняется.
+        '''
+        return existing_result
 
-        if not account:
-            raise ValueError(f"Счет с номером '{account_identifier}' не найден.")
+    '''
+    Проверка на существование аккаунта с предоставленным идентификатором.
+    Внутренний id счета берется из кэша (см. account_cache.py), балансы из кэша не читаются.
 
-        '''
-        Проверка баланса - если баланса меньше, чем запрашивается, то ошибка. 
-        
-        Ошибка выводит доступный баланс и запрошенный баланс для удержания. 
-        '''
+    Ошибка, если аккаунта не существует.
+    '''
+    with metrics.stage('account_lookup'):
+        account = get_account_ref(db, account_identifier)
 
-        available_balance = float(account.balance) - float(account.held_balance)
-        if available_balance < amount:
-            raise ValueError(f"Недостаточно средств на счету {account.account_number}. Доступно: {available_balance}, запрошено: {amount}.")
+    if not account:
+        raise ValueError(f"Счет с номером '{account_identifier}' не найден.")
 
-        '''
-        Реализация транзакции - по умолчанию устанавливается статус PENDING
-        '''
-        new_transaction = Transactions(
-            transaction_id=operation_id,
-            account_id=account.id,
-            transaction_type='HOLD',
-            transaction_date=datetime.now(timezone.utc),
-            amount=amount,
-            description=description,
-            transaction_status='PENDING'
-        )
-        db.add(new_transaction)
+    '''
+    Проверка баланса и удержание средств выполняются одним условным UPDATE:
+    удерживаемый баланс увеличивается, только если доступного баланса хватает.
+    Строка счета блокируется самим UPDATE, поэтому параллельные удержания с одного
+    счета не могут превысить его баланс и не теряют обновления друг друга.
+    Условие на номер счета защищает от устаревшей записи в кэше.
 
-        '''
-        Расчет удерживаемого баланса на счету
-        '''
-        
-        account.held_balance = float(account.held_balance) + amount
+    Ошибка, если средств недостаточно - выводит доступный баланс и запрошенный баланс для удержания.
 
-        db.commit()
-        db.refresh(new_transaction)
+    У "горячего" счета удержание изменяет не строку счета, а один из его слотов (см. hot_accounts.py).
+    '''
+    slot = None
+    held_account = None
+    if account.hold_slots:
+        slot = hold_on_slot(db, account.id, account.hold_slots, amount)
+
+    if slot is None:
+        held_account = db.execute(
+            update(Accounts)
+            .where(
+                Accounts.id == account.id,
+                Accounts.account_number == account.account_number,
+                Accounts.balance - Accounts.held_balance >= amount
+            )
+            .values(held_balance=Accounts.held_balance + amount)
+            .returning(BALANCE, HELD_BALANCE)
+            .execution_options(synchronize_session=False)
+        ).first()
 
-        '''
-        Ответ для успешного запроса
-        '''
+    if held_account is None and slot is None:
+        current = db.execute(
+            select(BALANCE, HELD_BALANCE, Accounts.hold_slots)
+            .where(Accounts.id == account.id, Accounts.account_number == account.account_number)
+        ).first()
+        if current is None:
+            invalidate_account(account_identifier)
+            raise ValueError(f"Счет с номером '{account_identifier}' не найден.")
+        if current.hold_slots and not account.hold_slots:
+            '''
+            Режим слотов включен после того, как атрибуты счета попали в кэш: доступный баланс
+            счета теперь в основном в слотах.
+            '''
+            invalidate_account(account_identifier)
+            slot = hold_on_slot(db, account.id, current.hold_slots, amount)
+        if slot is None:
+            store_balance(account.account_number, account.currency, current.balance, current.held_balance)
+            available_balance = current.balance - current.held_balance
+            raise ValueError(f"Недостаточно средств на счету {account.account_number}. Доступно: {available_balance}, запрошено: {amount}.")
 
-        return {
-            "operation_id": new_transaction.transaction_id,
-            "account_id": account.account_number,
-            "amount": float(new_transaction.amount),
-            "status": new_transaction.transaction_status,
-            "message": "Средства успешно удержаны."
-        }
+    if slot is not None:
+        held_account = account_balances(db, account.id)
+
+    '''
+    Реализация транзакции - по умолчанию устанавливается статус PENDING
+    '''
+    new_transaction = Transactions(
+        transaction_id=operation_id,
+        account_id=account.id,
+        transaction_type='HOLD',
+        transaction_date=datetime.now(timezone.utc),
+        amount=amount,
+        description=description,
+        transaction_status='PENDING',
+        hold_slot=slot
+    )
+    db.add(new_transaction)
+    journal(db, operation_id, account.id, 'HOLD', amount, Decimal('0.00'), amount, held_account.balance, held_account.held_balance)
+    publish(db, 'HOLD', operation_id, account.id, amount, held_account.balance, held_account.held_balance)
+    project_balance(db, account.account_number, account.currency, held_account.balance, held_account.held_balance)
+
+    '''
+    Ответ для успешного запроса
+    '''
 
-    except Exception as e:
-        db.rollback()
-        raise e
-    finally:
-        db.close()
+    return _remember(db, operation_id, 'hold', {
+        "operation_id": new_transaction.transaction_id,
+        "account_id": account.account_number,
+        "amount": new_transaction.amount,
+        "status": new_transaction.transaction_status,
+        "message": "Средства успешно удержаны."
+    }, "Операция удержания с данным ID уже существует и активна.")
 
 def process_charge_funds(operation_id: str):
     '''
@@ -158,50 +373,98 @@ def process_charge_funds(operation_id: str):
         - недостаточно средств для списания.
     ```
     '''
-   
-    db: Session = next(get_db())
+
+    '''
+    Повтор уже выполненного списания отвечается без обращения к основному серверу (см. find_replayed()).
+    '''
+    cached_result = find_replayed(operation_id, 'charge')
+    if cached_result is not None:
+        return cached_result
+
+    '''
+    Удержание, еще не записанное книгой резервирований этого процесса, сначала записывается в базу данных.
+    Удержание, не найденное в базе данных, может ждать записи в книге другого процесса (см. reservation_book.py -
+    await_operation()): после ее записи списание повторяется.
+    '''
+    if app_settings.reservation_book_enabled:
+        reservation_book.flush_operation(operation_id)
+
     try:
-        '''
-        Поиск исходной транзакции удержания по operation_id
-        '''
-        hold_transaction = db.query(Transactions).filter(
-            Transactions.transaction_id == operation_id
-        ).first()
+        return run_in_transaction(charge_funds, operation_id)
+    except ValueError:
+        if not app_settings.reservation_book_enabled or not reservation_book.await_operation(operation_id):
+            raise
+    return run_in_transaction(charge_funds, operation_id)
 
-        if not hold_transaction:
-            raise ValueError(f"Транзакция удержания с ID '{operation_id}' не найдена.")
+def charge_funds(db: Session, operation_id: str) -> dict:
+    '''
+    Списание удержанных средств в рамках транзакции `db` без ее фиксации. Описание входных и выходных данных - см. process_charge_funds().
+    '''
 
-        '''
-        Проверка типа и статуса транзакции
-
-        Возвращает успешный ответ, если транзакция оказалась завершена:
-        ```
-        {
-            "operation_id": "XXXXXXXX-XXXX-XXXX-XXXX-XXXXXXXXXXXX",
-            "account_id": "YYYYYYYY-YYYY-YYYY-YYYY-YYYYYYYYYYYY",
-            "amount": 100,
-            "status": "COMPLETED",
-            "message": "Средства по данной операции уже списаны."
-        }
-        ```
-        Ошибка, если у типа транзакции стоит какой-то иной тип, отличный от удержания (HOLD).
-        Ошибка, если у статуса транзакции стоит какой-то иной тип, отличный от ожиждания (PENDING).
-        '''
-        if hold_transaction.transaction_type != 'HOLD':
-            raise ValueError(f"Транзакция с ID '{operation_id}' не является операцией удержания.")
-        if hold_transaction.transaction_status == 'COMPLETED':
-            return {
-                "operation_id": hold_transaction.transaction_id,
-                "account_id": hold_transaction.account_id,
-                "amount": float(hold_transaction.amount),
-                "status": hold_transaction.transaction_status,
-                "message": "Средства по данной операции уже списаны."
-            }
-        if hold_transaction.transaction_status != 'PENDING':
-            raise ValueError(f"Транзакция с ID '{operation_id}' имеет статус '{hold_transaction.transaction_status}', невозможно списать. Ожидается 'PENDING'.")
+    '''
+    Поиск исходной транзакции удержания по operation_id
+
+    Строка транзакции блокируется до конца транзакции (SELECT ... FOR UPDATE), поэтому
+    параллельные списания и отмены одной операции выполняются строго по очереди.
+    '''
+    hold_transaction = db.query(Transactions).filter(
+        Transactions.transaction_id == operation_id
+    ).with_for_update().first()
 
+    if not hold_transaction:
+        raise ValueError(f"Транзакция удержания с ID '{operation_id}' не найдена.")
+
+    '''
+    Проверка типа и статуса транзакции
+
+    Возвращает успешный ответ, если транзакция оказалась завершена:
+    ```
+    {
+        "operation_id": "XXXXXXXX-XXXX-XXXX-XXXX-XXXXXXXXXXXX",
+        "account_id": "YYYYYYYY-YYYY-YYYY-YYYY-YYYYYYYYYYYY",
+        "amount": 100,
+        "status": "COMPLETED",
+        "message": "Средства по данной операции уже списаны."
+    }
+    ```
+    Ошибка, если у типа транзакции стоит какой-то иной тип, отличный от удержания (HOLD).
+    Ошибка, если у статуса транзакции стоит какой-то иной тип, отличный от ожиждания (PENDING).
+    '''
+    if hold_transaction.transaction_type != 'HOLD':
+        raise ValueError(f"Транзакция с ID '{operation_id}' не является операцией удержания.")
+    if hold_transaction.transaction_status == 'COMPLETED':
+        result = _charged_result(hold_transaction)
+        after_commit(db, idempotency_cache.store, operation_id, 'charge', result)
+        return result
+    if hold_transaction.transaction_status != 'PENDING':
+        raise ValueError(f"Транзакция с ID '{operation_id}' имеет статус '{hold_transaction.transaction_status}', невозможно списать. Ожидается 'PENDING'.")
+
+    '''
+    Списание выполняется одним условным UPDATE: баланс и удерживаемый баланс
+    уменьшаются, только если удерживаемых средств на счету достаточно.
+    Удержание, выполненное через слот "горячего" счета, списывается в том же слоте (см. hot_accounts.py).
+    '''
+    amount_to_charge = hold_transaction.amount
+    if hold_transaction.hold_slot is not None:
+        charged_account = release_slot(db, hold_transaction.account_id, hold_transaction.hold_slot, amount_to_charge, charge=True)
+    else:
+        charged_account = db.execute(
+            update(Accounts)
+            .where(
+                Accounts.id == hold_transaction.account_id,
+                Accounts.held_balance >= amount_to_charge
+            )
+            .values(
+                held_balance=Accounts.held_balance - amount_to_charge,
+                balance=Accounts.balance - amount_to_charge
+            )
+            .returning(Accounts.account_number, Accounts.currency, BALANCE, HELD_BALANCE)
+            .execution_options(synchronize_session=False)
+        ).first()
+
+    if charged_account is None:
         '''
-        Получение связанного счета с ранее полученной транзакцией
+        Условие не выполнено - выясняется, отсутствует ли счет или на нем недостаточно удерживаемых средств.
         '''
         account = db.query(Accounts).filter(
             Accounts.id == hold_transaction.account_id
@@ -210,38 +473,32 @@ def process_charge_funds(operation_id: str):
         if not account:
             raise ValueError(f"Счет с ID '{hold_transaction.account_id}' для транзакции '{operation_id}' не найден.")
 
-        '''
-        Проверка достаточности удерживаемых средств
-        '''
-        amount_to_charge = float(hold_transaction.amount)
-        if float(account.held_balance) < amount_to_charge:
-            raise ValueError(f"Недостаточно удерживаемых средств на счету {account.account_number} для списания операции '{operation_id}'. Удержано: {float(account.held_balance)}, требуется: {amount_to_charge}.")
-
-        '''
-        Успешная транзакция добавляется в таблицу и обновляется значение средств с учетом списания средств
-        '''
-        hold_transaction.transaction_status = 'COMPLETED'
-        hold_transaction.transaction_date = datetime.now(timezone.utc)
-
-  
-        account.held_balance = float(account.held_balance) - amount_to_charge
-        account.balance = float(account.balance) - amount_to_charge
+        raise ValueError(f"Недостаточно удерживаемых средств на счету {account.account_number} для списания операции '{operation_id}'. Удержано: {account.held_balance}, требуется: {amount_to_charge}.")
 
-        db.commit()
+    '''
+    Транзакция удержания переводится в статус завершенной
+    '''
+    hold_transaction.transaction_status = 'COMPLETED'
+    hold_transaction.transaction_date = datetime.now(timezone.utc)
+    journal(
+        db, operation_id, hold_transaction.account_id, 'CHARGE', amount_to_charge,
+        -amount_to_charge, -amount_to_charge, charged_account.balance, charged_account.held_balance
+    )
+    publish(db, 'CHARGE', operation_id, hold_transaction.account_id, amount_to_charge, charged_account.balance, charged_account.held_balance)
+    project_balance(db, charged_account.account_number, charged_account.currency, charged_account.balance, charged_account.held_balance)
 
-        return {
-            "operation_id": hold_transaction.transaction_id,
-            "account_id": account.account_number,
-            "amount": amount_to_charge,
-            "status": hold_transaction.transaction_status,
-            "message": "Средства успешно списаны."
-        }
+    '''
+    Удержание больше не активно, поэтому сохраненный ответ на повтор удержания удаляется.
+    '''
+    after_commit(db, idempotency_cache.forget, operation_id, 'hold')
 
-    except Exception as e:
-        db.rollback()
-        raise e
-    finally:
-        db.close()
+    return _remember(db, operation_id, 'charge', {
+        "operation_id": hold_transaction.transaction_id,
+        "account_id": charged_account.account_number,
+        "amount": amount_to_charge,
+        "status": hold_transaction.transaction_status,
+        "message": "Средства успешно списаны."
+    }, "Средства по данной операции уже списаны.")
 
 def process_cancel_hold(operation_id: str):
     '''
@@ -267,56 +524,103 @@ def process_cancel_hold(operation_id: str):
         - неверный внутренний статус транзакции - транзакция отмены удержания средств должна быть в статусе PENDING.
     '''
 
-    db: Session = next(get_db())
+    '''
+    Повтор уже выполненной отмены отвечается без обращения к основному серверу (см. find_replayed()).
+    '''
+    cached_result = find_replayed(operation_id, 'cancel')
+    if cached_result is not None:
+        return cached_result
+
+    '''
+    Удержание, еще не записанное книгой резервирований этого процесса, отменяется в памяти,
+    книгой другого процесса - в базе данных после ее записи (как и списание).
+    '''
+    if app_settings.reservation_book_enabled:
+        result = reservation_book.cancel(operation_id)
+        if result is not None:
+            return result
+
     try:
-        '''
-        Поиск исходной транзакции удержания по operation_id
-        '''
-        hold_transaction = db.query(Transactions).filter(
-            Transactions.transaction_id == operation_id
-        ).first()
+        return run_in_transaction(cancel_hold, operation_id)
+    except ValueError:
+        if not app_settings.reservation_book_enabled or not reservation_book.await_operation(operation_id):
+            raise
+    return run_in_transaction(cancel_hold, operation_id)
 
+def cancel_hold(db: Session, operation_id: str) -> dict:
+    '''
+    Отмена удержания в рамках транзакции `db` без ее фиксации. Описание входных и выходных данных - см. process_cancel_hold().
+    '''
 
-        '''
-        Проверка типа и статуса транзакции
-
-        Возвращает успешный ответ, если транзакция уже оказалась завершена:
-        ```
-        {
-            "operation_id": "XXXXXXXX-XXXX-XXXX-XXXX-XXXXXXXXXXXX",
-            "account_id": "YYYYYYYY-YYYY-YYYY-YYYY-YYYYYYYYYYYY",
-            "amount": 100,
-            "status": "CANCELLED",
-            "message": "Средства по данной операции уже отменены."
-        }
-        ```
+    '''
+    Поиск исходной транзакции удержания по operation_id
 
-        Ошибка, если у типа транзакции стоит какой-то иной тип, отличный от удержания (HOLD).
-        Ошибка, если у статуса транзакции стоит какой-то иной тип, отличный от ожиждания (PENDING).
-        Ошибка, если у статуса транзакция уже завершена (CANCELLED).
-        Ошибка, если средства уже списаны (COMPLETED).
-        '''
+    Строка транзакции блокируется до конца транзакции (SELECT ... FOR UPDATE), поэтому
+    параллельные списания и отмены одной операции выполняются строго по очереди.
+    '''
+    hold_transaction = db.query(Transactions).filter(
+        Transactions.transaction_id == operation_id
+    ).with_for_update().first()
 
-        if not hold_transaction:
-            raise ValueError(f"Транзакция удержания с ID '{operation_id}' не найдена.")
-
-        if hold_transaction.transaction_type != 'HOLD':
-            raise ValueError(f"Транзакция с ID '{operation_id}' не является операцией удержания.")
-        
-        if hold_transaction.transaction_status == 'CANCELLED':
-            return {
-                "operation_id": hold_transaction.transaction_id,
-                "account_id": hold_transaction.account_id,
-                "amount": float(hold_transaction.amount),
-                "status": hold_transaction.transaction_status,
-                "message": "Средства по данной операции уже отменены."
-            }
-        if hold_transaction.transaction_status == 'COMPLETED':
-            raise ValueError(f"Транзакция с ID '{operation_id}' уже списана. Невозможно отменить удержание.")
-        
-        if hold_transaction.transaction_status != 'PENDING':
-            raise ValueError(f"Транзакция с ID '{operation_id}' имеет статус '{hold_transaction.transaction_status}', невозможно отменить. Ожидается 'PENDING'.")
 
+    '''
+    Проверка типа и статуса транзакции
+
+    Возвращает успешный ответ, если транзакция уже оказалась завершена:
+    ```
+    {
+        "operation_id": "XXXXXXXX-XXXX-XXXX-XXXX-XXXXXXXXXXXX",
+        "account_id": "YYYYYYYY-YYYY-YYYY-YYYY-YYYYYYYYYYYY",
+        "amount": 100,
+        "status": "CANCELLED",
+        "message": "Средства по данной операции уже отменены."
+    }
+    ```
+
+    Ошибка, если у типа транзакции стоит какой-то иной тип, отличный от удержания (HOLD).
+    Ошибка, если у статуса транзакции стоит какой-то иной тип, отличный от ожиждания (PENDING).
+    Ошибка, если у статуса транзакция уже завершена (CANCELLED).
+    Ошибка, если средства уже списаны (COMPLETED).
+    '''
+
+    if not hold_transaction:
+        raise ValueError(f"Транзакция удержания с ID '{operation_id}' не найдена.")
+
+    if hold_transaction.transaction_type != 'HOLD':
+        raise ValueError(f"Транзакция с ID '{operation_id}' не является операцией удержания.")
+
+    if hold_transaction.transaction_status == 'CANCELLED':
+        result = _cancelled_result(hold_transaction)
+        after_commit(db, idempotency_cache.store, operation_id, 'cancel', result)
+        return result
+    if hold_transaction.transaction_status == 'COMPLETED':
+        raise ValueError(f"Транзакция с ID '{operation_id}' уже списана. Невозможно отменить удержание.")
+
+    if hold_transaction.transaction_status != 'PENDING':
+        raise ValueError(f"Транзакция с ID '{operation_id}' имеет статус '{hold_transaction.transaction_status}', невозможно отменить. Ожидается 'PENDING'.")
+
+    amount_to_return = hold_transaction.amount
+
+    '''
+    Освобождение удерживаемых средств выполняется одним условным UPDATE
+    относительно текущего значения в строке счета, а не значения, прочитанного ранее.
+    Удержание, выполненное через слот "горячего" счета, освобождается в том же слоте.
+    '''
+    if hold_transaction.hold_slot is not None:
+        released_account = release_slot(db, hold_transaction.account_id, hold_transaction.hold_slot, amount_to_return, charge=False)
+    else:
+        released_account = db.execute(
+            update(Accounts)
+            .where(
+                Accounts.id == hold_transaction.account_id,
+                Accounts.held_balance >= amount_to_return
+            )
+            .values(held_balance=Accounts.held_balance - amount_to_return)
+            .returning(Accounts.account_number, Accounts.currency, BALANCE, HELD_BALANCE)
+            .execution_options(synchronize_session=False)
+        ).first()
+
+    if released_account is None:
         account = db.query(Accounts).filter(
             Accounts.id == hold_transaction.account_id
         ).first()
@@ -324,32 +628,30 @@ def process_cancel_hold(operation_id: str):
         if not account:
             raise ValueError(f"Счет с ID '{hold_transaction.account_id}' для транзакции '{operation_id}' не найден.")
 
-        amount_to_return = float(hold_transaction.amount)
-       
-        '''
-        Успешная транзакция добавляется в таблицу
-        '''
+        raise ValueError(f"Недостаточно удерживаемых средств на счету {account.account_number} для отмены операции '{operation_id}'. Удержано: {account.held_balance}, требуется: {amount_to_return}.")
 
-        hold_transaction.transaction_status = 'CANCELLED'
-        hold_transaction.transaction_date = datetime.now(timezone.utc)
-
-        account.held_balance = float(account.held_balance) - amount_to_return
+    '''
+    Транзакция удержания переводится в статус отмененной
+    '''
 
-        db.commit()
+    hold_transaction.transaction_status = 'CANCELLED'
+    hold_transaction.transaction_date = datetime.now(timezone.utc)
+    journal(
+        db, operation_id, hold_transaction.account_id, 'CANCEL', amount_to_return,
+        Decimal('0.00'), -amount_to_return, released_account.balance, released_account.held_balance
+    )
+    publish(db, 'CANCEL', operation_id, hold_transaction.account_id, amount_to_return, released_account.balance, released_account.held_balance)
+    project_balance(db, released_account.account_number, released_account.currency, released_account.balance, released_account.held_balance)
 
-        return {
-            "operation_id": hold_transaction.transaction_id,
-            "account_id": account.account_number,
-            "amount": amount_to_return,
-            "status": hold_transaction.transaction_status,
-            "message": "Удержание средств успешно отменено."
-        }
+    after_commit(db, idempotency_cache.forget, operation_id, 'hold')
 
-    except Exception as e:
-        db.rollback()
-        raise e
-    finally:
-        db.close()
+    return _remember(db, operation_id, 'cancel', {
+        "operation_id": hold_transaction.transaction_id,
+        "account_id": released_account.account_number,
+        "amount": amount_to_return,
+        "status": hold_transaction.transaction_status,
+        "message": "Удержание средств успешно отменено."
+    }, "Средства по данной операции уже отменены.")
 
 def process_refund_funds(operation_id: str, description: str = "Возврат средств"):
     '''
@@ -378,88 +680,386 @@ def process_refund_funds(operation_id: str, description: str = "Возврат 
         - уже возвращено.
     '''
 
-    db: Session = next(get_db())
-    try:
-        '''
-        Поиск исходной транзакции списания (CHARGE) по operation_id
-        Ищем оригинальную транзакцию (HOLD), которая была COMPLETED (списана)
-        '''
-        original_charge_transaction = db.query(Transactions).filter(
-            Transactions.transaction_id == operation_id,
-            Transactions.transaction_type == 'HOLD',
-            Transactions.transaction_status == 'COMPLETED'
-        ).first()
+    '''
+    Повтор уже выполненного возврата отвечается без обращения к основному серверу (см. find_replayed()).
+    '''
+    cached_result = find_replayed(operation_id, 'refund')
+    if cached_result is not None:
+        return cached_result
 
-        if not original_charge_transaction:
-            raise ValueError(f"Исходная транзакция списания (CHARGE) с ID '{operation_id}' не найдена или не имеет статус 'COMPLETED'.")
+    return run_in_transaction(refund_funds, operation_id, description)
 
-        '''
-        Проверка, что по этой исходной транзакции ещё не было возврата
-        Для этого используется поле original_transaction_id для проверки
-        '''
-        existing_refund_transaction = db.query(Transactions).filter(
-            Transactions.original_transaction_id == original_charge_transaction.transaction_id,
-            Transactions.transaction_type == 'REFUND'
-        ).first()
 
-        if existing_refund_transaction:
-            return {
-                "operation_id": original_charge_transaction.transaction_id,
-                "refund_transaction_id": existing_refund_transaction.transaction_id,
-                "account_id": existing_refund_transaction.account_id,
-                "amount": float(existing_refund_transaction.amount),
-                "status": existing_refund_transaction.transaction_status,
-                "message": "Средства по данной операции уже были возвращены."
+def refund_funds(db: Session, operation_id: str, description: str) -> dict:
+    '''
+    Возврат средств в рамках транзакции `db` без ее фиксации. Описание входных и выходных данных - см. process_refund_funds().
+    '''
+
+    '''
+    Поиск исходной транзакции списания (CHARGE) по operation_id
+    Ищем оригинальную транзакцию (HOLD), которая была COMPLETED (списана)
+
+    Строка исходной транзакции блокируется (SELECT ... FOR UPDATE), чтобы параллельные
+    запросы возврата по одной операции не создали два возврата.
+    '''
+    original_charge_transaction = db.query(Transactions).filter(
+        Transactions.transaction_id == operation_id,
+        Transactions.transaction_type == 'HOLD',
+        Transactions.transaction_status == 'COMPLETED'
+    ).with_for_update().first()
+
+    if not original_charge_transaction:
+        raise ValueError(f"Исходная транзакция списания (CHARGE) с ID '{operation_id}' не найдена или не имеет статус 'COMPLETED'.")
+
+    '''
+    Проверка, что по этой исходной транзакции ещё не было возврата
+    Для этого используется поле original_transaction_id для проверки
+    '''
+    existing_refund_transaction = db.query(Transactions).filter(
+        Transactions.original_transaction_id == original_charge_transaction.transaction_id,
+        Transactions.transaction_type == 'REFUND'
+    ).first()
+
+    if existing_refund_transaction:
+        result = _refunded_result(original_charge_transaction, existing_refund_transaction)
+        after_commit(db, idempotency_cache.store, operation_id, 'refund', result)
+        return result
+
+    amount_to_refund = original_charge_transaction.amount
+
+    '''
+    Обновление баланса счета, то есть прибавка к текущему баланса значения, с которого ранее был сделан возврат.
+
+    Прибавка выполняется атомарно в самом UPDATE, поэтому параллельные изменения баланса не теряются.
+    '''
+    refunded_account = db.execute(
+        update(Accounts)
+        .where(Accounts.id == original_charge_transaction.account_id)
+        .values(balance=Accounts.balance + amount_to_refund)
+        .returning(Accounts.id, Accounts.account_number, Accounts.currency, BALANCE, HELD_BALANCE)
+        .execution_options(synchronize_session=False)
+    ).first()
+
+    if refunded_account is None:
+        raise ValueError(f"Счет с ID '{original_charge_transaction.account_id}' для исходной транзакции '{operation_id}' не найден.")
+
+    '''
+    Создание новой записи о транзакции возврата
+
+    Во время выполнения транзакции генерируется UUID-транзакции возврата средств.
+
+    Согласно таблице, также имеется ссылка на исходную транзакцию, откуда выполнялся возврат средств.
+    '''
+    refund_transaction_id = str(uuid.uuid4())
+    new_refund_transaction = Transactions(
+        transaction_id=refund_transaction_id,
+        account_id=refunded_account.id,
+        transaction_type='REFUND',
+        transaction_date=datetime.now(timezone.utc),
+        amount=amount_to_refund,
+        description=f"{description} по операции {operation_id}",
+        transaction_status='COMPLETED',
+        original_transaction_id=original_charge_transaction.transaction_id
+    )
+    db.add(new_refund_transaction)
+    journal(
+        db, operation_id, refunded_account.id, 'REFUND', amount_to_refund,
+        amount_to_refund, Decimal('0.00'), refunded_account.balance, refunded_account.held_balance
+    )
+    publish(db, 'REFUND', operation_id, refunded_account.id, amount_to_refund, refunded_account.balance, refunded_account.held_balance)
+    project_balance(db, refunded_account.account_number, refunded_account.currency, refunded_account.balance, refunded_account.held_balance)
+
+    return _remember(db, operation_id, 'refund', {
+        "operation_id": original_charge_transaction.transaction_id,
+        "refund_transaction_id": new_refund_transaction.transaction_id,
+        "account_id": refunded_account.account_number,
+        "amount": new_refund_transaction.amount,
+        "status": new_refund_transaction.transaction_status,
+        "message": "Средства успешно возвращены."
+    }, "Средства по данной операции уже были возвращены.")
+
+def process_hold_funds_batch(items: list):
+    '''
+    Реализация пакетного удержания средств
+
+    Входные аргументы:
+    - `items` - список объектов вида
+      `{"operation_id": ..., "account_identifier": ..., "amount": ..., "description": ...}`.
+
+    Выходные данные - JSON-ответ с результатом для каждого элемента в порядке запроса:
+
+    ```
+    {
+        "results": [
+            {
+                "code": 201,
+                "operation_id": "YYYYYYYY-YYYY-YYYY-YYYY-YYYYYYYYYYYY",
+                "account_id": "XXXXXXXX-XXXX-XXXX-XXXX-XXXXXXXXXXXX",
+                "amount": 100,
+                "status": "PENDING",
+                "message": "Средства успешно удержаны."
+            },
+            {
+                "code": 400,
+                "operation_id": "ZZZZZZZZ-ZZZZ-ZZZZ-ZZZZ-ZZZZZZZZZZZZ",
+                "message": "Недостаточно средств на счету ..."
             }
+        ],
+        "created": 1,
+        "existing": 0,
+        "failed": 1
+    }
+    ```
 
-        account = db.query(Accounts).filter(
-            Accounts.id == original_charge_transaction.account_id
-        ).first()
+    Коды элементов совпадают с кодами эндпоинта одиночного удержания: 201 - удержано,
+    200 - операция уже существует, 400 - ошибка в элементе.
 
-        if not account:
-            raise ValueError(f"Счет с ID '{original_charge_transaction.account_id}' для исходной транзакции '{operation_id}' не найден.")
+    В отличие от одиночного удержания, все элементы обрабатываются в одной сессии:
+    счета и существующие операции загружаются одним запросом каждый, новые транзакции
+    добавляются одним пакетным INSERT, а удерживаемый баланс обновляется одним UPDATE
+    на каждый затронутый счет. Фиксация выполняется один раз на весь пакет. Повторы операций
+    находятся так же, как у одиночного удержания: в кэше идемпотентности, в книгах резервирований
+    и среди существующих операций, включая созданные параллельными запросами во время пакета.
 
-        amount_to_refund = float(original_charge_transaction.amount)
+    Ошибки:
+    - `ValueError`:
+        - пакет пустой или превышает допустимый размер.
+    '''
 
-        '''
-        Создание новой записи о транзакции возврата
+    if not isinstance(items, list) or not items:
+        raise ValueError("Требуется непустой список операций.")
+    if len(items) > app_settings.hold_batch_max_size:
+        raise ValueError(f"Размер пакета превышает допустимый: {app_settings.hold_batch_max_size}.")
 
-        Во время выполнения транзакции генерируется UUID-транзакции возврата средств.
-        
-        Согласно таблице, также имеется ссылка на исходную транзакцию, откуда выполнялся возврат средств.
-        '''
-        refund_transaction_id = str(uuid.uuid4())
-        new_refund_transaction = Transactions(
-            transaction_id=refund_transaction_id,
-            account_id=account.id,
-            transaction_type='REFUND',
-            transaction_date=datetime.now(timezone.utc),
-            amount=amount_to_refund,
-            description=f"{description} по операции {operation_id}",
-            transaction_status='COMPLETED',
-            original_transaction_id=original_charge_transaction.transaction_id
-        )
-        db.add(new_refund_transaction)
+    results: list = [None] * len(items)
+    valid: list = []
+    seen_operations: set = set()
 
-        '''
-        Обновление баланса счета, то есть прибавка к текущему баланса значения, с которого ранее был сделан возврат.
-        '''
-        account.balance = float(account.balance) + amount_to_refund
+    '''
+    Проверка входных данных каждого элемента. Ошибочные элементы получают ответ
+    сразу и в дальнейшей обработке не участвуют.
+    '''
+    for index, item in enumerate(items):
+        operation_id = item.get('operation_id') if isinstance(item, dict) else None
+        try:
+            operation_id, account_identifier, amount, description = load_batch_hold_item(item)
+            if operation_id in seen_operations:
+                raise ValueError(f"Операция с ID '{operation_id}' повторяется в пакете.")
+        except ValueError as e:
+            results[index] = {"code": 400, "operation_id": operation_id, "message": str(e)}
+            continue
+
+        seen_operations.add(operation_id)
+        valid.append((index, operation_id, account_identifier, amount, description))
 
-        db.commit()
-        db.refresh(new_refund_transaction)
+    '''
+    Повторы уже выполненных удержаний отвечаются так же, как у одиночного удержания: из кэша
+    идемпотентности, а операции, подтвержденные книгами резервирований, но еще не записанные
+    в базу данных, сначала дожидаются записи (см. reservation_book.py - await_operations()),
+    чтобы найтись среди существующих операций.
+    '''
+    pending = []
+    for entry in valid:
+        cached_result = idempotency_cache.get(entry[1], 'hold')
+        if cached_result is not None:
+            results[entry[0]] = {"code": 200, **cached_result}
+        else:
+            pending.append(entry)
+    valid = pending
+
+    if app_settings.reservation_book_enabled and valid:
+        reservation_book.await_operations([entry[1] for entry in valid])
+
+    if valid:
+        with session_scope() as db:
+            try:
+                _hold_batch(db, valid, results)
+                with metrics.stage('commit'):
+                    db.commit()
+            except Exception as e:
+                db.rollback()
+                raise e
+
+    return {
+        "results": results,
+        "created": sum(1 for result in results if result["code"] == 201),
+        "existing": sum(1 for result in results if result["code"] == 200),
+        "failed": sum(1 for result in results if result["code"] == 400)
+    }
 
+def _existing_hold_result(operation_id: str, existing) -> dict:
+    '''
+    Результат элемента пакета, operation_id которого уже принадлежит транзакции `existing`.
+    '''
+    if existing.transaction_type == 'HOLD' and existing.transaction_status in ('PENDING', 'HELD'):
         return {
-            "operation_id": original_charge_transaction.transaction_id,
-            "refund_transaction_id": new_refund_transaction.transaction_id,
-            "account_id": account.account_number,
-            "amount": float(new_refund_transaction.amount),
-            "status": new_refund_transaction.transaction_status,
-            "message": "Средства успешно возвращены."
+            "code": 200,
+            "operation_id": existing.transaction_id,
+            "account_id": existing.account_id,
+            "amount": existing.amount,
+            "status": existing.transaction_status,
+            "message": "Операция удержания с данным ID уже существует и активна."
         }
+    return {
+        "code": 400,
+        "operation_id": operation_id,
+        "message": f"Операция с ID '{operation_id}' уже существует и имеет статус '{existing.transaction_status}'."
+    }
 
-    except Exception as e:
-        db.rollback()
-        raise e
-    finally:
-        db.close()
+def _hold_batch(db: Session, valid: list, results: list):
+    '''
+    Удержания элементов пакета `valid` в транзакции `db` без ее фиксации. Результаты записываются
+    в `results` по индексам элементов. Описание - см. process_hold_funds_batch().
+    '''
+
+    '''
+    Загрузка всех упомянутых операций и счетов - по одному запросу на каждую таблицу.
+
+    Строки счетов блокируются до фиксации (SELECT ... FOR NO KEY UPDATE, см. hot_accounts.py) в порядке идентификаторов,
+    чтобы пакеты с пересекающимися счетами не блокировали друг друга взаимно.
+    '''
+    existing_transactions = {
+        str(transaction.transaction_id): transaction
+        for transaction in db.scalars(
+            select(Transactions).where(Transactions.transaction_id.in_([entry[1] for entry in valid]))
+        )
+    }
+    accounts = {
+        str(account.account_number): account
+        for account in db.scalars(
+            select(Accounts)
+            .where(Accounts.account_number.in_({entry[2] for entry in valid}))
+            .order_by(Accounts.id)
+            .with_for_update(key_share=True)
+        )
+    }
+
+    '''
+    Доступный баланс "горячих" счетов возвращается из слотов в строку счета (см. hot_accounts.py),
+    поэтому строка счета содержит его значения с учетом слотов.
+    '''
+    for account in sorted(accounts.values(), key=lambda account: account.id):
+        if account.hold_slots:
+            collapse(db, account.id)
+            db.refresh(account)
+
+    available = {
+        number: account.balance - account.held_balance
+        for number, account in accounts.items()
+    }
+    held_delta: dict = {}
+    now = datetime.now(timezone.utc)
+
+    pending = []
+    for entry in valid:
+        index, operation_id, account_identifier = entry[:3]
+        existing = existing_transactions.get(operation_id)
+        if existing is not None:
+            results[index] = _existing_hold_result(operation_id, existing)
+        elif account_identifier not in accounts:
+            results[index] = {
+                "code": 400,
+                "operation_id": operation_id,
+                "message": f"Счет с номером '{account_identifier}' не найден."
+            }
+        else:
+            pending.append(entry)
+
+    '''
+    Применение удержаний в памяти в порядке запроса. Доступный баланс каждого счета
+    уменьшается по мере обработки элементов, поэтому элементы одного счета
+    не могут суммарно превысить его баланс.
+
+    Принятые элементы добавляются одним запросом INSERT ... SELECT FROM unnest(...) ON CONFLICT
+    (transaction_id) DO NOTHING RETURNING (массивы передаются параметрами, поэтому текст запроса
+    не зависит от размера пакета): если параллельный запрос успел создать операцию с тем же operation_id после загрузки
+    существующих операций, пакет не падает с IntegrityError, а такой элемент получает ответ
+    "уже существует". Удерживаемая им сумма возвращается в доступный баланс, и элементы, которым
+    ее не хватило, проверяются снова.
+    '''
+    while pending:
+        accepted, rejected = [], []
+        for entry in pending:
+            amount = entry[3]
+            if available[entry[2]] < amount:
+                rejected.append(entry)
+            else:
+                available[entry[2]] -= amount
+                accepted.append(entry)
+        if not accepted:
+            break
+
+        rows = func.unnest(
+            bindparam('operation_ids', [entry[1] for entry in accepted], type_=ARRAY(UUID(as_uuid=False))),
+            bindparam('account_ids', [accounts[entry[2]].id for entry in accepted], type_=ARRAY(Integer)),
+            bindparam('amounts', [entry[3] for entry in accepted], type_=ARRAY(Transactions.amount.type)),
+            bindparam('descriptions', [entry[4] for entry in accepted], type_=ARRAY(Transactions.description.type))
+        ).table_valued('transaction_id', 'account_id', 'amount', 'description').render_derived()
+        inserted = set(map(str, db.scalars(
+            pg_insert(Transactions)
+            .from_select(
+                ['transaction_id', 'account_id', 'amount', 'description', 'transaction_type', 'transaction_date', 'transaction_status'],
+                select(rows.c.transaction_id, rows.c.account_id, rows.c.amount, rows.c.description, literal('HOLD'), literal(now, Transactions.transaction_date.type), literal('PENDING'))
+            )
+            .on_conflict_do_nothing(index_elements=[Transactions.transaction_id])
+            .returning(Transactions.transaction_id)
+        )))
+
+        conflicting = [entry for entry in accepted if entry[1] not in inserted]
+        if conflicting:
+            existing_transactions = {
+                str(transaction.transaction_id): transaction
+                for transaction in db.scalars(
+                    select(Transactions).where(Transactions.transaction_id.in_([entry[1] for entry in conflicting]))
+                )
+            }
+            for index, operation_id, account_identifier, amount, description in conflicting:
+                available[account_identifier] += amount
+                results[index] = _existing_hold_result(operation_id, existing_transactions[operation_id])
+
+        for index, operation_id, account_identifier, amount, description in accepted:
+            if operation_id not in inserted:
+                continue
+            account = accounts[account_identifier]
+            held_delta[account.id] = held_delta.get(account.id, Decimal('0.00')) + amount
+            journal(
+                db, operation_id, account.id, 'HOLD', amount, Decimal('0.00'), amount,
+                account.balance, account.held_balance + held_delta[account.id]
+            )
+            publish(db, 'HOLD', operation_id, account.id, amount, account.balance, account.held_balance + held_delta[account.id])
+            results[index] = {
+                "code": 201,
+                "operation_id": operation_id,
+                "account_id": account.account_number,
+                "amount": amount,
+                "status": 'PENDING',
+                "message": "Средства успешно удержаны."
+            }
+            _remember(db, operation_id, 'hold', {
+                key: value for key, value in results[index].items() if key != "code"
+            }, "Операция удержания с данным ID уже существует и активна.")
+
+        pending = rejected
+        if not conflicting:
+            break
+
+    for index, operation_id, account_identifier, amount, description in pending:
+        results[index] = {
+            "code": 400,
+            "operation_id": operation_id,
+            "message": f"Недостаточно средств на счету {account_identifier}. Доступно: {available[account_identifier]}, запрошено: {amount}."
+        }
+
+    '''
+    Одно обновление удерживаемого баланса на каждый счет.
+    '''
+    if held_delta:
+        accounts_by_id = {account.id: account for account in accounts.values()}
+        held_balances = [
+            {"id": account_id, "held_balance": accounts_by_id[account_id].held_balance + delta}
+            for account_id, delta in held_delta.items()
+        ]
+        db.execute(update(Accounts), held_balances)
+        for item in held_balances:
+            account = accounts_by_id[item["id"]]
+            project_balance(db, account.account_number, account.currency, account.balance, item["held_balance"])
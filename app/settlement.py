@@ -0,0 +1,420 @@
+'''
+Пакетное списание удержаний (settlement).
+
+Пакет - список удержаний, заданный явно (operation_id) или условием "все удержания счета
+в статусе PENDING, созданные раньше указанного времени". При создании пакета его элементы
+записываются в таблицу settlement_items (см. database/settlements.py) одним запросом,
+после чего пакет обрабатывается частями по `SETTLEMENT_CHUNK_SIZE` элементов, каждая часть -
+одна транзакция:
+1. необработанные элементы части блокируются с `FOR UPDATE SKIP LOCKED`;
+2. строки удержаний части блокируются одним SELECT ... FOR UPDATE в порядке id, как при
+   одиночном списании (сначала удержание, затем счет);
+3. суммы удержаний складываются по счетам, и строки счетов блокируются в порядке id;
+4. одним UPDATE удержания переводятся в статус COMPLETED, одним UPDATE ... FROM (VALUES ...)
+   уменьшаются баланс и удерживаемый баланс всех счетов части, и одним пакетным UPDATE
+   записываются результаты элементов.
+
+Удержания, выполненные через слоты "горячих" счетов (см. hot_accounts.py), списываются
+из своих слотов: слоты блокируются после счетов, и проверка удерживаемых средств выполняется
+по слоту, а не по строке счета.
+
+Результаты элементов фиксируются вместе со списанием, поэтому прерванную обработку (падение
+процесса, обрыв соединения) можно продолжить: повторный запуск того же пакета обрабатывает
+только элементы в статусе PENDING. Несколько одновременных запусков одного пакета делят
+элементы между собой через SKIP LOCKED.
+
+Запуск: `POST /api/settlements/<settlement_id>` или `python run.py settle`.
+'''
+import logging
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+from sqlalchemy import select, update, insert, func, values, column, literal, Integer, DECIMAL
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from app.balance_cache import project_balance
+from app.database import Accounts, Transactions, Settlements, SettlementItems
+from app.db_session import session, after_commit
+from app.hot_accounts import BALANCE, HELD_BALANCE, lock_slots, release_slots
+from app.idempotency import idempotency_cache
+from app.ledger import journal
+from app.outbox import publish
+from app.metrics import registry, Counter, Histogram
+from app.settings import app_settings
+
+logger = logging.getLogger(__name__)
+
+settled_total = registry.register(Counter(
+    'settlement_items_total', 'Количество обработанных элементов пакетного списания по результату.', ('status',)
+))
+settlement_chunk_duration = registry.register(Histogram(
+    'settlement_chunk_duration_seconds', 'Длительность обработки части пакетного списания в секундах.', ()
+))
+
+
+def create_settlement(db: Session, settlement_id: str, operation_ids: list = None,
+                      account_id: int = None, created_before: datetime = None) -> int:
+    '''
+    Создание пакета с элементами в транзакции `db` без ее фиксации.
+
+    Элементы пакета - `operation_ids` или, если они не заданы, удержания счета `account_id`
+    в статусе PENDING, созданные раньше `created_before`.
+
+    Выходные данные - внутренний id пакета.
+
+    Ошибки:
+    - `IntegrityError` - пакет с `settlement_id` уже существует.
+    '''
+    created = db.execute(
+        insert(Settlements)
+        .values(
+            settlement_id=settlement_id,
+            status='RUNNING',
+            account_id=account_id,
+            created_before=created_before,
+            created_at=datetime.now(timezone.utc)
+        )
+        .returning(Settlements.id)
+    ).scalar()
+
+    if operation_ids is not None:
+        if operation_ids:
+            db.execute(insert(SettlementItems), [
+                {"settlement_id": created, "operation_id": operation_id, "status": 'PENDING'}
+                for operation_id in dict.fromkeys(operation_ids)
+            ])
+        return created
+
+    holds = select(literal(created), Transactions.transaction_id, literal('PENDING')).where(
+        Transactions.account_id == account_id,
+        Transactions.transaction_type == 'HOLD',
+        Transactions.transaction_status == 'PENDING'
+    ).order_by(Transactions.id)
+    if created_before is not None:
+        holds = holds.where(Transactions.transaction_date < created_before)
+    db.execute(insert(SettlementItems).from_select(['settlement_id', 'operation_id', 'status'], holds))
+    return created
+
+
+def settle_chunk(db: Session, settlement_pk: int, chunk_size: int) -> int:
+    '''
+    Обработка одной части пакета в транзакции `db` без ее фиксации.
+
+    Выходные данные - количество обработанных элементов; 0 - свободных необработанных элементов нет.
+    '''
+    items = db.execute(
+        select(SettlementItems.id, SettlementItems.operation_id)
+        .where(SettlementItems.settlement_id == settlement_pk, SettlementItems.status == 'PENDING')
+        .order_by(SettlementItems.id)
+        .limit(chunk_size)
+        .with_for_update(skip_locked=True)
+    ).all()
+    if not items:
+        return 0
+
+    holds = {
+        str(row.transaction_id): row
+        for row in db.execute(
+            select(
+                Transactions.id, Transactions.transaction_id, Transactions.transaction_type,
+                Transactions.transaction_status, Transactions.account_id, Transactions.amount,
+                Transactions.hold_slot
+            )
+            .where(Transactions.transaction_id.in_([item.operation_id for item in items]))
+            .order_by(Transactions.id)
+            .with_for_update()
+        )
+    }
+
+    '''
+    Проверка каждого элемента так же, как при одиночном списании (см. services.py - charge_funds()).
+    '''
+    results = {}
+    candidates = []
+    for item in items:
+        operation_id = str(item.operation_id)
+        hold = holds.get(operation_id)
+        if hold is None:
+            results[item.id] = ('FAILED', None, None, f"Транзакция удержания с ID '{operation_id}' не найдена.")
+        elif hold.transaction_type != 'HOLD':
+            results[item.id] = ('FAILED', hold.account_id, hold.amount, f"Транзакция с ID '{operation_id}' не является операцией удержания.")
+        elif hold.transaction_status == 'COMPLETED':
+            results[item.id] = ('SKIPPED', hold.account_id, hold.amount, "Средства по данной операции уже списаны.")
+        elif hold.transaction_status != 'PENDING':
+            results[item.id] = ('FAILED', hold.account_id, hold.amount, f"Транзакция с ID '{operation_id}' имеет статус '{hold.transaction_status}', невозможно списать. Ожидается 'PENDING'.")
+        else:
+            candidates.append((item.id, hold))
+
+    totals: dict = {}
+    slot_totals: dict = {}
+    for _, hold in candidates:
+        totals[hold.account_id] = totals.get(hold.account_id, Decimal('0.00')) + hold.amount
+        if hold.hold_slot is not None:
+            key = (hold.account_id, hold.hold_slot)
+            slot_totals[key] = slot_totals.get(key, Decimal('0.00')) + hold.amount
+
+    accounts = {}
+    if totals:
+        accounts = {
+            row.id: row
+            for row in db.execute(
+                select(Accounts.id, Accounts.held_balance)
+                .where(Accounts.id.in_(totals))
+                .order_by(Accounts.id)
+                .with_for_update(key_share=True)
+            )
+        }
+    slots = lock_slots(db, slot_totals)
+
+    '''
+    Счет (слот), на котором удерживаемых средств меньше суммы его удержаний в части, не изменяется,
+    а все его удержания части получают ошибку.
+    '''
+    charged = []
+    for item_id, hold in candidates:
+        account = accounts.get(hold.account_id)
+        key = (hold.account_id, hold.hold_slot)
+        if account is None:
+            results[item_id] = ('FAILED', None, hold.amount, f"Счет с ID '{hold.account_id}' для транзакции '{hold.transaction_id}' не найден.")
+        elif account.held_balance < totals[hold.account_id]:
+            results[item_id] = ('FAILED', hold.account_id, hold.amount, f"Недостаточно удерживаемых средств на счету для списания операции '{hold.transaction_id}'. Удержано: {account.held_balance}, требуется: {totals[hold.account_id]}.")
+        elif hold.hold_slot is not None and slots.get(key, Decimal('0.00')) < slot_totals[key]:
+            results[item_id] = ('FAILED', hold.account_id, hold.amount, f"Недостаточно удерживаемых средств в слоте {hold.hold_slot} счета для списания операции '{hold.transaction_id}'. Удержано: {slots.get(key, Decimal('0.00'))}, требуется: {slot_totals[key]}.")
+        else:
+            results[item_id] = ('CHARGED', hold.account_id, hold.amount, "Средства успешно списаны.")
+            charged.append(hold)
+
+    if charged:
+        charged_totals: dict = {}
+        charged_slots: dict = {}
+        for hold in charged:
+            charged_totals[hold.account_id] = charged_totals.get(hold.account_id, Decimal('0.00')) + hold.amount
+            if hold.hold_slot is not None:
+                key = (hold.account_id, hold.hold_slot)
+                charged_slots[key] = charged_slots.get(key, Decimal('0.00')) + hold.amount
+
+        db.execute(
+            update(Transactions)
+            .where(Transactions.id.in_([hold.id for hold in charged]))
+            .values(transaction_status='COMPLETED', transaction_date=datetime.now(timezone.utc))
+            .execution_options(synchronize_session=False)
+        )
+        release_slots(db, charged_slots, charge=True)
+        charged_values = values(
+            column('account_id', Integer), column('amount', DECIMAL(15, 2)), name='charged'
+        ).data(sorted(charged_totals.items()))
+        balances = {
+            row.id: row
+            for row in db.execute(
+                update(Accounts)
+                .where(Accounts.id == charged_values.c.account_id)
+                .values(
+                    balance=Accounts.balance - charged_values.c.amount,
+                    held_balance=Accounts.held_balance - charged_values.c.amount
+                )
+                .returning(Accounts.id, Accounts.account_number, Accounts.currency, BALANCE, HELD_BALANCE)
+                .execution_options(synchronize_session=False)
+            )
+        }
+
+        for account in balances.values():
+            project_balance(db, account.account_number, account.currency, account.balance, account.held_balance)
+
+        '''
+        Балансы после каждого списания части восстанавливаются от значений до части.
+        '''
+        running = {
+            account_id: [balances[account_id].balance + amount, balances[account_id].held_balance + amount]
+            for account_id, amount in charged_totals.items()
+        }
+        for hold in charged:
+            operation_id = str(hold.transaction_id)
+            running[hold.account_id][0] -= hold.amount
+            running[hold.account_id][1] -= hold.amount
+            after_commit(db, idempotency_cache.forget, operation_id, 'hold')
+            journal(
+                db, operation_id, hold.account_id, 'CHARGE', hold.amount,
+                -hold.amount, -hold.amount, *running[hold.account_id]
+            )
+            publish(db, 'CHARGE', operation_id, hold.account_id, hold.amount, *running[hold.account_id])
+
+    db.execute(update(SettlementItems), [
+        {"id": item_id, "status": status, "account_id": account_id, "amount": amount, "message": message}
+        for item_id, (status, account_id, amount, message) in results.items()
+    ])
+
+    for status, *_ in results.values():
+        settled_total.inc((status,))
+    return len(items)
+
+
+def run_settlement(settlement_id: str, chunk_size: int = None) -> dict:
+    '''
+    Обработка всех необработанных элементов пакета по частям, каждая часть в своей транзакции.
+    Пакет переводится в статус COMPLETED, когда необработанных элементов не осталось.
+
+    Выходные данные - отчет по пакету (см. settlement_report()) без элементов.
+    '''
+    chunk_size = chunk_size or app_settings.settlement_chunk_size
+
+    db = session()
+    try:
+        settlement_pk = db.scalar(select(Settlements.id).where(Settlements.settlement_id == settlement_id))
+    finally:
+        db.close()
+    if settlement_pk is None:
+        raise ValueError(f"Пакетное списание с ID '{settlement_id}' не найдено.")
+
+    while True:
+        chunk_started = time.perf_counter()
+        db = session()
+        try:
+            processed = settle_chunk(db, settlement_pk, chunk_size)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+        if not processed:
+            break
+        settlement_chunk_duration.observe((), time.perf_counter() - chunk_started)
+        logger.info("Пакетное списание %s: обработано %d элементов.", settlement_id, processed)
+
+    '''
+    Элементы, заблокированные параллельным запуском, пропускаются SKIP LOCKED, но остаются
+    в статусе PENDING до его фиксации - тогда пакет завершит параллельный запуск.
+    '''
+    db = session()
+    try:
+        db.execute(
+            update(Settlements)
+            .where(
+                Settlements.id == settlement_pk,
+                Settlements.status == 'RUNNING',
+                ~select(SettlementItems.id).where(
+                    SettlementItems.settlement_id == settlement_pk,
+                    SettlementItems.status == 'PENDING'
+                ).exists()
+            )
+            .values(status='COMPLETED', finished_at=datetime.now(timezone.utc))
+        )
+        db.commit()
+        return settlement_report(db, settlement_id, items=False)
+    finally:
+        db.close()
+
+
+def settle(settlement_id: str, operation_ids: list = None, account_id: int = None,
+           created_before: datetime = None, chunk_size: int = None) -> tuple:
+    '''
+    Создание пакета (если пакета с `settlement_id` еще нет) и его обработка.
+    Для существующего пакета условия отбора не учитываются: обработка продолжается
+    с необработанных элементов.
+
+    Выходные данные - кортеж `(created, report)`, где `created` - был ли пакет создан этим вызовом.
+    '''
+    db = session()
+    try:
+        create_settlement(db, settlement_id, operation_ids, account_id, created_before)
+        db.commit()
+        created = True
+    except IntegrityError:
+        db.rollback()
+        created = False
+    finally:
+        db.close()
+
+    return created, run_settlement(settlement_id, chunk_size)
+
+
+def settlement_report(db: Session, settlement_id: str, items: bool = True):
+    '''
+    Отчет по пакету:
+
+    ```
+    {
+        "settlement_id": "XXXXXXXX-XXXX-XXXX-XXXX-XXXXXXXXXXXX",
+        "status": "COMPLETED",
+        "created_at": "2026-10-18T12:00:00",
+        "finished_at": "2026-10-18T12:00:03",
+        "total": 3,
+        "pending": 0,
+        "charged": 1,
+        "skipped": 1,
+        "failed": 1,
+        "charged_amount": 100.00,
+        "items": [
+            {
+                "operation_id": "YYYYYYYY-YYYY-YYYY-YYYY-YYYYYYYYYYYY",
+                "status": "CHARGED",
+                "account_id": "ZZZZZZZZ-ZZZZ-ZZZZ-ZZZZ-ZZZZZZZZZZZZ",
+                "amount": 100.00,
+                "message": "Средства успешно списаны."
+            }
+        ]
+    }
+    ```
+
+    Выходные данные - отчет или None, если пакета нет. С `items=False` поле `items` не выводится.
+    '''
+    settlement = db.scalars(select(Settlements).where(Settlements.settlement_id == settlement_id)).first()
+    if settlement is None:
+        return None
+
+    counts = {
+        row.status: (row.count, row.amount)
+        for row in db.execute(
+            select(
+                SettlementItems.status,
+                func.count().label('count'),
+                func.coalesce(func.sum(SettlementItems.amount), 0).label('amount')
+            )
+            .where(SettlementItems.settlement_id == settlement.id)
+            .group_by(SettlementItems.status)
+        )
+    }
+    report = {
+        "settlement_id": str(settlement.settlement_id),
+        "status": settlement.status,
+        "created_at": settlement.created_at.isoformat(),
+        "finished_at": settlement.finished_at.isoformat() if settlement.finished_at else None,
+        "total": sum(count for count, _ in counts.values()),
+        "pending": counts.get('PENDING', (0, 0))[0],
+        "charged": counts.get('CHARGED', (0, 0))[0],
+        "skipped": counts.get('SKIPPED', (0, 0))[0],
+        "failed": counts.get('FAILED', (0, 0))[0],
+        "charged_amount": counts.get('CHARGED', (0, Decimal('0.00')))[1]
+    }
+
+    if items:
+        report["items"] = [
+            {
+                "operation_id": str(row.operation_id),
+                "status": row.status,
+                "account_id": str(row.account_number) if row.account_number else None,
+                "amount": row.amount,
+                "message": row.message
+            }
+            for row in db.execute(
+                select(
+                    SettlementItems.operation_id, SettlementItems.status, SettlementItems.amount,
+                    SettlementItems.message, Accounts.account_number
+                )
+                .outerjoin(Accounts, Accounts.id == SettlementItems.account_id)
+                .where(SettlementItems.settlement_id == settlement.id)
+                .order_by(SettlementItems.id)
+            )
+        ]
+    return report
+
+
+def get_settlement_report(settlement_id: str, items: bool = True):
+    '''
+    Отчет по пакету (см. settlement_report()) в отдельной сессии.
+    '''
+    db = session()
+    try:
+        return settlement_report(db, settlement_id, items)
+    finally:
+        db.close()
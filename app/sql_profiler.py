@@ -0,0 +1,216 @@
+'''
+Профилировщик SQL-запросов.
+
+Включается настройкой `SQL_PROFILE` и подключается к событиям движка SQLAlchemy
+(`before_cursor_execute` / `after_cursor_execute`). В отличие от `DB_ECHO` запросы не выводятся
+в лог, а группируются по «отпечатку» - тексту запроса, в котором параметры и литералы
+заменены на `?`. Для каждого отпечатка считаются количество выполнений, количество строк
+в пакетных запросах (executemany), суммарное и максимальное время.
+
+Запросы дольше `SQL_SLOW_QUERY_MS` записываются в лог с предупреждением и сохраняются
+в списке последних медленных запросов.
+
+Отчет доступен по адресу `GET /api/admin/sql-profile` и выводится при завершении процесса:
+в лог или в файл `SQL_PROFILE_DUMP`, если он задан (например, `sql-profile-{pid}.json`).
+'''
+import atexit
+import json
+import logging
+import os
+import re
+import time
+from collections import deque
+from threading import Lock
+from sqlalchemy import event
+from app.settings import app_settings
+
+logger = logging.getLogger(__name__)
+
+'''
+Параметры psycopg (`%(account_number_1)s`, `%s`), строковые и числовые литералы,
+списки значений в IN (...) и повторяющиеся пробелы.
+'''
+_PARAMETER = re.compile(r"%\(\w+\)s|%s|'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_VALUES_LIST = re.compile(r"\(\s*\?(?:::\w+)?(?:\s*,\s*\?(?:::\w+)?)+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def fingerprint(statement: str) -> str:
+    statement = _PARAMETER.sub('?', statement)
+    statement = _VALUES_LIST.sub('(?, ...)', statement)
+    return _WHITESPACE.sub(' ', statement).strip()
+
+
+class QueryStats:
+    __slots__ = ('calls', 'rows', 'total', 'max')
+
+    def __init__(self):
+        self.calls = 0
+        self.rows = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+class SqlProfiler:
+    '''
+    Статистика запросов по отпечаткам.
+
+    Отпечатки вычисляются регулярными выражениями, поэтому результат запоминается для каждого
+    исходного текста запроса: SQLAlchemy кэширует скомпилированные запросы, и набор различных
+    текстов ограничен.
+    '''
+
+    ORDERS = ('total', 'calls', 'max', 'avg')
+
+    def __init__(self, slow_query_ms: float, slow_log_size: int = 100, fingerprint_cache_size: int = 10000):
+        self.slow_query = slow_query_ms / 1000
+        self.slow_log = deque(maxlen=slow_log_size)
+        self.fingerprint_cache_size = fingerprint_cache_size
+        self.fingerprints = {}
+        self.stats = {}
+        self.lock = Lock()
+        self.started = time.time()
+
+    def attach(self, engine):
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    '''
+    Время начала хранится в контексте выполнения запроса, который создается заново для каждого
+    запроса, поэтому запросы, завершившиеся ошибкой (after_cursor_execute не вызывается), не
+    оставляют после себя состояния.
+    '''
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        context._sql_profiler_started = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._sql_profiler_started
+        rows = len(parameters) if executemany else 1
+        self.record(statement, elapsed, rows)
+
+    def record(self, statement: str, elapsed: float, rows: int = 1):
+        key = self.fingerprints.get(statement)
+        if key is None:
+            key = fingerprint(statement)
+            if len(self.fingerprints) < self.fingerprint_cache_size:
+                self.fingerprints[statement] = key
+
+        with self.lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = QueryStats()
+            stats.calls += 1
+            stats.rows += rows
+            stats.total += elapsed
+            if elapsed > stats.max:
+                stats.max = elapsed
+
+        if elapsed >= self.slow_query:
+            self.slow_log.append({
+                "statement": key,
+                "duration_ms": round(elapsed * 1000, 3),
+                "at": time.time()
+            })
+            logger.warning("Медленный SQL-запрос (%.1f мс): %s", elapsed * 1000, key)
+
+    def reset(self):
+        with self.lock:
+            self.stats.clear()
+            self.slow_log.clear()
+            self.started = time.time()
+
+    def report(self, limit: int = 20, order: str = 'total') -> dict:
+        '''
+        Отчет по запросам, упорядоченный по `order` (total, calls, max или avg):
+
+        ```
+        {
+            "since": 1760813861.2,
+            "statements": 14,
+            "calls": 5210,
+            "total_ms": 8123.4,
+            "slow_query_ms": 100,
+            "top": [
+                {
+                    "statement": "SELECT accounts.id, ... WHERE accounts.account_number = ? LIMIT ?",
+                    "calls": 1302,
+                    "rows": 1302,
+                    "total_ms": 2011.2,
+                    "avg_ms": 1.545,
+                    "max_ms": 31.2,
+                    "share": 0.248
+                },
+                ...
+            ],
+            "slow": [{"statement": "...", "duration_ms": 153.2, "at": 1760813900.1}, ...]
+        }
+        ```
+        '''
+        if order not in self.ORDERS:
+            raise ValueError(f"Недопустимый порядок сортировки '{order}'. Допустимые значения: {', '.join(self.ORDERS)}.")
+
+        with self.lock:
+            items = [(key, s.calls, s.rows, s.total, s.max) for key, s in self.stats.items()]
+            slow = list(self.slow_log)
+
+        total = sum(item[3] for item in items)
+        sort_key = {
+            'total': lambda item: item[3],
+            'calls': lambda item: item[1],
+            'max': lambda item: item[4],
+            'avg': lambda item: item[3] / item[1],
+        }[order]
+        items.sort(key=sort_key, reverse=True)
+
+        return {
+            "since": self.started,
+            "statements": len(items),
+            "calls": sum(item[1] for item in items),
+            "total_ms": round(total * 1000, 3),
+            "slow_query_ms": self.slow_query * 1000,
+            "top": [
+                {
+                    "statement": key,
+                    "calls": calls,
+                    "rows": rows,
+                    "total_ms": round(elapsed * 1000, 3),
+                    "avg_ms": round(elapsed * 1000 / calls, 3),
+                    "max_ms": round(longest * 1000, 3),
+                    "share": round(elapsed / total, 3) if total else 0.0
+                }
+                for key, calls, rows, elapsed, longest in items[:limit]
+            ],
+            "slow": slow
+        }
+
+    def dump(self, path: str = None):
+        '''
+        Вывод отчета в файл `path` (JSON) или в лог. Подстрока `{pid}` в `path` заменяется
+        на номер процесса, чтобы процессы production-сервера не перезаписывали отчеты друг друга.
+        '''
+        report = self.report(limit=len(self.stats) or 1)
+        if not report["calls"]:
+            return
+        if path:
+            with open(path.replace('{pid}', str(os.getpid())), 'w') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            return
+        lines = [f"Профиль SQL: {report['calls']} запросов, {report['total_ms']} мс"]
+        for item in report["top"]:
+            lines.append(f"{item['total_ms']:>12.1f} мс {item['calls']:>8} x {item['avg_ms']:>8.3f} мс  {item['statement']}")
+        logger.warning('\n'.join(lines))
+
+
+sql_profiler = SqlProfiler(app_settings.sql_slow_query_ms) if app_settings.sql_profile else None
+
+
+def attach(engine):
+    '''
+    Подключение профилировщика к движку, если профилирование включено.
+    '''
+    if sql_profiler is not None:
+        sql_profiler.attach(engine)
+
+
+if sql_profiler is not None:
+    atexit.register(sql_profiler.dump, app_settings.sql_profile_dump)
@@ -0,0 +1,217 @@
+'''
+Освобождение просроченных удержаний.
+
+Удержание в статусе PENDING, созданное раньше чем `HOLD_TTL_SECONDS` назад, считается
+просроченным: оно переводится в статус EXPIRED, а его сумма вычитается из удерживаемого
+баланса счета.
+
+Удержания обрабатываются пакетами по `SWEEP_BATCH_SIZE`, каждый пакет - одна транзакция:
+1. один UPDATE переводит пакет удержаний в статус EXPIRED. Строки выбираются по частичному
+   индексу просроченных удержаний (transaction_date, id) (см. database/transactions.py) в порядке
+   этого индекса, поэтому выборка пакета не сортирует все просроченные удержания, а останавливается
+   на `SWEEP_BATCH_SIZE` строках. Выборка идет с `FOR UPDATE SKIP LOCKED`:
+   удержания, которые в этот момент списываются или отменяются, пропускаются и не ждут;
+2. строки затронутых счетов блокируются в порядке id - в том же порядке, что и при пакетном
+   удержании, поэтому параллельные пакеты не блокируют друг друга взаимно;
+3. один UPDATE ... FROM (VALUES ...) уменьшает удерживаемый баланс всех счетов пакета.
+   Удержания, выполненные через слоты "горячих" счетов, освобождаются в своих слотах
+   (см. hot_accounts.py): слоты блокируются после счетов и изменяются таким же одним UPDATE.
+
+Списание или отмена, ожидавшие блокировку строки удержания, после фиксации пакета видят
+статус EXPIRED и получают ошибку. Несколько экземпляров очистки могут работать одновременно:
+SKIP LOCKED распределяет между ними разные удержания.
+
+Запуск: `python run.py sweep` (постоянно, раз в `SWEEP_INTERVAL_SECONDS`) или `python run.py sweep --once`.
+Каждый проход также перераспределяет слоты горячих счетов (`HOT_ACCOUNT_REBALANCE`).
+'''
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from sqlalchemy import select, update, values, column, Integer, DECIMAL
+from sqlalchemy.orm import Session
+from app.balance_cache import project_balance
+from app.database import Accounts, Transactions
+from app.db_session import session, after_commit
+from app.hot_accounts import BALANCE, HELD_BALANCE, lock_slots, release_slots, rebalance_accounts
+from app.idempotency import idempotency_cache
+from app.ledger import journal
+from app.outbox import publish
+from app.metrics import registry, Counter, Histogram
+from app.settings import app_settings
+
+logger = logging.getLogger(__name__)
+
+expired_total = registry.register(Counter(
+    'holds_expired_total', 'Количество освобожденных просроченных удержаний.', ()
+))
+expired_amount_total = registry.register(Counter(
+    'holds_expired_amount_total', 'Сумма освобожденных просроченных удержаний.', ()
+))
+sweep_batch_duration = registry.register(Histogram(
+    'hold_sweep_batch_duration_seconds', 'Длительность обработки пакета просроченных удержаний в секундах.', ()
+))
+
+
+def expire_batch(db: Session, cutoff: datetime, batch_size: int) -> list:
+    '''
+    Освобождение одного пакета удержаний, созданных раньше `cutoff`, в транзакции `db` без ее фиксации.
+
+    Выходные данные - список освобожденных удержаний `(operation_id, account_id, amount)`.
+    '''
+    expired_ids = (
+        select(Transactions.id)
+        .where(
+            Transactions.transaction_type == 'HOLD',
+            Transactions.transaction_status == 'PENDING',
+            Transactions.transaction_date < cutoff
+        )
+        .order_by(Transactions.transaction_date, Transactions.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    expired = db.execute(
+        update(Transactions)
+        .where(Transactions.id.in_(expired_ids))
+        .values(transaction_status='EXPIRED', transaction_date=datetime.now(timezone.utc))
+        .returning(Transactions.transaction_id, Transactions.account_id, Transactions.amount, Transactions.hold_slot)
+        .execution_options(synchronize_session=False)
+    ).all()
+    if not expired:
+        return []
+
+    '''
+    `released` - все освобождаемые суммы по счетам, `account_released` - та их часть, что
+    уменьшает удерживаемый баланс в строке счета, `slot_released` - суммы по слотам.
+    '''
+    released: dict = {}
+    account_released: dict = {}
+    slot_released: dict = {}
+    for hold in expired:
+        released[hold.account_id] = released.get(hold.account_id, Decimal('0.00')) + hold.amount
+        account_released.setdefault(hold.account_id, Decimal('0.00'))
+        if hold.hold_slot is None:
+            account_released[hold.account_id] += hold.amount
+        else:
+            key = (hold.account_id, hold.hold_slot)
+            slot_released[key] = slot_released.get(key, Decimal('0.00')) + hold.amount
+
+    db.execute(
+        select(Accounts.id)
+        .where(Accounts.id.in_(released))
+        .order_by(Accounts.id)
+        .with_for_update(key_share=True)
+    ).all()
+    lock_slots(db, slot_released)
+    release_slots(db, slot_released, charge=False)
+
+    released_values = values(
+        column('account_id', Integer), column('amount', DECIMAL(15, 2)), name='released'
+    ).data(sorted(account_released.items()))
+    balances = {
+        row.id: row
+        for row in db.execute(
+            update(Accounts)
+            .where(Accounts.id == released_values.c.account_id)
+            .values(held_balance=Accounts.held_balance - released_values.c.amount)
+            .returning(Accounts.id, Accounts.account_number, Accounts.currency, BALANCE, HELD_BALANCE)
+            .execution_options(synchronize_session=False)
+        )
+    }
+
+    for account in balances.values():
+        project_balance(db, account.account_number, account.currency, account.balance, account.held_balance)
+
+    '''
+    Удерживаемый баланс после каждого удержания пакета восстанавливается от значения до пакета.
+    '''
+    held_after = {account_id: balances[account_id].held_balance + amount for account_id, amount in released.items()}
+    for hold in expired:
+        operation_id = str(hold.transaction_id)
+        held_after[hold.account_id] -= hold.amount
+        after_commit(db, idempotency_cache.forget, operation_id, 'hold')
+        journal(
+            db, operation_id, hold.account_id, 'EXPIRE', hold.amount, Decimal('0.00'), -hold.amount,
+            balances[hold.account_id].balance, held_after[hold.account_id]
+        )
+        publish(db, 'EXPIRE', operation_id, hold.account_id, hold.amount, balances[hold.account_id].balance, held_after[hold.account_id])
+
+    return [(str(hold.transaction_id), hold.account_id, hold.amount) for hold in expired]
+
+
+def sweep(ttl: int = None, batch_size: int = None, max_batches: int = None) -> dict:
+    '''
+    Освобождение всех удержаний старше `ttl` секунд пакетами по `batch_size`.
+    При `ttl` 0 удержания не освобождаются.
+
+    Выходные данные - итоги прохода:
+
+    ```
+    {"batches": 3, "expired": 2412, "amount": 120600.00, "seconds": 0.84}
+    ```
+    '''
+    ttl = app_settings.hold_ttl_seconds if ttl is None else ttl
+    batch_size = batch_size or app_settings.sweep_batch_size
+    if ttl <= 0:
+        return {"batches": 0, "expired": 0, "amount": Decimal('0.00'), "seconds": 0.0}
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=ttl)
+
+    started = time.perf_counter()
+    batches = expired_count = 0
+    amount = Decimal('0.00')
+
+    while max_batches is None or batches < max_batches:
+        batch_started = time.perf_counter()
+        db = session()
+        try:
+            expired = expire_batch(db, cutoff, batch_size)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+        if not expired:
+            break
+
+        batch_amount = sum((hold[2] for hold in expired), Decimal('0.00'))
+        batches += 1
+        expired_count += len(expired)
+        amount += batch_amount
+
+        expired_total.inc((), len(expired))
+        expired_amount_total.inc((), float(batch_amount))
+        sweep_batch_duration.observe((), time.perf_counter() - batch_started)
+        logger.info("Освобождено %d просроченных удержаний на сумму %s (пакет %d).", len(expired), batch_amount, batches)
+
+        if len(expired) < batch_size:
+            break
+
+    return {
+        "batches": batches,
+        "expired": expired_count,
+        "amount": amount,
+        "seconds": round(time.perf_counter() - started, 3)
+    }
+
+
+def run_forever(interval: float = None):
+    '''
+    Очистка раз в `interval` секунд до остановки процесса.
+    '''
+    interval = interval or app_settings.sweep_interval_seconds
+    while True:
+        try:
+            result = sweep()
+            if app_settings.hot_account_rebalance:
+                rebalance_accounts()
+            if result["expired"]:
+                logger.warning(
+                    "Очистка: %d удержаний на сумму %s за %s с.",
+                    result["expired"], result["amount"], result["seconds"]
+                )
+        except Exception:
+            logger.exception("Ошибка очистки просроченных удержаний.")
+        time.sleep(interval)
@@ -0,0 +1,11 @@
+'''
+Нагрузочные проверки и бенчмарки сервиса.
+
+Скрипты запускаются из корня репозитория как модули, например:
+
+```sh
+python -m bench.stress_hold
+```
+
+Подключение к базе данных берется из тех же переменных окружения, что и у сервера.
+'''
@@ -0,0 +1,71 @@
+'''
+Общие функции для нагрузочных проверок: заполнение базы тестовыми клиентами и счетами.
+'''
+import datetime
+import uuid
+from sqlalchemy import insert, select
+from app.db_session import session
+from app.database import Clients, Accounts
+from app.ledger import open_accounts
+from app.hot_accounts import account_balances
+
+
+def seed_accounts(count: int, balance: float, currency: str = 'KZT') -> list:
+    '''
+    Создает одного тестового клиента и `count` счетов с балансом `balance`
+    и записи OPENING в журнале изменений для них.
+
+    Выходные данные - список номеров (UUID) созданных счетов.
+    '''
+    db = session()
+    try:
+        client = Clients(
+            first_name='Bench',
+            last_name='Client',
+            date_of_birth=datetime.date(1990, 1, 1),
+            address='-',
+            phone_number='-'
+        )
+        db.add(client)
+        db.flush()
+
+        account_numbers = [str(uuid.uuid4()) for _ in range(count)]
+        db.execute(insert(Accounts), [
+            {
+                "client_id": client.id,
+                "account_number": number,
+                "account_type": 'bench',
+                "balance": balance,
+                "currency": currency,
+                "held_balance": 0
+            }
+            for number in account_numbers
+        ])
+        open_accounts(db, select(Accounts.id).where(Accounts.client_id == client.id))
+        db.commit()
+        return account_numbers
+    finally:
+        db.close()
+
+
+def load_account(account_number: str) -> Accounts:
+    '''
+    Возвращает актуальное состояние счета из базы данных.
+    '''
+    db = session()
+    try:
+        return db.scalars(select(Accounts).where(Accounts.account_number == account_number)).one()
+    finally:
+        db.close()
+
+
+def load_balances(account_number: str):
+    '''
+    Возвращает баланс и удерживаемый баланс счета с учетом слотов "горячего" счета (см. app/hot_accounts.py).
+    '''
+    db = session()
+    try:
+        account_id = db.scalar(select(Accounts.id).where(Accounts.account_number == account_number))
+        return account_balances(db, account_id)
+    finally:
+        db.close()
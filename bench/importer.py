@@ -0,0 +1,169 @@
+'''
+Проверка массовой загрузки клиентов, счетов и карт (см. app/importer.py).
+
+Генерирует CSV-файлы с `--clients` клиентами, счетом на каждого клиента и картой на каждый счет,
+добавляя в каждый файл строки с ошибками (некорректные значения, ссылки на несуществующие записи,
+повторы ключей), и загружает их:
+1. через COPY - загружены все корректные строки, ошибочные строки попали в отчет с номерами строк,
+   у новых счетов есть записи OPENING и балансы сходятся с журналом;
+2. повторно - ничего не загружено, все корректные строки пропущены как существующие;
+3. через пакетный INSERT на новых файлах того же размера - для сравнения скорости.
+
+Пиковый объем памяти, выделенной при загрузке (tracemalloc), сравнивается с загрузкой файлов
+в `--scale` раз меньше: при загрузке частями он не должен расти вместе с размером файла.
+
+```sh
+python -m bench.importer --clients 20000
+```
+
+Код завершения 1, если обнаружено расхождение.
+'''
+import argparse
+import csv
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from sqlalchemy import select
+from app.db_session import engine, session
+from app.database import Accounts, Clients
+from app.importer import ImportReport, import_files
+from app.ledger import replay_balances
+
+BROKEN = 6
+
+
+def write_files(directory: str, count: int) -> tuple:
+    '''
+    Файлы клиентов, счетов и карт. В каждый файл после корректных строк добавляется
+    `BROKEN` строк с ошибками и одна строка-повтор.
+
+    Выходные данные - пути к файлам и префикс external_id клиентов.
+    '''
+    prefix = uuid.uuid4().hex[:12]
+    paths = tuple(os.path.join(directory, f'{prefix}-{name}.csv') for name in ('clients', 'accounts', 'cards'))
+    card_base = int(uuid.uuid4().int % 10 ** 8) * 10 ** 8
+    accounts = []
+
+    with open(paths[0], 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(('external_id', 'first_name', 'last_name', 'middle_name', 'date_of_birth', 'address', 'phone_number'))
+        for number in range(count):
+            writer.writerow((f'{prefix}-{number}', 'Имя', 'Фамилия', '', '1990-01-31', 'Алматы', '+7 700 000 00 00'))
+        writer.writerow((f'{prefix}-0', 'Повтор', 'Клиента', '', '1990-01-31', 'Алматы', '+7 700 000 00 00'))
+        writer.writerow((f'{prefix}-bad-1', '', 'Без имени', '', '1990-01-31', 'Алматы', '+7 700 000 00 00'))
+        writer.writerow((f'{prefix}-bad-2', 'Имя', 'Фамилия', '', '31.01.1990', 'Алматы', '+7 700 000 00 00'))
+        writer.writerow((f'{prefix}-bad-3', 'Имя', 'Фамилия', '', '2999-01-01', 'Алматы', '+7 700 000 00 00'))
+        writer.writerow((f'{prefix}-bad-4', 'Имя', 'Фамилия', '', '1990-01-31', 'Алматы', 'телефон'))
+        writer.writerow((f'{prefix}-bad-5', 'Имя' * 30, 'Фамилия', '', '1990-01-31', 'Алматы', '+7 700 000 00 00'))
+        writer.writerow((f'{prefix}-bad-6', 'Имя', 'Фамилия', '', '1990-02-30', 'Алматы', '+7 700 000 00 00'))
+
+    with open(paths[1], 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(('client_external_id', 'account_number', 'account_type', 'balance', 'currency'))
+        for number in range(count):
+            account_number = str(uuid.uuid4())
+            accounts.append(account_number)
+            writer.writerow((f'{prefix}-{number}', account_number, 'current', f'{number % 1000}.50', 'kzt'))
+        writer.writerow((f'{prefix}-1', accounts[0], 'current', '1.00', 'KZT'))
+        writer.writerow((f'{prefix}-missing', str(uuid.uuid4()), 'current', '1.00', 'KZT'))
+        writer.writerow((f'{prefix}-1', 'не-uuid', 'current', '1.00', 'KZT'))
+        writer.writerow((f'{prefix}-1', str(uuid.uuid4()), 'current', '-5.00', 'KZT'))
+        writer.writerow((f'{prefix}-1', str(uuid.uuid4()), 'current', '1.005', 'KZT'))
+        writer.writerow((f'{prefix}-1', str(uuid.uuid4()), 'current', '1e100', 'KZT'))
+        writer.writerow((f'{prefix}-1', str(uuid.uuid4()), 'current', '1.00', 'тенге'))
+
+    with open(paths[2], 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(('account_number', 'card_number', 'expiry_date', 'cvc', 'cardholder_name', 'issue_date'))
+        for number, account_number in enumerate(accounts):
+            writer.writerow((account_number, str(4000000000000000 + card_base + number), '12/29', '123', 'IMYA FAMILIYA', '2025-01-01'))
+        writer.writerow((accounts[1], str(4000000000000000 + card_base), '2029-12-31', '123', 'IMYA FAMILIYA', '2025-01-01'))
+        writer.writerow((str(uuid.uuid4()), '4111111111111111', '12/29', '123', 'IMYA FAMILIYA', '2025-01-01'))
+        writer.writerow((accounts[1], '4111', '12/29', '123', 'IMYA FAMILIYA', '2025-01-01'))
+        writer.writerow((accounts[1], '4111111111111112', '13/29', '123', 'IMYA FAMILIYA', '2025-01-01'))
+        writer.writerow((accounts[1], '4111111111111113', '12/29', '12a', 'IMYA FAMILIYA', '2025-01-01'))
+        writer.writerow((accounts[1], '4111111111111114', '12/29', '123', 'IMYA FAMILIYA', '2030-01-01'))
+        writer.writerow((accounts[1], '4111111111111115', '12/29', '123', 'IMYA FAMILIYA', 'вчера'))
+    return paths, prefix
+
+
+def run_import(paths: tuple, method: str) -> tuple:
+    output = io.StringIO()
+    tracemalloc.start()
+    started = time.perf_counter()
+    report = import_files(*paths, report=ImportReport(output), method=method)
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return report, list(csv.DictReader(io.StringIO(output.getvalue()))), elapsed, peak
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=20000)
+    parser.add_argument('--scale', type=int, default=4, help='во сколько раз меньше файлы для сравнения памяти')
+    args = parser.parse_args()
+
+    engine.echo = False
+    directory = tempfile.mkdtemp(prefix='import-')
+    failures = []
+    try:
+        small_paths, _ = write_files(directory, max(args.clients // args.scale, 10))
+        _, _, _, small_peak = run_import(small_paths, 'copy')
+
+        paths, prefix = write_files(directory, args.clients)
+        report, rows, elapsed, peak = run_import(paths, 'copy')
+        rate = 3 * args.clients / elapsed
+        print(f"COPY: {report.totals}, {elapsed:.1f} с ({rate:.0f} строк/с), пик памяти {peak / 2 ** 20:.1f} МБ "
+              f"(в {args.scale} раз меньше файлы: {small_peak / 2 ** 20:.1f} МБ)")
+
+        for name in ('clients', 'accounts', 'cards'):
+            expected = {"inserted": args.clients, "skipped": 1, "failed": BROKEN}
+            if report.totals.get(name) != expected:
+                failures.append(f"{name}: {report.totals.get(name)} вместо {expected}")
+        failed_lines = sorted(int(row['line']) for row in rows if row['status'] == 'failed' and row['file'] == paths[0])
+        if failed_lines != list(range(args.clients + 3, args.clients + 3 + BROKEN)):
+            failures.append(f"номера ошибочных строк клиентов: {failed_lines}")
+        if peak > small_peak * 2:
+            failures.append(f"пик памяти вырос с {small_peak} до {peak} байт вместе с размером файла")
+
+        db = session()
+        try:
+            account_ids = db.scalars(
+                select(Accounts.id).join(Clients, Clients.id == Accounts.client_id).where(Clients.external_id.like(f'{prefix}-%'))
+            ).all()
+            mismatches = replay_balances(db, account_ids)
+        finally:
+            db.close()
+        if len(account_ids) != args.clients:
+            failures.append(f"счетов загружено {len(account_ids)}")
+        failures.extend(f"журнал расходится со счетом {item['account_number']}: OPENING {item['opened']}" for item in mismatches)
+
+        report, _, elapsed, _ = run_import(paths, 'copy')
+        print(f"повтор: {report.totals}, {elapsed:.1f} с")
+        for name in ('clients', 'accounts', 'cards'):
+            expected = {"inserted": 0, "skipped": args.clients + 1, "failed": BROKEN}
+            if report.totals.get(name) != expected:
+                failures.append(f"повтор {name}: {report.totals.get(name)} вместо {expected}")
+
+        insert_paths, _ = write_files(directory, args.clients)
+        report, _, elapsed, _ = run_import(insert_paths, 'insert')
+        print(f"INSERT: {report.totals}, {elapsed:.1f} с ({3 * args.clients / elapsed:.0f} строк/с)")
+        if any(totals["inserted"] != args.clients for totals in report.totals.values()):
+            failures.append(f"INSERT: {report.totals}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    for failure in failures[:50]:
+        print(f"FAIL: {failure}")
+    print("OK" if not failures else "FAILED")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
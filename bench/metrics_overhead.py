@@ -0,0 +1,78 @@
+'''
+Микробенчмарк накладных расходов метрик (см. app/metrics.py).
+
+Измеряет время вызова пустого эндпоинта, обернутого в `metrics.instrument()`, с теми же
+этапами (`metrics.stage()`), что и у эндпоинта удержания, при включенных и выключенных метриках.
+Разница - накладные расходы метрик на один запрос. База данных не используется.
+
+Бюджет по умолчанию (25 мкс) составляет доли процента от типичной длительности операции
+с обращением к базе данных (единицы миллисекунд).
+
+```sh
+python -m bench.metrics_overhead --iterations 200000 --threads 8 --budget-us 25
+```
+
+Код завершения 1, если накладные расходы превышают бюджет `--budget-us` (в микросекундах).
+'''
+import argparse
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask
+from app import metrics
+from app.settings import app_settings
+
+STAGES = ('json_parse', 'idempotency_check', 'account_lookup', 'commit')
+
+
+@metrics.instrument('bench')
+def endpoint():
+    for name in STAGES:
+        with metrics.stage(name):
+            pass
+    return {}, 201
+
+
+def measure(app: Flask, iterations: int, threads: int) -> float:
+    '''
+    Среднее время одного вызова `endpoint()` в микросекундах при `threads` параллельных потоках.
+    '''
+    def loop(count: int):
+        with app.app_context():
+            for _ in range(count):
+                endpoint()
+
+    per_thread = iterations // threads
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(loop, [per_thread] * threads))
+    return (time.perf_counter() - started) / (per_thread * threads) * 1_000_000
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=200_000)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--budget-us', type=float, default=25.0, help='допустимые накладные расходы на запрос, мкс')
+    parser.add_argument('--repeat', type=int, default=3, help='количество повторов, берется лучший результат')
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    results = {}
+    for enabled in (False, True):
+        app_settings.metrics_enabled = enabled
+        results[enabled] = min(measure(app, args.iterations, args.threads) for _ in range(args.repeat))
+
+    overhead = results[True] - results[False]
+    print(f"metrics off: {results[False]:.2f} us/request")
+    print(f"metrics on:  {results[True]:.2f} us/request")
+    print(f"overhead:    {overhead:.2f} us/request (budget {args.budget_us:.2f} us)")
+    if overhead > args.budget_us:
+        print("FAILED")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,300 @@
+'''
+Нагрузочный тест жизненного цикла операций.
+
+Каждый поток в цикле выполняет один из сценариев:
+- удержание -> списание (и, с заданной вероятностью, возврат);
+- удержание -> отмена.
+
+Счета выбираются с перекосом: доля `--hot-share` операций приходится на `--hot-accounts`
+«горячих» счетов, остальные распределяются равномерно по прочим счетам.
+
+Запросы отправляются либо в приложение Flask внутри процесса (тестовый клиент, та же база
+данных, что и у сервера), либо на запущенный сервер по адресу `--url`. Счета в обоих случаях
+создаются напрямую в базе данных, поэтому сервер должен работать с той же базой.
+
+```sh
+python -m bench.operations --threads 16 --duration 30 --accounts 100 --hot-accounts 5 --hot-share 0.5
+python -m bench.operations --url http://127.0.0.1:5000 --threads 64 --operations 10000 --output results.json
+```
+
+Для каждого эндпоинта выводятся количество запросов по кодам ответа, пропускная способность
+и задержки p50/p95/p99. С `--output` результаты и параметры запуска сохраняются в JSON,
+с `--compare` - сравниваются с результатами предыдущего запуска.
+'''
+import argparse
+import json
+import math
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import defaultdict
+from decimal import Decimal
+from app.db_session import engine
+from bench.common import seed_accounts
+
+ENDPOINTS = ('hold', 'charge', 'cancel', 'refund')
+
+
+class InProcessTarget:
+    '''
+    Отправка запросов в приложение Flask без сети. У каждого потока свой тестовый клиент.
+    '''
+
+    def __init__(self):
+        from run import production_app
+        self.app = production_app()
+        self.local = threading.local()
+
+    def post(self, path: str, body: dict = None) -> int:
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        return client.post(path, json=body).status_code
+
+
+class HttpTarget:
+    '''
+    Отправка запросов на запущенный сервер.
+    '''
+
+    def __init__(self, url: str):
+        self.url = url.rstrip('/')
+
+    def post(self, path: str, body: dict = None) -> int:
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(
+            self.url + path, data=data, method='POST',
+            headers={'Content-Type': 'application/json'}
+        )
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+
+class AccountPicker:
+    '''
+    Выбор счета с перекосом в сторону «горячих» счетов.
+    '''
+
+    def __init__(self, account_numbers: list, hot_accounts: int, hot_share: float):
+        self.hot = account_numbers[:hot_accounts]
+        self.cold = account_numbers[hot_accounts:] or self.hot
+        self.hot_share = hot_share if self.hot else 0
+
+    def pick(self, rnd: random.Random) -> str:
+        if rnd.random() < self.hot_share:
+            return rnd.choice(self.hot)
+        return rnd.choice(self.cold)
+
+
+class Recorder:
+    '''
+    Сбор задержек и кодов ответа по эндпоинтам. Каждый поток пишет в свои списки,
+    объединение выполняется после завершения теста.
+    '''
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    def call(self, target, endpoint: str, path: str, body: dict = None) -> int:
+        started = time.perf_counter()
+        try:
+            status = target.post(path, body)
+        except OSError:
+            status = 'error'
+        self.latencies[endpoint].append(time.perf_counter() - started)
+        self.statuses[endpoint][status] += 1
+        return status
+
+    def merge(self, other: 'Recorder'):
+        for endpoint, values in other.latencies.items():
+            self.latencies[endpoint].extend(values)
+        for endpoint, counts in other.statuses.items():
+            for status, count in counts.items():
+                self.statuses[endpoint][status] += count
+
+
+def percentile(values: list, q: float) -> float:
+    '''
+    Перцентиль по методу ближайшего ранга. `values` должен быть отсортирован.
+    '''
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, math.ceil(q / 100 * len(values)) - 1))
+    return values[index]
+
+
+def run_lifecycle(target, recorder: Recorder, picker: AccountPicker, rnd: random.Random, args):
+    operation_id = str(uuid.uuid4())
+    base = f'/api/operation/{operation_id}'
+    status = recorder.call(target, 'hold', f'{base}/hold', {
+        'account_identifier': picker.pick(rnd),
+        'amount': float(args.amount),
+        'description': 'bench'
+    })
+    if status != 201:
+        return
+
+    if rnd.random() < args.cancel_ratio:
+        recorder.call(target, 'cancel', f'{base}/cancel')
+        return
+
+    status = recorder.call(target, 'charge', f'{base}/charge')
+    if status == 200 and rnd.random() < args.refund_ratio:
+        recorder.call(target, 'refund', f'{base}/refund', {'description': 'bench'})
+
+
+def run(target, picker: AccountPicker, args) -> tuple:
+    '''
+    Запуск `args.threads` потоков. Тест завершается по истечении `args.duration` секунд
+    или после `args.operations` сценариев (что наступит раньше).
+    '''
+    deadline = time.perf_counter() + args.duration if args.duration else None
+    remaining = [args.operations]
+    lock = threading.Lock()
+    recorders = []
+
+    def take() -> bool:
+        if deadline is not None and time.perf_counter() >= deadline:
+            return False
+        if args.operations:
+            with lock:
+                if remaining[0] <= 0:
+                    return False
+                remaining[0] -= 1
+        return True
+
+    def worker(seed: int):
+        rnd = random.Random(seed)
+        recorder = Recorder()
+        while take():
+            run_lifecycle(target, recorder, picker, rnd, args)
+        with lock:
+            recorders.append(recorder)
+
+    threads = [
+        threading.Thread(target=worker, args=(args.seed + i,))
+        for i in range(args.threads)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    total = Recorder()
+    for recorder in recorders:
+        total.merge(recorder)
+    return total, elapsed
+
+
+def summarize(recorder: Recorder, elapsed: float) -> dict:
+    endpoints = {}
+    for endpoint in ENDPOINTS:
+        values = sorted(recorder.latencies.get(endpoint, []))
+        if not values:
+            continue
+        endpoints[endpoint] = {
+            'requests': len(values),
+            'statuses': {str(k): v for k, v in sorted(recorder.statuses[endpoint].items(), key=str)},
+            'throughput': len(values) / elapsed,
+            'p50_ms': percentile(values, 50) * 1000,
+            'p95_ms': percentile(values, 95) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+            'max_ms': values[-1] * 1000,
+        }
+    requests = sum(e['requests'] for e in endpoints.values())
+    return {
+        'elapsed_s': elapsed,
+        'requests': requests,
+        'throughput': requests / elapsed if elapsed else 0,
+        'endpoints': endpoints,
+    }
+
+
+def print_summary(summary: dict, baseline: dict = None):
+    print(f"{'endpoint':<8} {'requests':>9} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}  statuses")
+    for endpoint, e in summary['endpoints'].items():
+        print(
+            f"{endpoint:<8} {e['requests']:>9} {e['throughput']:>9.1f} {e['p50_ms']:>9.2f} "
+            f"{e['p95_ms']:>9.2f} {e['p99_ms']:>9.2f}  {e['statuses']}"
+        )
+        previous = (baseline or {}).get('endpoints', {}).get(endpoint)
+        if previous:
+            print(
+                f"{'':<8} {'':>9} {_delta(e['throughput'], previous['throughput']):>9} "
+                f"{_delta(e['p50_ms'], previous['p50_ms']):>9} {_delta(e['p95_ms'], previous['p95_ms']):>9} "
+                f"{_delta(e['p99_ms'], previous['p99_ms']):>9}"
+            )
+    print(f"total: {summary['requests']} requests in {summary['elapsed_s']:.1f}s, {summary['throughput']:.1f} req/s")
+
+
+def _delta(current: float, previous: float) -> str:
+    if not previous:
+        return '-'
+    return f"{(current - previous) / previous * 100:+.0f}%"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='адрес запущенного сервера; по умолчанию - приложение внутри процесса')
+    parser.add_argument('--threads', type=int, default=8, help='количество параллельных клиентов')
+    parser.add_argument('--duration', type=float, default=10, help='длительность теста в секундах, 0 - без ограничения')
+    parser.add_argument('--operations', type=int, default=0, help='количество сценариев, 0 - без ограничения')
+    parser.add_argument('--accounts', type=int, default=100)
+    parser.add_argument('--hot-accounts', type=int, default=0, help='количество «горячих» счетов')
+    parser.add_argument('--hot-share', type=float, default=0.0, help='доля операций на «горячих» счетах')
+    parser.add_argument('--cancel-ratio', type=float, default=0.3, help='доля удержаний, которые отменяются')
+    parser.add_argument('--refund-ratio', type=float, default=0.1, help='доля списаний, по которым делается возврат')
+    parser.add_argument('--amount', type=Decimal, default=Decimal('1.00'))
+    parser.add_argument('--balance', type=Decimal, default=Decimal('1000000.00'))
+    parser.add_argument('--seed', type=int, default=0, help='начальное значение генератора случайных чисел')
+    parser.add_argument('--output', help='файл для сохранения результатов в JSON')
+    parser.add_argument('--compare', help='JSON с результатами предыдущего запуска')
+    args = parser.parse_args()
+
+    if not args.duration and not args.operations:
+        parser.error('нужно задать --duration или --operations')
+    if args.hot_accounts >= args.accounts and args.hot_share < 1:
+        parser.error('--hot-accounts должно быть меньше --accounts')
+
+    engine.echo = False
+    account_numbers = seed_accounts(args.accounts, args.balance)
+    picker = AccountPicker(account_numbers, args.hot_accounts, args.hot_share)
+    target = HttpTarget(args.url) if args.url else InProcessTarget()
+
+    recorder, elapsed = run(target, picker, args)
+    summary = summarize(recorder, elapsed)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['summary']
+    print_summary(summary, baseline)
+
+    if args.output:
+        parameters = {k: str(v) if isinstance(v, Decimal) else v for k, v in vars(args).items()}
+        parameters['target'] = 'http' if args.url else 'in-process'
+        with open(args.output, 'w') as f:
+            json.dump({'parameters': parameters, 'summary': summary}, f, indent=2)
+
+    errors = sum(
+        count
+        for counts in recorder.statuses.values()
+        for status, count in counts.items()
+        if status == 'error' or status >= 500
+    )
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,164 @@
+'''
+Проверка публикации событий операций через outbox (см. app/outbox.py).
+
+`--threads` потоков выполняют на `--accounts` счетах сценарии «удержание -> списание -> возврат»
+и «удержание -> отмена», часть удержаний получает отказ из-за недостатка средств. Параллельно
+ретранслятор отправляет события в приемник, который отклоняет каждую `--fail-every`-ю отправку.
+После отправки всех событий проверяется, что:
+- на каждое событие журнала изменений (см. app/ledger.py) отправлено ровно одно событие outbox
+  с той же суммой и теми же балансами после изменения, и лишних событий нет;
+- события одной операции получены в порядке изменений;
+- повторно отправленные после ошибки пакеты не создали дубликатов `event_id`.
+
+```sh
+python -m bench.outbox --threads 8 --operations 400 --accounts 20
+```
+
+Код завершения 1, если обнаружено расхождение.
+'''
+import argparse
+import random
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from sqlalchemy import select
+from app.db_session import engine, session
+from app.database import Accounts, Ledger
+from app.ledger import ledger_writer
+from app.outbox import OutboxRelay, QueueSink
+from app.services import process_hold_funds, process_charge_funds, process_cancel_hold, process_refund_funds
+from app.settings import app_settings
+from bench.common import seed_accounts
+
+ORDER = {'HOLD': 0, 'CHARGE': 1, 'CANCEL': 1, 'EXPIRE': 1, 'REFUND': 2}
+
+
+class FlakySink(QueueSink):
+    '''
+    Приемник, отклоняющий каждую `fail_every`-ю отправку.
+    '''
+
+    def __init__(self, fail_every: int):
+        super().__init__()
+        self.fail_every = fail_every
+        self.sends = 0
+        self.failures = 0
+
+    def send(self, events: list):
+        self.sends += 1
+        if self.fail_every and self.sends % self.fail_every == 0:
+            self.failures += 1
+            raise ConnectionError("приемник недоступен")
+        super().send(events)
+
+
+def scenario(account_number: str, rng: random.Random):
+    operation_id = str(uuid.uuid4())
+    try:
+        process_hold_funds(operation_id, account_number, Decimal(rng.randint(100, 20000)) / 100, 'bench')
+    except ValueError:
+        return
+    if rng.random() < 0.6:
+        process_charge_funds(operation_id)
+        if rng.random() < 0.3:
+            process_refund_funds(operation_id)
+    else:
+        process_cancel_hold(operation_id)
+
+
+def relay_until_stopped(relay: OutboxRelay, stop: threading.Event):
+    while True:
+        stopping = stop.is_set()
+        try:
+            published = relay.drain()
+        except Exception:
+            time.sleep(0.01)
+            continue
+        if stopping and published == 0:
+            return
+        time.sleep(0.01)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--operations', type=int, default=400, help='количество сценариев')
+    parser.add_argument('--accounts', type=int, default=20)
+    parser.add_argument('--balance', type=Decimal, default=Decimal('500.00'))
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--fail-every', type=int, default=4, help='каждая N-я отправка завершается ошибкой, 0 - без ошибок')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    engine.echo = False
+    app_settings.outbox_enabled = True
+    accounts = seed_accounts(args.accounts, args.balance)
+    rng = random.Random(args.seed)
+    work = [(rng.choice(accounts), random.Random(rng.random())) for _ in range(args.operations)]
+
+    sink = FlakySink(args.fail_every)
+    relay = OutboxRelay(sink, batch_size=args.batch_size)
+    stop = threading.Event()
+    relay_thread = threading.Thread(target=relay_until_stopped, args=(relay, stop))
+    relay_thread.start()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        list(executor.map(lambda item: scenario(*item), work))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    relay_thread.join()
+    ledger_writer.flush()
+
+    db = session()
+    try:
+        account_ids = db.scalars(select(Accounts.id).where(Accounts.account_number.in_(accounts))).all()
+        ledger = {
+            (str(row.operation_id), row.entry_type): row
+            for row in db.execute(
+                select(Ledger).where(Ledger.account_id.in_(account_ids), Ledger.entry_type != 'OPENING')
+            ).scalars()
+        }
+    finally:
+        db.close()
+
+    events = [event for event in sink.events if event["account_id"] in set(accounts)]
+    print(
+        f"сценариев {args.operations} за {elapsed:.1f} с, событий журнала {len(ledger)}, "
+        f"событий outbox {len(events)}, отправок {sink.sends}, ошибок приемника {sink.failures}"
+    )
+
+    failures = []
+    received = {}
+    last_order = {}
+    for event in events:
+        key = (event["operation_id"], event["event_type"])
+        if key in received:
+            failures.append(f"повтор события {key}")
+        received[key] = event
+        order = ORDER[event["event_type"]]
+        if order < last_order.get(event["operation_id"], -1):
+            failures.append(f"операция {event['operation_id']}: {event['event_type']} получено после более позднего события")
+        last_order[event["operation_id"]] = order
+
+    if len({event["event_id"] for event in sink.events}) != len(sink.events):
+        failures.append("дубликаты event_id")
+    for key, entry in ledger.items():
+        event = received.get(key)
+        if event is None:
+            failures.append(f"нет события outbox для {key}")
+        elif (event["amount"], event["balance"], event["held_balance"]) != (entry.amount, entry.balance_after, entry.held_balance_after):
+            failures.append(f"событие {key} расходится с журналом")
+    failures.extend(f"лишнее событие outbox {key}" for key in received.keys() - ledger.keys())
+
+    for failure in failures[:50]:
+        print(f"FAIL: {failure}")
+    print("OK" if not failures else "FAILED")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
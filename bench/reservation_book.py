@@ -0,0 +1,422 @@
+'''
+Проверка согласованности книги резервирований (см. app/reservation_book.py) с удержаниями в базе данных.
+
+Четыре фазы:
+1. одна и та же случайная последовательность удержаний, повторов, отмен и списаний выполняется
+   на двух счетах с одинаковым балансом: обычном (удержания в базе данных) и горячем с книгой.
+   Каждая операция должна получить одинаковый результат (успех, повтор или ошибку с тем же
+   сообщением), а после записи книги в базу данных должны совпасть балансы счетов, статусы
+   операций и сверка с журналом изменений;
+2. `--threads` потоков параллельно удерживают средства горячего счета через книгу: успешных
+   удержаний должно быть ровно столько, сколько позволяет баланс;
+3. дочерний процесс удерживает и отменяет средства через книгу и завершается, не записав ее
+   в базу данных. Все подтвержденные им операции должны восстановиться из WAL
+   (`reservation_book.recover()`);
+4. последовательность фазы 1 выполняется в двух процессах с собственными книгами: каждая операция
+   отправляется в случайный процесс, поэтому удержание, подтвержденное книгой одного процесса,
+   списывается, отменяется и повторяется в другом до записи книги в базу данных. После записи обеих
+   книг удержания повторяются еще раз в другом процессе, в том числе для завершенных операций.
+   Результаты операций, балансы, статусы и сверка с журналом должны совпасть с путем без книги.
+   Баланс счетов этой фазы больше суммы всех удержаний: свободный остаток книги одного процесса
+   недоступен книге другого (см. app/hot_accounts.py - fund_book()), поэтому при нехватке средств
+   книги двух процессов отказывают раньше, чем одна строка счета. Отказы из-за нехватки средств
+   проверяются в фазе 1.
+
+```sh
+python -m bench.reservation_book --operations 2000 --seed 1 --threads 8
+```
+
+Код завершения 1, если обнаружено расхождение.
+'''
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from app.db_session import engine, session
+from app.database import Transactions
+from app.hot_accounts import set_hold_slots
+from app.ledger import ledger_writer, replay_balances
+from app.reservation_book import reservation_book
+from app.services import process_hold_funds, process_cancel_hold, process_charge_funds
+from app.settings import app_settings
+from bench.common import seed_accounts, load_account, load_balances
+
+
+def _hot_account(balance: Decimal) -> str:
+    account_number = seed_accounts(1, balance)[0]
+    db = session()
+    try:
+        set_hold_slots(db, account_number, 1)
+        db.commit()
+    finally:
+        db.close()
+    return account_number
+
+
+def _call(fn, *args) -> tuple:
+    try:
+        result = fn(*args)
+        return 'ok', result["status"], result["message"]
+    except ValueError as e:
+        return 'error', str(e)
+    except IntegrityError:
+        return 'error', 'IntegrityError'
+
+
+def _normalize(outcome: tuple, account_number: str, operation_id: str) -> tuple:
+    return tuple(
+        value.replace(account_number, '<account>').replace(operation_id, '<operation>') if isinstance(value, str) else value
+        for value in outcome
+    )
+
+
+def _statuses(account_number: str) -> dict:
+    db = session()
+    try:
+        account_id = load_account(account_number).id
+        return {
+            str(row.transaction_id): row.transaction_status
+            for row in db.execute(
+                select(Transactions.transaction_id, Transactions.transaction_status)
+                .where(Transactions.account_id == account_id)
+            )
+        }
+    finally:
+        db.close()
+
+
+def _scenario(count: int, seed: int) -> list:
+    '''
+    Последовательность операций над ключами операций. Повторы удержаний выбираются только
+    среди активных удержаний.
+    '''
+    rng = random.Random(seed)
+    operations, active, finished = [], [], []
+    for key in range(count):
+        roll = rng.random()
+        if roll < 0.55 or not active:
+            amount = Decimal(rng.randint(100, 5000)) / 100 if rng.random() < 0.9 else Decimal(rng.randint(200, 900))
+            operations.append(('hold', key, amount))
+            active.append(key)
+        elif roll < 0.65:
+            operations.append(('hold', rng.choice(active), None))
+        elif roll < 0.85:
+            target = active.pop(rng.randrange(len(active)))
+            operations.append(('cancel', target, None))
+            finished.append(target)
+        elif roll < 0.95:
+            target = active.pop(rng.randrange(len(active)))
+            operations.append(('charge', target, None))
+            finished.append(target)
+        else:
+            operations.append(('cancel', rng.choice(finished) if finished else key, None))
+    return operations
+
+
+ACTIONS = {'hold': process_hold_funds, 'cancel': process_cancel_hold, 'charge': process_charge_funds}
+
+
+def _compare_results(plain: str, hot: str, ids: dict) -> list:
+    '''
+    Сравнение балансов, статусов операций и сверки с журналом счета без книги `plain` и горячего счета `hot`.
+    '''
+    failures = []
+    plain_account, hot_account = load_balances(plain), load_balances(hot)
+    if (plain_account.balance, plain_account.held_balance) != (hot_account.balance, hot_account.held_balance):
+        failures.append(
+            f"балансы счетов различаются: база данных {plain_account.balance}/{plain_account.held_balance}, "
+            f"книга {hot_account.balance}/{hot_account.held_balance}"
+        )
+
+    plain_statuses, hot_statuses = _statuses(plain), _statuses(hot)
+    for key in sorted({key for _, key in ids}):
+        plain_status = plain_statuses.get(ids.get((plain, key)))
+        hot_status = hot_statuses.get(ids.get((hot, key)))
+        if plain_status != hot_status:
+            failures.append(f"операция {key}: статус {plain_status} в базе данных, {hot_status} в книге")
+
+    db = session()
+    try:
+        mismatches = replay_balances(db, [load_account(plain).id, load_account(hot).id])
+    finally:
+        db.close()
+    failures.extend(f"журнал расходится со счетом {item['account_number']}" for item in mismatches)
+    return failures
+
+
+def compare_paths(operations: int, seed: int, balance: Decimal) -> list:
+    plain = seed_accounts(1, balance)[0]
+    hot = _hot_account(balance)
+    ids = {}
+    amounts = {}
+    failures = []
+    timings = {plain: [], hot: []}
+
+    for step, (action, key, amount) in enumerate(_scenario(operations, seed)):
+        if amount is not None:
+            amounts[key] = amount
+        outcomes = []
+        for account_number in (plain, hot):
+            operation_id = ids.setdefault((account_number, key), str(uuid.uuid4()))
+            started = time.perf_counter()
+            if action == 'hold':
+                outcome = _call(process_hold_funds, operation_id, account_number, amounts.get(key, Decimal('1.00')), 'bench')
+                timings[account_number].append(time.perf_counter() - started)
+            elif action == 'cancel':
+                outcome = _call(process_cancel_hold, operation_id)
+            else:
+                outcome = _call(process_charge_funds, operation_id)
+            outcomes.append(_normalize(outcome, account_number, operation_id))
+        if outcomes[0] != outcomes[1]:
+            failures.append(f"шаг {step} {action}: база данных {outcomes[0]}, книга {outcomes[1]}")
+
+    reservation_book.flush()
+    ledger_writer.flush()
+
+    plain_account, hot_account = load_balances(plain), load_balances(hot)
+    print(
+        f"база данных: баланс {plain_account.balance}, удержано {plain_account.held_balance}, "
+        f"удержание {sum(timings[plain]) / len(timings[plain]) * 1e6:.0f} мкс"
+    )
+    print(
+        f"книга:       баланс {hot_account.balance}, удержано {hot_account.held_balance}, "
+        f"удержание {sum(timings[hot]) / len(timings[hot]) * 1e6:.0f} мкс"
+    )
+    return failures + _compare_results(plain, hot, ids)
+
+
+class Worker:
+    '''
+    Второй процесс фазы 4 со своей книгой: выполняет операции, полученные через stdin (см. serve()).
+    '''
+
+    def __init__(self):
+        env = {
+            **os.environ,
+            "RESERVATION_BOOK_ENABLED": 'true',
+            "RESERVATION_BOOK_WAL_DIR": reservation_book.directory,
+            "RESERVATION_BOOK_FLUSH_INTERVAL_MS": str(app_settings.reservation_book_flush_interval_ms)
+        }
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'bench.reservation_book', '--serve'],
+            env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
+        )
+
+    def call(self, action: str, *args):
+        self.process.stdin.write(json.dumps([action, *args], default=str) + '\n')
+        self.process.stdin.flush()
+        return tuple(json.loads(self.process.stdout.readline()))
+
+    def stop(self):
+        self.call('stop')
+        self.process.wait()
+
+
+def serve():
+    '''
+    Цикл второго процесса фазы 4: одна операция `[action, *args]` в строке stdin, результат `_call()` в stdout.
+    '''
+    app_settings.reservation_book_enabled = True
+    for line in sys.stdin:
+        action, *args = json.loads(line)
+        if action == 'flush':
+            reservation_book.flush()
+            outcome = ()
+        elif action == 'stop':
+            reservation_book.stop()
+            ledger_writer.flush()
+            outcome = ()
+        else:
+            if action == 'hold':
+                args[2] = Decimal(args[2])
+            outcome = _call(ACTIONS[action], *args)
+        print(json.dumps(outcome))
+        sys.stdout.flush()
+        if action == 'stop':
+            return
+
+
+def two_processes(operations: int, seed: int) -> list:
+    balance = Decimal(operations * 1000)
+    plain = seed_accounts(1, balance)[0]
+    hot = _hot_account(balance)
+    worker = Worker()
+    rng = random.Random(seed)
+    ids = {}
+    amounts = {}
+    holders = {}
+    failures = []
+    crossed = 0
+
+    def run(remote: bool, action: str, key: int) -> list:
+        outcomes = []
+        for account_number in (plain, hot):
+            operation_id = ids.setdefault((account_number, key), str(uuid.uuid4()))
+            args = (operation_id, account_number, amounts.get(key, Decimal('1.00')), 'bench') if action == 'hold' else (operation_id,)
+            outcome = worker.call(action, *args) if remote else _call(ACTIONS[action], *args)
+            outcomes.append(_normalize(outcome, account_number, operation_id))
+        return outcomes
+
+    try:
+        for step, (action, key, amount) in enumerate(_scenario(operations, seed)):
+            if amount is not None:
+                amounts[key] = amount
+            remote = rng.random() < 0.5
+            if key in holders and holders[key] != remote:
+                crossed += 1
+            holders.setdefault(key, remote)
+            outcomes = run(remote, action, key)
+            if outcomes[0] != outcomes[1]:
+                failures.append(f"шаг {step} {action} ({'второй' if remote else 'первый'} процесс): база данных {outcomes[0]}, книга {outcomes[1]}")
+
+        '''
+        Повтор удержаний в другом процессе после записи обеих книг: книга не должна принять
+        удержание, уже записанное в базу данных.
+        '''
+        worker.call('flush')
+        reservation_book.flush()
+        for key, remote in sorted(holders.items())[:200]:
+            outcomes = run(not remote, 'hold', key)
+            if outcomes[0] != outcomes[1]:
+                failures.append(f"повтор удержания {key} после записи: база данных {outcomes[0]}, книга {outcomes[1]}")
+    finally:
+        worker.stop()
+
+    reservation_book.flush()
+    ledger_writer.flush()
+    print(f"два процесса: {operations} операций, в другом процессе {crossed}")
+    return failures + _compare_results(plain, hot, ids)
+
+
+def concurrent_holds(threads: int, holds: int, amount: Decimal, balance: Decimal) -> list:
+    account_number = _hot_account(balance)
+    operations = [(str(uuid.uuid4()), account_number, amount, 'bench') for _ in range(threads * holds)]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        outcomes = list(executor.map(lambda args: _call(process_hold_funds, *args), operations))
+    elapsed = time.perf_counter() - started
+    reservation_book.flush()
+
+    held = sum(1 for outcome in outcomes if outcome[0] == 'ok')
+    expected = min(len(operations), int(balance // amount))
+    account = load_balances(account_number)
+    statuses = _statuses(account_number)
+    print(f"параллельно: {held} удержано, {len(operations) - held} отказов, {len(operations) / elapsed:.0f} оп/с")
+
+    failures = []
+    if held != expected:
+        failures.append(f"удержано {held}, ожидалось {expected}")
+    if account.held_balance != amount * held:
+        failures.append(f"held_balance {account.held_balance} != {amount * held}")
+    if sum(1 for status in statuses.values() if status == 'PENDING') != held:
+        failures.append("количество удержаний PENDING не совпадает с подтвержденными")
+    return failures
+
+
+def crash_recovery(operations: int, balance: Decimal) -> list:
+    account_number = _hot_account(balance)
+    env = {
+        **os.environ,
+        "RESERVATION_BOOK_ENABLED": 'true',
+        "RESERVATION_BOOK_WAL_DIR": reservation_book.directory,
+        "RESERVATION_BOOK_FLUSH_INTERVAL_MS": str(3600 * 1000),
+        "RESERVATION_BOOK_FLUSH_SIZE": str(operations * 10)
+    }
+    child = subprocess.run(
+        [sys.executable, '-m', 'bench.reservation_book', '--child', account_number, '--operations', str(operations)],
+        env=env, capture_output=True, text=True, check=True
+    )
+    acknowledged = json.loads(child.stdout)
+
+    if _statuses(account_number):
+        return ["дочерний процесс записал операции в базу данных до падения"]
+    recovered = reservation_book.recover()
+    ledger_writer.flush()
+
+    statuses = _statuses(account_number)
+    account = load_balances(account_number)
+    held = sum(Decimal(item["amount"]) for item in acknowledged if item["status"] == 'PENDING')
+    print(f"восстановление: {len(acknowledged)} подтвержденных операций, книг {recovered}, удержано {account.held_balance}")
+
+    failures = []
+    for item in acknowledged:
+        if statuses.get(item["operation_id"]) != item["status"]:
+            failures.append(f"операция {item['operation_id']}: {statuses.get(item['operation_id'])} вместо {item['status']}")
+    if account.held_balance != held:
+        failures.append(f"held_balance {account.held_balance} != {held}")
+    db = session()
+    try:
+        failures.extend(
+            f"журнал расходится со счетом {item['account_number']}"
+            for item in replay_balances(db, [load_account(account_number).id])
+        )
+    finally:
+        db.close()
+    return failures
+
+
+def child(account_number: str, operations: int):
+    '''
+    Дочерний процесс фазы 3: удержания и отмены через книгу, вывод подтвержденных операций
+    и завершение без записи книги и без обработчиков atexit.
+    '''
+    acknowledged = {}
+    for step in range(operations):
+        operation_id = str(uuid.uuid4())
+        result = process_hold_funds(operation_id, account_number, Decimal('2.50'), 'bench')
+        acknowledged[operation_id] = {"operation_id": operation_id, "amount": str(result["amount"]), "status": result["status"]}
+        if step % 3 == 0:
+            acknowledged[operation_id]["status"] = process_cancel_hold(operation_id)["status"]
+    print(json.dumps(list(acknowledged.values())))
+    sys.stdout.flush()
+    os._exit(0)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--operations', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--balance', type=Decimal, default=Decimal('1000.00'))
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--holds', type=int, default=100, help='удержаний на поток в параллельной фазе')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    engine.echo = False
+    if args.child:
+        child(args.child, args.operations)
+    if args.serve:
+        serve()
+        return 0
+
+    app_settings.reservation_book_enabled = True
+    reservation_book.directory = tempfile.mkdtemp(prefix='reservation-book-')
+    try:
+        failures = compare_paths(args.operations, args.seed, args.balance)
+        failures += concurrent_holds(args.threads, args.holds, Decimal('1.25'), args.balance / 4)
+        failures += crash_recovery(min(args.operations, 300), args.balance)
+        failures += two_processes(min(args.operations, 600), args.seed + 1)
+    finally:
+        reservation_book.stop()
+        shutil.rmtree(reservation_book.directory, ignore_errors=True)
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    print("OK" if not failures else "FAILED")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,134 @@
+'''
+Стресс-проверка параллельных операций над одним счетом.
+
+N потоков одновременно выполняют удержания на одном счету, затем параллельно
+списывают и отменяют полученные удержания. После каждой фазы проверяется, что
+баланс и удерживаемый баланс счета в точности совпадают с суммами успешных операций,
+то есть ни одно обновление не потеряно и баланс не ушел в минус.
+
+```sh
+python -m bench.stress_hold --threads 32 --holds 50 --amount 1.25 --balance 1000
+python -m bench.stress_hold --threads 32 --holds 50 --slots 8     # "горячий" счет со слотами
+```
+
+С `--slots` счет переводится в режим слотов удерживаемого баланса (см. app/hot_accounts.py),
+и балансы проверяются с учетом слотов; пропускная способность удержаний сравнивается
+с запуском без `--slots`. С `RESERVATION_BOOK_ENABLED=true` удержания горячего счета выполняются
+через книгу резервирований (см. app/reservation_book.py) и перед проверкой записываются в базу данных.
+
+Код завершения 1, если обнаружено расхождение.
+'''
+import argparse
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from sqlalchemy import func, select
+from app.db_session import engine, session
+from app.database import Transactions
+from app.hot_accounts import set_hold_slots
+from app.reservation_book import reservation_book
+from app.services import process_hold_funds, process_charge_funds, process_cancel_hold
+from bench.common import seed_accounts, load_account, load_balances
+
+
+def _run(threads: int, fn, arguments: list) -> tuple:
+    '''
+    Выполняет `fn` для каждого набора аргументов в `threads` потоках.
+
+    Выходные данные - список успешных аргументов, количество ошибок и длительность фазы.
+    '''
+    def call(args):
+        try:
+            fn(*args)
+            return args
+        except ValueError:
+            return None
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(call, arguments))
+    elapsed = time.perf_counter() - started
+    succeeded = [args for args in results if args is not None]
+    return succeeded, len(results) - len(succeeded), elapsed
+
+
+def _pending_sum(account_id: int) -> Decimal:
+    db = session()
+    try:
+        return db.scalar(
+            select(func.coalesce(func.sum(Transactions.amount), 0)).where(
+                Transactions.account_id == account_id,
+                Transactions.transaction_type == 'HOLD',
+                Transactions.transaction_status == 'PENDING'
+            )
+        )
+    finally:
+        db.close()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--holds', type=int, default=50, help='удержаний на поток')
+    parser.add_argument('--amount', type=Decimal, default=Decimal('1.25'))
+    parser.add_argument('--balance', type=Decimal, default=Decimal('500.00'))
+    parser.add_argument('--slots', type=int, default=0, help='количество слотов удерживаемого баланса счета')
+    args = parser.parse_args()
+
+    engine.echo = False
+    account_number = seed_accounts(1, args.balance)[0]
+    account_id = load_account(account_number).id
+    if args.slots:
+        db = session()
+        try:
+            set_hold_slots(db, account_number, args.slots)
+            db.commit()
+        finally:
+            db.close()
+    failures = []
+
+    '''
+    Фаза 1 - параллельные удержания. Часть из них должна получить отказ по недостатку средств.
+    '''
+    holds = [
+        (str(uuid.uuid4()), account_number, args.amount, 'stress')
+        for _ in range(args.threads * args.holds)
+    ]
+    held, rejected, elapsed = _run(args.threads, process_hold_funds, holds)
+    reservation_book.flush()
+    account = load_balances(account_number)
+    expected_held = args.amount * len(held)
+    print(f"hold:   {len(held)} ok, {rejected} rejected, {len(holds) / elapsed:.0f} op/s")
+    if account.held_balance != expected_held or account.held_balance != _pending_sum(account_id):
+        failures.append(f"held_balance {account.held_balance} != {expected_held}")
+    if account.held_balance > account.balance:
+        failures.append(f"held_balance {account.held_balance} > balance {account.balance}")
+
+    '''
+    Фаза 2 - параллельные списания и отмены. Каждая операция отправляется дважды,
+    чтобы проверить, что повторы не списывают средства повторно.
+    '''
+    to_charge = [(operation[0],) for operation in held[::2]]
+    to_cancel = [(operation[0],) for operation in held[1::2]]
+    _, charge_errors, _ = _run(args.threads, process_charge_funds, to_charge * 2)
+    _, cancel_errors, _ = _run(args.threads, process_cancel_hold, to_cancel * 2)
+    account = load_balances(account_number)
+    expected_balance = args.balance - args.amount * len(to_charge)
+    print(f"charge: {len(to_charge)}, cancel: {len(to_cancel)}, errors: {charge_errors + cancel_errors}")
+    if account.balance != expected_balance:
+        failures.append(f"balance {account.balance} != {expected_balance}")
+    if account.held_balance != 0:
+        failures.append(f"held_balance {account.held_balance} != 0")
+    if charge_errors or cancel_errors:
+        failures.append(f"{charge_errors + cancel_errors} unexpected errors on charge/cancel")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    print("OK" if not failures else "FAILED")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,159 @@
+'''
+Бенчмарк поиска транзакций на большой таблице.
+
+Скрипт заполняет таблицу transactions заданным количеством строк (по умолчанию
+2 000 000, через INSERT ... SELECT generate_series на стороне PostgreSQL) и измеряет
+задержку запросов, которые выполняет services.py:
+
+- поиск возврата по исходной операции (original_transaction_id + REFUND);
+- поиск незавершенных удержаний счета (HOLD + PENDING);
+- последние операции счета (account_id, сортировка по transaction_date).
+
+Замеры выполняются дважды: без индексов из миграции 7c3e91d2a4b8 (индексы удаляются
+внутри транзакции, которая затем откатывается) и с ними.
+
+```sh
+python -m bench.transaction_lookup --rows 2000000 --accounts 1000
+```
+
+Заполнение выполняется только если в таблице меньше строк, чем `--rows`.
+'''
+import argparse
+import statistics
+import time
+from sqlalchemy import text
+from app.db_session import engine
+from bench.common import seed_accounts
+
+INDEXES = (
+    'ix_transactions_account_id_transaction_date',
+    'ix_transactions_pending_holds',
+    'uq_transactions_refund_original_transaction_id',
+)
+
+QUERIES = {
+    'refund_by_original': (
+        "SELECT * FROM transactions WHERE original_transaction_id = :original_id "
+        "AND transaction_type = 'REFUND' LIMIT 1"
+    ),
+    'pending_holds_of_account': (
+        "SELECT * FROM transactions WHERE account_id = :account_id "
+        "AND transaction_type = 'HOLD' AND transaction_status = 'PENDING' "
+        "ORDER BY transaction_date LIMIT 100"
+    ),
+    'recent_of_account': (
+        "SELECT * FROM transactions WHERE account_id = :account_id "
+        "ORDER BY transaction_date DESC, id DESC LIMIT 50"
+    ),
+}
+
+
+def seed_transactions(connection, rows: int, accounts: int):
+    '''
+    Дозаполнение таблицы до `rows` строк: 70% удержаний разных статусов и 30% возвратов
+    по завершенным удержаниям.
+    '''
+    existing = connection.scalar(text("SELECT count(*) FROM transactions"))
+    missing = rows - existing
+    if missing <= 0:
+        return
+    seed_accounts(accounts, 1000000)
+    account_ids = connection.scalars(text("SELECT id FROM accounts ORDER BY id DESC LIMIT :n"), {"n": accounts}).all()
+    low, high = min(account_ids), max(account_ids)
+
+    holds = int(missing * 0.7)
+    print(f"seeding {holds} holds...")
+    connection.execute(text("""
+        INSERT INTO transactions (transaction_id, account_id, transaction_type, transaction_date,
+                                  amount, description, transaction_status)
+        SELECT gen_random_uuid(),
+               :low + (random() * (:high - :low))::int,
+               'HOLD',
+               now() - random() * interval '365 days',
+               round((random() * 1000)::numeric, 2),
+               'bench',
+               (ARRAY['COMPLETED', 'COMPLETED', 'COMPLETED', 'CANCELLED', 'PENDING'])[1 + (random() * 4)::int]
+        FROM generate_series(1, :count)
+    """), {"low": low, "high": high, "count": holds})
+
+    refunds = missing - holds
+    print(f"seeding {refunds} refunds...")
+    connection.execute(text("""
+        INSERT INTO transactions (transaction_id, account_id, transaction_type, transaction_date,
+                                  amount, description, transaction_status, original_transaction_id)
+        SELECT gen_random_uuid(), account_id, 'REFUND', transaction_date + interval '1 day',
+               amount, 'bench', 'COMPLETED', transaction_id
+        FROM transactions
+        WHERE transaction_type = 'HOLD' AND transaction_status = 'COMPLETED'
+          AND NOT EXISTS (
+              SELECT 1 FROM transactions r
+              WHERE r.original_transaction_id = transactions.transaction_id AND r.transaction_type = 'REFUND'
+          )
+        LIMIT :count
+    """), {"count": refunds})
+    connection.commit()
+    connection.execute(text("ANALYZE transactions"))
+    connection.commit()
+
+
+def measure(connection, samples: int) -> dict:
+    '''
+    Выполняет каждый запрос `samples` раз со случайными параметрами и возвращает p50/p95 в миллисекундах.
+    '''
+    originals = connection.scalars(text(
+        "SELECT original_transaction_id FROM transactions WHERE transaction_type = 'REFUND' "
+        "ORDER BY random() LIMIT :n"), {"n": samples}).all()
+    accounts = connection.scalars(text(
+        "SELECT account_id FROM transactions ORDER BY random() LIMIT :n"), {"n": samples}).all()
+
+    report = {}
+    for name, query in QUERIES.items():
+        parameters = (
+            [{"original_id": value} for value in originals]
+            if name == 'refund_by_original'
+            else [{"account_id": value} for value in accounts]
+        )
+        timings = []
+        for params in parameters:
+            started = time.perf_counter()
+            connection.execute(text(query), params).all()
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        report[name] = {
+            "p50_ms": round(statistics.median(timings), 3),
+            "p95_ms": round(timings[int(len(timings) * 0.95) - 1], 3),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--accounts', type=int, default=1000)
+    parser.add_argument('--samples', type=int, default=200)
+    args = parser.parse_args()
+
+    engine.echo = False
+    with engine.connect() as connection:
+        seed_transactions(connection, args.rows, args.accounts)
+
+        '''
+        Замер без индексов: DROP INDEX в PostgreSQL транзакционен, поэтому индексы
+        возвращаются на место откатом транзакции.
+        '''
+        for index in INDEXES:
+            connection.execute(text(f"DROP INDEX IF EXISTS {index}"))
+        before = measure(connection, args.samples)
+        connection.rollback()
+
+        after = measure(connection, args.samples)
+        connection.rollback()
+
+    print(f"{'query':<28}{'before p50':>12}{'before p95':>12}{'after p50':>12}{'after p95':>12}")
+    for name in QUERIES:
+        print(f"{name:<28}{before[name]['p50_ms']:>12}{before[name]['p95_ms']:>12}"
+              f"{after[name]['p50_ms']:>12}{after[name]['p95_ms']:>12}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+'''
+Проверка входных данных эндпоинтов удержания (см. app/schemas.py).
+
+Отправляет одиночные и пакетные удержания с некорректными суммами - слишком большими
+(`1e100`, `10**30`), строками, логическими значениями, с лишними знаками после запятой - во
+Flask-приложение и в ASGI-приложение внутри процесса и проверяет, что:
+- одиночное удержание получает ответ 400 с JSON-сообщением (ASGI - тоже);
+- в ответе пакетного удержания у каждого такого элемента код 400;
+- ни один запрос не получил соединение из пула.
+
+```sh
+python -m bench.validation
+```
+
+Код завершения 1, если обнаружено расхождение.
+'''
+import asyncio
+import json
+import sys
+import uuid
+from sqlalchemy import event
+from app.asgi import application
+from app.async_services import async_engine
+from app.db_session import engine
+from run import main as create_app
+
+AMOUNTS = ('1e100', '-1e100', str(10 ** 30), '9999999999999999.99', '"1e100"', '"100"', 'true', '1.005', '0', '-5')
+
+
+class Checkouts:
+    '''
+    Счетчик выдачи соединений из пулов синхронного и асинхронного движков.
+    '''
+
+    def __init__(self):
+        self.count = 0
+        for pool in (engine.pool, async_engine.sync_engine.pool):
+            event.listen(pool, 'checkout', self.checkout)
+
+    def checkout(self, *args):
+        self.count += 1
+
+
+async def asgi_post(path: str, body: str) -> tuple:
+    '''
+    Запрос к ASGI-приложению без сервера. Выходные данные - код ответа и тело.
+    '''
+    messages = [{'type': 'http.request', 'body': body.encode(), 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await application({'type': 'http', 'method': 'POST', 'path': path}, receive, send)
+    return sent[0]['status'], b''.join(message.get('body', b'') for message in sent[1:])
+
+
+def hold_body(amount: str, operation_id: str = None) -> str:
+    item = '"account_identifier": "%s", "amount": %s, "description": "bench"' % (uuid.uuid4(), amount)
+    if operation_id is not None:
+        item = '"operation_id": "%s", %s' % (operation_id, item)
+    return '{%s}' % item
+
+
+def message(body: bytes):
+    try:
+        return json.loads(body).get('message')
+    except (ValueError, AttributeError):
+        return None
+
+
+def main() -> int:
+    engine.echo = False
+    client = create_app(debug=False).test_client()
+    checkouts = Checkouts()
+    failures = []
+
+    for amount in AMOUNTS:
+        path = f'/api/operation/{uuid.uuid4()}/hold'
+        response = client.post(path, data=hold_body(amount), content_type='application/json')
+        if response.status_code != 400 or not message(response.get_data()):
+            failures.append(f"Flask, сумма {amount}: {response.status_code} {response.get_data(as_text=True)[:100]}")
+
+        status, body = asyncio.run(asgi_post(path, hold_body(amount)))
+        if status != 400 or not message(body):
+            failures.append(f"ASGI, сумма {amount}: {status} {body[:100]}")
+
+    batch = '[%s]' % ', '.join(hold_body(amount, str(uuid.uuid4())) for amount in AMOUNTS)
+    response = client.post('/api/operations/hold:batch', data=batch, content_type='application/json')
+    if response.status_code != 200:
+        failures.append(f"пакет: {response.status_code} {response.get_data(as_text=True)[:100]}")
+    else:
+        for amount, result in zip(AMOUNTS, response.get_json()['results']):
+            if result['code'] != 400 or not result.get('message'):
+                failures.append(f"пакет, сумма {amount}: {result}")
+
+    if checkouts.count:
+        failures.append(f"соединение из пула получено {checkouts.count} раз")
+
+    print(f"сумм {len(AMOUNTS)}, соединений из пула {checkouts.count}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    print("OK" if not failures else "FAILED")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,16 +1,314 @@
+import argparse
+import sys
+
 from flask import Flask
 
 from app.routes import bp as main_bp
+from app.money import MoneyJSONProvider
+from app import db_session
 
-def main():
+def main(debug: bool = True):
     app = Flask(__name__)
+    app.json = MoneyJSONProvider(app)
 
-    app.config['DEBUG'] = True
+    app.config['DEBUG'] = debug
 
     app.register_blueprint(main_bp)
 
+    db_session.init_app(app)
+
     return app
 
+def production_app():
+    return main(debug=False)
+
+def parse_args():
+    '''
+    Команды запуска:
+    - без команды - сервер разработки Flask с включенной отладкой;
+    - `serve` - production-сервер с несколькими процессами (см. app/server.py);
+    - `ledger-replay` - сверка балансов счетов с журналом изменений (см. app/ledger.py);
+    - `sweep` - освобождение просроченных удержаний (см. app/sweeper.py);
+    - `settle` - пакетное списание удержаний (см. app/settlement.py);
+    - `hot-account` - слоты удерживаемого баланса "горячих" счетов (см. app/hot_accounts.py);
+    - `reservation-book` - книги резервирований горячих счетов (см. app/reservation_book.py);
+    - `outbox` - ретранслятор событий операций (см. app/outbox.py);
+    - `import` - массовая загрузка клиентов, счетов и карт из CSV и Parquet (см. app/importer.py).
+    '''
+    parser = argparse.ArgumentParser(description='Эмулятор банковской системы.')
+    commands = parser.add_subparsers(dest='command')
+
+    serve_parser = commands.add_parser('serve', help='запуск production-сервера')
+    serve_parser.add_argument('--bind', help='адрес и порт, например 0.0.0.0:5000')
+    serve_parser.add_argument('--workers', type=int, help='количество процессов')
+    serve_parser.add_argument('--threads', type=int, help='количество потоков в процессе')
+
+    replay_parser = commands.add_parser('ledger-replay', help='сверка балансов счетов с журналом изменений')
+    replay_parser.add_argument('--account', type=int, action='append', dest='accounts', help='id счета, можно указать несколько раз')
+    replay_parser.add_argument('--open', action='store_true', help='создать записи OPENING для счетов без них')
+    replay_parser.add_argument('--apply', action='store_true', help='заменить расходящиеся балансы восстановленными по журналу (отказ, если в журнале нет записей операций)')
+
+    sweep_parser = commands.add_parser('sweep', help='освобождение просроченных удержаний')
+    sweep_parser.add_argument('--once', action='store_true', help='один проход вместо постоянной работы')
+    sweep_parser.add_argument('--ttl', type=int, help='время жизни удержания в секундах')
+    sweep_parser.add_argument('--batch-size', type=int, help='количество удержаний в одной транзакции')
+
+    settle_parser = commands.add_parser('settle', help='пакетное списание удержаний')
+    settle_parser.add_argument('--id', dest='settlement_id', help='UUID пакета; для существующего пакета обработка продолжается')
+    settle_parser.add_argument('--file', help='файл с operation_id удержаний, по одному в строке')
+    settle_parser.add_argument('--account', help='номер счета: списать его удержания в статусе PENDING')
+    settle_parser.add_argument('--before', help='только удержания, созданные раньше указанного времени (ISO 8601)')
+    settle_parser.add_argument('--older-than', type=int, help='только удержания старше указанного количества секунд')
+    settle_parser.add_argument('--chunk-size', type=int, help='количество удержаний в одной транзакции')
+    settle_parser.add_argument('--report', help='файл для отчета по каждому удержанию (JSON)')
+
+    hot_parser = commands.add_parser('hot-account', help='слоты удерживаемого баланса "горячего" счета')
+    hot_parser.add_argument('account', nargs='?', help='номер счета; без других параметров - вывод его слотов')
+    hot_parser.add_argument('--enable', action='store_true', help='включить режим слотов с HOT_ACCOUNT_SLOTS слотами')
+    hot_parser.add_argument('--slots', type=int, help='количество слотов, 0 - выключить режим слотов')
+    hot_parser.add_argument('--rebalance', action='store_true', help='перераспределить слоты всех горячих счетов')
+
+    book_parser = commands.add_parser('reservation-book', help='книги резервирований горячих счетов')
+    book_parser.add_argument('--recover', action='store_true', help='перенести в базу данных и освободить книги остановленных процессов')
+
+    outbox_parser = commands.add_parser('outbox', help='ретранслятор событий операций')
+    outbox_parser.add_argument('--once', action='store_true', help='отправить все неотправленные события и завершиться')
+    outbox_parser.add_argument('--status', action='store_true', help='вывести количество неотправленных событий')
+    outbox_parser.add_argument('--sink', choices=('file', 'redis', 'webhook'), help='приемник вместо OUTBOX_SINK')
+
+    import_parser = commands.add_parser('import', help='массовая загрузка клиентов, счетов и карт')
+    import_parser.add_argument('--clients', help='файл клиентов (CSV или .parquet)')
+    import_parser.add_argument('--accounts', help='файл счетов (CSV или .parquet)')
+    import_parser.add_argument('--cards', help='файл карт (CSV или .parquet)')
+    import_parser.add_argument('--method', choices=('copy', 'insert'), default='copy', help='загрузка через COPY или пакетным INSERT')
+    import_parser.add_argument('--chunk-size', type=int, help='количество строк в одной транзакции')
+    import_parser.add_argument('--report', help='файл для отчета по пропущенным и ошибочным строкам (CSV)')
+
+    return parser.parse_args()
+
+def ledger_replay(args) -> int:
+    from app.db_session import session
+    from app.ledger import open_accounts, replay_balances
+
+    db = session()
+    try:
+        if args.open:
+            print(f"OPENING: {open_accounts(db, args.accounts)}")
+        mismatches = replay_balances(db, args.accounts, apply=args.apply)
+        db.commit()
+    except ValueError as e:
+        db.rollback()
+        print(e, file=sys.stderr)
+        return 2
+    finally:
+        db.close()
+
+    for item in mismatches:
+        if not item['opened']:
+            print(f"{item['account_number']}: нет записи OPENING")
+            continue
+        print(
+            f"{item['account_number']}: balance {item['balance']} / журнал {item['ledger_balance']}, "
+            f"held_balance {item['held_balance']} / журнал {item['ledger_held_balance']}"
+            + (f", операций без записей журнала: {item['missing']}" if item['missing'] else "")
+        )
+    print(f"Расхождений: {len(mismatches)}" + (" (исправлены)" if args.apply and mismatches else ""))
+    return 1 if mismatches and not args.apply else 0
+
+def settle(args) -> int:
+    import json
+    import logging
+    import uuid
+    from datetime import datetime, timedelta, timezone
+    from app.account_cache import get_account_ref
+    from app.db_session import session_scope
+    from app.money import json_default
+    from app.schemas import validate_settlement_id, validate_operation_id, validate_account_number, parse_timestamp
+    from app.settlement import settle as run_settle, get_settlement_report
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    operation_ids = account_id = created_before = None
+    try:
+        settlement_id = validate_settlement_id(args.settlement_id) if args.settlement_id else str(uuid.uuid4())
+        existing = get_settlement_report(settlement_id, items=False) is not None
+        if not existing and bool(args.file) == bool(args.account):
+            raise ValueError("Для нового пакета требуется --file или --account.")
+
+        if not existing and args.file:
+            with open(args.file) as file:
+                operation_ids = [validate_operation_id(line.strip()) for line in file if line.strip()]
+        elif not existing:
+            with session_scope() as db:
+                account = get_account_ref(db, validate_account_number(args.account))
+            if account is None:
+                raise ValueError(f"Счет с номером '{args.account}' не найден.")
+            account_id = account.id
+            if args.older_than is not None:
+                created_before = datetime.now(timezone.utc) - timedelta(seconds=args.older_than)
+            elif args.before:
+                created_before = parse_timestamp(args.before, '--before')
+    except ValueError as e:
+        print(e)
+        return 2
+
+    print(f"Пакетное списание {settlement_id}" + (" (продолжение)" if existing else ""))
+    _, report = run_settle(settlement_id, operation_ids, account_id, created_before, args.chunk_size)
+    print(
+        f"Статус: {report['status']}, всего: {report['total']}, списано: {report['charged']} "
+        f"на сумму {report['charged_amount']}, уже списано: {report['skipped']}, ошибок: {report['failed']}"
+    )
+
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump(get_settlement_report(settlement_id), file, ensure_ascii=False, indent=2, default=json_default)
+    return 0 if report['failed'] == 0 else 1
+
+def hot_account(args) -> int:
+    from app.account_cache import get_account_ref
+    from app.db_session import session
+    from app.hot_accounts import set_hold_slots, slot_stats, account_balances, rebalance_accounts
+    from app.schemas import validate_account_number
+    from app.settings import app_settings
+
+    if args.rebalance:
+        print(f"Перераспределены слоты счетов: {rebalance_accounts()}")
+        if not args.account:
+            return 0
+    if not args.account:
+        print("Требуется номер счета или --rebalance.")
+        return 2
+
+    slots = app_settings.hot_account_slots if args.enable else args.slots
+    db = session()
+    try:
+        account_number = validate_account_number(args.account)
+        if slots is not None:
+            if slots < 0:
+                raise ValueError("Количество слотов не может быть отрицательным.")
+            account_id = set_hold_slots(db, account_number, slots)
+            db.commit()
+        else:
+            account = get_account_ref(db, account_number)
+            if account is None:
+                raise ValueError(f"Счет с номером '{account_number}' не найден.")
+            account_id = account.id
+
+        account = account_balances(db, account_id)
+        print(f"Счет {account.account_number}: баланс {account.balance}, удержано {account.held_balance}")
+        for item in slot_stats(db, account_id):
+            print(f"  слот {item['slot']}: передано {item['reserved']}, удержано {item['held']}, списано {item['charged']}")
+    except ValueError as e:
+        print(e)
+        return 2
+    finally:
+        db.close()
+    return 0
+
+def reservation_books(args) -> int:
+    from sqlalchemy import select
+    from app.database import Accounts, AccountSlots
+    from app.db_session import session
+    from app.reservation_book import reservation_book
+
+    if args.recover:
+        print(f"Освобождено книг: {reservation_book.recover()}")
+
+    db = session()
+    try:
+        rows = db.execute(
+            select(Accounts.account_number, AccountSlots.slot, AccountSlots.reserved, AccountSlots.held, AccountSlots.charged, AccountSlots.wal_lsn)
+            .join(Accounts, Accounts.id == AccountSlots.account_id)
+            .where(AccountSlots.slot < 0)
+            .order_by(AccountSlots.account_id, AccountSlots.slot.desc())
+        ).all()
+    finally:
+        db.close()
+    for row in rows:
+        print(
+            f"{row.account_number} книга {-row.slot}: передано {row.reserved}, удержано {row.held}, "
+            f"списано {row.charged}, WAL {row.wal_lsn}"
+        )
+    return 0
+
+def outbox(args) -> int:
+    import logging
+    from app.db_session import session
+    from app.outbox import OutboxRelay, make_sink, outbox_stats
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    if args.status:
+        db = session()
+        try:
+            stats = outbox_stats(db)
+        finally:
+            db.close()
+        print(f"Неотправленных событий: {stats['pending']}, с ошибками отправки: {stats['failing']}, самое раннее: {stats['oldest_pending']}")
+        return 0
+
+    try:
+        relay = OutboxRelay(make_sink(args.sink))
+    except ValueError as e:
+        print(e)
+        return 2
+    if args.once:
+        print(f"Отправлено событий: {relay.drain()}")
+    else:
+        relay.run_forever()
+    return 0
+
+def import_files(args) -> int:
+    import contextlib
+    import logging
+    from app.importer import ImportReport, import_files as run_import
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    if not (args.clients or args.accounts or args.cards):
+        print("Требуется хотя бы один из параметров --clients, --accounts, --cards.")
+        return 2
+
+    with contextlib.ExitStack() as stack:
+        output = stack.enter_context(open(args.report, 'w', newline='', encoding='utf-8')) if args.report else None
+        try:
+            report = run_import(args.clients, args.accounts, args.cards, ImportReport(output), args.method, args.chunk_size)
+        except (ValueError, OSError) as e:
+            print(e)
+            return 2
+
+    for name, totals in report.totals.items():
+        print(f"{name}: загружено {totals['inserted']}, уже существовало {totals['skipped']}, ошибок {totals['failed']}")
+    for example in report.examples:
+        print(f"  {example}")
+    return 0 if all(totals['failed'] == 0 for totals in report.totals.values()) else 1
+
 if __name__ == '__main__':
-    app = main()
-    app.run()
+    args = parse_args()
+
+    if args.command == 'serve':
+        from app.server import serve
+        serve(production_app, bind=args.bind, workers=args.workers, threads=args.threads)
+    elif args.command == 'ledger-replay':
+        sys.exit(ledger_replay(args))
+    elif args.command == 'settle':
+        sys.exit(settle(args))
+    elif args.command == 'hot-account':
+        sys.exit(hot_account(args))
+    elif args.command == 'reservation-book':
+        sys.exit(reservation_books(args))
+    elif args.command == 'import':
+        sys.exit(import_files(args))
+    elif args.command == 'outbox':
+        sys.exit(outbox(args))
+    elif args.command == 'sweep':
+        import logging
+        from app import sweeper
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+        if args.once:
+            print(sweeper.sweep(ttl=args.ttl, batch_size=args.batch_size))
+        else:
+            sweeper.run_forever()
+    else:
+        app = main()
+        app.run()
\ No newline at end of file